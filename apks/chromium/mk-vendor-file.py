@@ -5,11 +5,25 @@
 from __future__ import print_function
 
 import argparse
+import base64
+import collections
+import concurrent.futures
+import json
 import os
 import re
 import shutil
 import subprocess
 import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Share the NAR hashing code of the repo update scripts
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts")
+)
+import nar  # noqa: E402
 
 BASEDIR = "/mnt/cache/chromium"
 
@@ -21,20 +35,193 @@ NO_SUBMODULES = [
     "src/third_party/swiftshader"  # Fails when trying to fetch git-hooks submodule
 ]
 
+# Also hash every path with `nix hash-path`, and fail on any difference
+VERIFY_HASHES = False
+
 
 def hash_path(path):
-    sha256 = (
-        subprocess.check_output(
-            ["nix", "hash-path", "--base32", "--type", "sha256", path]
+    sha256 = nar.hash_path(path)
+    if VERIFY_HASHES:
+        expected = (
+            subprocess.check_output(
+                ["nix", "hash-path", "--base32", "--type", "sha256", path]
+            )
+            .decode()
+            .strip()
         )
-        .decode()
-        .strip()
-    )
+        if sha256 != expected:
+            raise ValueError(
+                "hash mismatch for %s: %s, nix hash-path gives %s"
+                % (path, sha256, expected)
+            )
     if re.match(r"[0-9a-z]{52}", sha256) is None:
         raise ValueError("bad hash %s" % sha256)
     return sha256
 
 
+def tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            size += os.lstat(os.path.join(root, filename)).st_size
+    return size
+
+
+class DepCache:
+    """Memoized checkouts of deps and their hashes, kept under `basedir`.
+
+    Each entry is keyed by a git rev or a CIPD package and version. The index
+    records its sha256, the size of its checkout (0 once the checkout has
+    been pruned, keeping only the hash) and when it was last used. Deps with
+    the same key share an entry, and only one worker may fetch it at a time.
+
+    The work trees of Chromium versions (src and depot_tools) are indexed
+    too, keyed by version and without a sha256, so they are evicted along
+    with the deps. Their entries are dropped once pruned.
+    """
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.index_path = os.path.join(basedir, "index.json")
+        self.lock = threading.Lock()
+        self.key_locks = collections.defaultdict(threading.Lock)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            self.index = json.load(open(self.index_path))
+        self.import_sha256_files()
+        self.import_version_trees()
+
+    def import_sha256_files(self):
+        """Index the <key>.sha256 files written by previous versions
+
+        The files are left in place for those versions, and skipped once their
+        keys are indexed.
+        """
+        if not os.path.isdir(self.basedir):
+            return
+        for filename in os.listdir(self.basedir):
+            key = filename[: -len(".sha256")]
+            if not filename.endswith(".sha256") or key in self.index:
+                continue
+            sha256_path = os.path.join(self.basedir, filename)
+            path = self.path(key)
+            self.index[key] = {
+                "sha256": open(sha256_path).read().strip(),
+                "size": tree_size(path) if os.path.isdir(path) else 0,
+                "last_used": int(os.path.getmtime(sha256_path)),
+            }
+        self.save()
+
+    def import_version_trees(self):
+        """Index the version work trees left by runs which did not index them"""
+        if not os.path.isdir(self.basedir):
+            return
+        for key in os.listdir(self.basedir):
+            path = self.path(key)
+            is_work_tree = os.path.isdir(os.path.join(path, "depot_tools"))
+            if key in self.index or not is_work_tree:
+                continue
+            self.index[key] = {
+                "sha256": None,
+                "size": tree_size(path),
+                "last_used": int(os.path.getmtime(path)),
+            }
+        self.save()
+
+    def save(self):
+        os.makedirs(self.basedir, exist_ok=True)
+        tmp_path = "%s.tmp%d" % (self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, sort_keys=True, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def path(self, key):
+        return os.path.join(self.basedir, key)
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.key_locks[key]
+
+    def get(self, key, need_tree=False):
+        """Get the hash of an entry, if it is cached (with its checkout)"""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or (need_tree and not os.path.isdir(self.path(key))):
+                return None
+            entry["last_used"] = int(time.time())
+            return entry["sha256"]
+
+    def put(self, key, sha256):
+        size = tree_size(self.path(key))
+        with self.lock:
+            self.index[key] = {
+                "sha256": sha256,
+                "size": size,
+                "last_used": int(time.time()),
+            }
+            self.save()
+
+    def put_tree(self, key):
+        """Index a directory without a hash, such as a version work tree"""
+        size = tree_size(self.path(key))
+        with self.lock:
+            self.index[key] = {
+                "sha256": None,
+                "size": size,
+                "last_used": int(time.time()),
+            }
+            self.save()
+
+    def prune_tree(self, key):
+        """Delete the checkout of an entry, keeping only its hash"""
+        shutil.rmtree(self.path(key), ignore_errors=True)
+        if key not in self.index:
+            return
+        if self.index[key]["sha256"] is None:
+            del self.index[key]
+        else:
+            self.index[key]["size"] = 0
+
+    def evict(self, max_size=None, keys=None):
+        """Prune checkouts of `keys`, then least recently used ones until the
+        total size is at most `max_size` bytes"""
+        with self.lock:
+            for key in keys or []:
+                self.prune_tree(key)
+            total = sum(entry["size"] for entry in self.index.values())
+            if max_size is not None:
+                lru = sorted(self.index, key=lambda k: self.index[k]["last_used"])
+                for key in lru:
+                    if total <= max_size:
+                        break
+                    total -= self.index[key]["size"]
+                    self.prune_tree(key)
+            self.save()
+
+    def print_stats(self):
+        entries = self.index.values()
+        deps = [entry for entry in entries if entry["sha256"] is not None]
+        with_trees = [entry for entry in deps if entry["size"] > 0]
+        print("Cache directory: %s" % self.basedir)
+        print("Entries: %d (%d with checkouts)" % (len(deps), len(with_trees)))
+        print("Version work trees: %d" % (len(entries) - len(deps)))
+        print("Checkout size: %.1f GiB" % (sum(e["size"] for e in entries) / 2**30))
+        if entries:
+            oldest = min(entry["last_used"] for entry in entries)
+            print(
+                "Least recently used: %s"
+                % time.strftime("%Y-%m-%d", time.gmtime(oldest))
+            )
+
+
+def parse_size(size):
+    """Parse a size such as 500M or 100G into bytes"""
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+
 def checkout_git(url, rev, path, fetch_submodules=True):
     subprocess.check_call(
         ["nix-prefetch-git", "--builder", "--url", url, "--out", path, "--rev", rev]
@@ -50,46 +237,469 @@ def checkout_cipd(package, version, path):
     return hash_path(path)
 
 
-def nix_str_git(path, dep):
+def fetch_git_dep(cache, path, url, rev, need_tree=False, base=None):
+    fetch_submodules = path not in NO_SUBMODULES
+    memoized_path = cache.path(rev)
+    base_key = ("git", url, rev, fetch_submodules)
+    with cache.key_lock(rev):
+        if not need_tree and base is not None and base_key in base:
+            sha256 = base[base_key]
+        else:
+            sha256 = cache.get(rev, need_tree=need_tree)
+        if sha256 is None:
+            shutil.rmtree(memoized_path, ignore_errors=True)
+            sha256 = checkout_git(
+                url, rev, memoized_path, fetch_submodules=fetch_submodules
+            )
+            cache.put(rev, sha256)
+
+    return {
+        "url": url,
+        "rev": rev,
+        "sha256": sha256,
+        "dep_type": "git",
+        "fetch_submodules": fetch_submodules,
+    }
+
+
+def cipd_key(package, version):
+    # TODO: Better path normalization
+    return (package + "_" + version).replace("/", "_").replace(":", "")
+
+
+def fetch_cipd_dep(cache, path, packages, base=None):
+    fetched_packages = []
+    for p in packages:
+        package, version = p["package"], p["version"]
+        dirname = cipd_key(package, version)
+        memoized_path = cache.path(dirname)
+
+        with cache.key_lock(dirname):
+            sha256 = (base or {}).get(("cipd", package, version))
+            if sha256 is None:
+                sha256 = cache.get(dirname)
+            if sha256 is None:
+                shutil.rmtree(memoized_path, ignore_errors=True)
+                sha256 = checkout_cipd(package, version, memoized_path)
+                cache.put(dirname, sha256)
+
+        fetched_packages.append(
+            {
+                "package": package,
+                "version": version,
+                "sha256": sha256,
+            }
+        )
+
+    return {
+        "packages": fetched_packages,
+        "dep_type": "cipd",
+    }
+
+
+def fetch_dep(cache, path, fields, need_tree=False, base=None):
+    """Fetch a dep from the flattened DEPS and get its hash.
+
+    Hashes found in `base` (see base_hashes) are used without fetching,
+    unless the checkout itself is needed.
+    """
+    if fields["dep_type"] == "git":
+        url, rev = fields["url"].split("@")
+        return fetch_git_dep(cache, path, url, rev, need_tree=need_tree, base=base)
+    elif fields["dep_type"] == "cipd":
+        return fetch_cipd_dep(cache, path, fields["packages"], base=base)
+    else:
+        raise ValueError("Unrecognized dep_type", fields["dep_type"])
+
+
+def gitiles_file(url, rev, filename):
+    """Get the contents of a file from a gitiles server, or None if missing"""
+    if url.endswith(".git"):
+        url = url[: -len(".git")]
+    try:
+        with urllib.request.urlopen(
+            "%s/+/%s/%s?format=TEXT" % (url, rev, filename)
+        ) as response:
+            return base64.b64decode(response.read()).decode()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+
+def fetch_dep_and_deps_file(cache, path, fields, deps_file, base=None):
+    """Fetch a dep, and the contents of its DEPS file named `deps_file`.
+
+    If the hash of a dep on a gitiles server is already known from `base`,
+    only the DEPS file itself is downloaded.
+    """
+    if deps_file is None:
+        return fetch_dep(cache, path, fields, base=base), None
+
+    url, rev = fields["url"].split("@")
+    base_key = ("git", url, rev, path not in NO_SUBMODULES)
+    if base is not None and base_key in base and ".googlesource.com/" in url:
+        dep = fetch_dep(cache, path, fields, base=base)
+        return dep, gitiles_file(url, rev, deps_file)
+
+    dep = fetch_dep(cache, path, fields, need_tree=True)
+    deps_filename = os.path.join(cache.path(rev), deps_file)
+    if not os.path.exists(deps_filename):
+        return dep, None
+    return dep, open(deps_filename).read()
+
+
+def parse_vendor_nix(filename):
+    """Parse the git and CIPD deps of a vendor-<version>.nix file.
+
+    Returns the deps, in the form used by make_vendor_file, along with the
+    hashes of all other fetchurl calls, by URL.
+    """
+    content = open(filename).read()
+    attr_re = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|(true|false))\s*;')
+
+    def attrs(text):
+        return dict(
+            (name, boolean == "true" if boolean else string)
+            for name, string, boolean in attr_re.findall(text)
+        )
+
+    deps = {}
+    url_hashes = {}
+    entries = list(re.finditer(r'^\s*"([^"]+)"\s*=', content, re.M))
+    for entry, next_entry in zip(entries, entries[1:] + [None]):
+        start = entry.end()
+        end = len(content) if next_entry is None else next_entry.start()
+        text = content[start:end]
+        path = entry.group(1)
+        if text.lstrip().startswith("fetchgit"):
+            fields = attrs(text)
+            deps[path] = {
+                "url": fields["url"],
+                "rev": fields["rev"],
+                "sha256": fields["sha256"],
+                "dep_type": "git",
+                "fetch_submodules": fields.get("fetchSubmodules", False),
+            }
+        elif "fetchcipd" in text:
+            # Package names may contain ${platform}
+            packages = [
+                attrs(match)
+                for match in re.findall(r"fetchcipd\s*\{(.*?)\}\s*[);]", text, re.S)
+            ]
+            deps[path] = {"packages": packages, "dep_type": "cipd"}
+        elif "fetchurl" in text:
+            fields = attrs(text)
+            if "sha256" in fields:
+                url_hashes[fields["url"]] = fields["sha256"]
+    return deps, url_hashes
+
+
+def load_vendor_file(filename):
+    """Load the deps of a vendor file, from its JSON lock if there is one.
+
+    Returns the git and CIPD deps, along with the sha256 hashes of all other
+    downloaded URLs.
+    """
+    json_filename = re.sub(r"\.nix$", ".json", filename)
+    if not os.path.exists(json_filename):
+        return parse_vendor_nix(filename)
+
+    deps = {}
+    url_hashes = {}
+    for path, dep in json.load(open(json_filename))["deps"].items():
+        if dep["dep_type"] in ["git", "cipd"]:
+            deps[path] = dep
+        elif "sha256" in dep:
+            url_hashes[dep["url"]] = dep["sha256"]
+    return deps, url_hashes
+
+
+def base_hashes(deps, url_hashes):
+    """Index the hashes of base deps by what determines their contents"""
+    base = {}
+    for dep in deps.values():
+        if dep["dep_type"] == "git":
+            key = ("git", dep["url"], dep["rev"], dep["fetch_submodules"])
+            base[key] = dep["sha256"]
+        else:
+            for p in dep["packages"]:
+                base[("cipd", p["package"], p["version"])] = p["sha256"]
+    for url, sha256 in url_hashes.items():
+        base[("url", url)] = sha256
+    return base
+
+
+def dep_source(dep):
+    if dep["dep_type"] == "git":
+        return "%s@%s" % (dep["url"], dep["rev"])
+    return ", ".join("%s@%s" % (p["package"], p["version"]) for p in dep["packages"])
+
+
+def print_changes(base_deps, deps):
+    changes = {"unchanged": [], "changed": [], "added": [], "removed": []}
+    for path in sorted(set(base_deps) | set(deps)):
+        if path not in deps:
+            changes["removed"].append(path)
+        elif path not in base_deps:
+            changes["added"].append(path)
+        elif dep_source(deps[path]) == dep_source(base_deps[path]):
+            changes["unchanged"].append(path)
+        else:
+            changes["changed"].append(path)
+
+    print(
+        "Changes relative to base: "
+        + ", ".join("%d %s" % (len(paths), kind) for kind, paths in changes.items())
+    )
+    for path in changes["changed"]:
+        print("  changed: %s" % path)
+        print("    %s" % dep_source(base_deps[path]))
+        print("    %s" % dep_source(deps[path]))
+    for kind in ["added", "removed"]:
+        for path in changes[kind]:
+            print("  %s: %s" % (kind, path))
+
+
+def prefetch_url(url, base=None):
+    if base is not None and ("url", url) in base:
+        return base[("url", url)]
     return (
-        """  %(path)-90s = fetchgit { url = %(url)-128s; rev = "%(rev)s"; sha256 = "%(sha256)s"; fetchSubmodules = %(fetchSubmodules)s; };\n"""
-        % {
-            "path": '"' + path + '"',
-            "url": '"' + dep["url"] + '"',
-            "rev": dep["rev"],
-            "sha256": dep["sha256"],
-            "fetchSubmodules": "true" if dep["fetch_submodules"] else "false",
+        subprocess.check_output(["nix-prefetch-url", "--type", "sha256", url])
+        .decode()
+        .strip()
+    )
+
+
+def resolve_deps_flatten(cache, gclient_eval, topdir, builtin_vars, pool):
+    """Resolve deps by running `gclient flatten` until no new DEPS files appear.
+
+    Every pass links the new deps into topdir, so that the next pass sees
+    the DEPS files nested inside them.
+    """
+    deps = {}
+    need_another_iteration = True
+    while need_another_iteration:
+        need_another_iteration = False
+        new_deps = {}
+
+        subprocess.check_call(
+            [
+                "python3",
+                "depot_tools/gclient.py",
+                "config",
+                "https://chromium.googlesource.com/chromium/src.git",
+            ],
+            cwd=topdir,
+        )
+        flat = subprocess.check_output(
+            ["python3", "depot_tools/gclient.py", "flatten", "--pin-all-deps"],
+            cwd=topdir,
+        ).decode()
+
+        content = gclient_eval.Parse(
+            flat, filename="DEPS", vars_override={}, builtin_vars=builtin_vars
+        )
+
+        merged_vars = dict(content["vars"])
+        merged_vars.update(builtin_vars)
+
+        for path, fields in content["deps"].items():
+            # Skip these
+            if path in SKIP_DEPS:
+                continue
+
+            # Skip dependency if its condition evaluates to False
+            if "condition" in fields and not gclient_eval.EvaluateCondition(
+                fields["condition"], merged_vars
+            ):
+                continue
+
+            if path not in deps and path not in new_deps:
+                new_deps[path] = fields
+
+        # Fetch and hash new deps concurrently, but link them into topdir in
+        # sorted order, so that parent directories are replaced before the
+        # deps nested inside them are linked
+        futures = {
+            path: pool.submit(fetch_dep, cache, path, fields, need_tree=True)
+            for path, fields in new_deps.items()
         }
+        for path in sorted(futures):
+            deps[path] = futures[path].result()
+
+        for path in sorted(new_deps):
+            dep = deps[path]
+            if dep["dep_type"] != "git":
+                continue
+
+            memoized_path = cache.path(dep["rev"])
+            wholepath = os.path.join(topdir, path)
+            if path != "src":
+                shutil.rmtree(wholepath, ignore_errors=True)
+                if not os.path.isdir(os.path.dirname(wholepath)):
+                    os.makedirs(os.path.dirname(wholepath))
+                # shutil.copytree(memoized_path, wholepath, copy_function=os.link) # copy_function isn't available in python 2
+                subprocess.check_call(["cp", "-al", memoized_path, wholepath])
+
+            if os.path.exists(os.path.join(memoized_path, "DEPS")):  # Need to recurse
+                need_another_iteration = True
+
+    return deps
+
+
+def remote_head(url):
+    """Get the rev of HEAD of a git remote, for deps without a pinned rev"""
+    output = subprocess.check_output(["git", "ls-remote", url, "HEAD"]).decode()
+    return output.split()[0]
+
+
+def merge_vars(gclient_eval, result, new_vars):
+    """Like merge_vars() in gclient.py, add `new_vars` to `result`, overriding
+    its values. Vars declared with Str() in `result` remain ConstantStrings"""
+    for k, v in new_vars.items():
+        if (
+            k in result
+            and isinstance(result[k], gclient_eval.ConstantString)
+            and not isinstance(v, gclient_eval.ConstantString)
+        ):
+            result[k].value = v
+        else:
+            result[k] = v
+
+
+def resolve_deps_worklist(cache, gclient_eval, topdir, builtin_vars, pool, base=None):
+    """Resolve deps by evaluating each DEPS file once, as gclient itself does.
+
+    Starting from src/DEPS, the DEPS file of a dep is read from its memoized
+    checkout as soon as it has been fetched, if its parent lists it in
+    `recursedeps`. Fetching continues concurrently in the meantime.
+    """
+    src_dir = os.path.join(topdir, "src")
+    src_url = "https://chromium.googlesource.com/chromium/src.git"
+    src_rev = (
+        subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=src_dir)
+        .decode()
+        .strip()
     )
 
+    deps = {}
+    pending = {}  # future -> (path, deps_file to recurse into, vars)
+    seen = set(["src"])
 
-def nix_str_cipd(path, dep):
-    def _fetchcipd_str(p):
-        return (
-            'fetchcipd { package = "%(package)s"; version = "%(version)s"; sha256 = "%(sha256)s"; }'
-            % p
+    def visit(deps_content, deps_filename, parent_path, parent_url, vars_override):
+        content = gclient_eval.Parse(
+            deps_content,
+            filename=deps_filename,
+            vars_override=vars_override,
+            builtin_vars=builtin_vars,
         )
 
-    if len(dep["packages"]) == 1:
-        src_str = _fetchcipd_str(dep["packages"][0])
-    else:
-        nix_paths = "    \n".join(
-            ["(%s)" % (_fetchcipd_str(p),) for p in dep["packages"]]
+        # Like Dependency.get_vars() in gclient.py, the vars of the parents
+        # are added to those of this DEPS file, taking precedence
+        merged_vars = dict(content.get("vars", {}))
+        merge_vars(gclient_eval, merged_vars, vars_override)
+        merged_vars.update(builtin_vars)
+
+        def dep_path(name):
+            if content.get("use_relative_paths", False):
+                return os.path.join(parent_path, name)
+            return name
+
+        recursedeps = {}
+        for entry in content.get("recursedeps", []):
+            if isinstance(entry, str):
+                recursedeps[dep_path(entry)] = "DEPS"
+            else:
+                recursedeps[dep_path(entry[0])] = entry[1]
+
+        for name, fields in content.get("deps", {}).items():
+            path = dep_path(name)
+            if path in SKIP_DEPS or path in seen:
+                continue
+            if "condition" in fields and not gclient_eval.EvaluateCondition(
+                fields["condition"], merged_vars
+            ):
+                continue
+            seen.add(path)
+
+            fields = dict(fields)
+            if fields["dep_type"] == "git":
+                url = fields["url"]
+                if url.startswith("/"):  # Relative to the URL of the parent
+                    url = parent_url[: parent_url.rfind("/")] + url
+                if "@" not in url:
+                    url += "@" + remote_head(url)
+                fields["url"] = url
+
+            deps_file = recursedeps.get(path) if fields["dep_type"] == "git" else None
+            future = pool.submit(
+                fetch_dep_and_deps_file, cache, path, fields, deps_file, base
+            )
+            pending[future] = (path, deps_file, merged_vars)
+
+    src_fields = {"dep_type": "git", "url": src_url + "@" + src_rev}
+    future = pool.submit(fetch_dep_and_deps_file, cache, "src", src_fields, None, base)
+    pending[future] = ("src", None, {})
+    deps_filename = os.path.join(src_dir, "DEPS")
+    visit(open(deps_filename).read(), deps_filename, "src", src_url, {})
+
+    while pending:
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
         )
-        src_str = (
-            """
-            symlinkJoin { name = "cipd-joined"; paths = [
-            %s
-            ]; }
-        """
-            % nix_paths
+        for future in done:
+            path, deps_file, merged_vars = pending.pop(future)
+            dep, deps_content = future.result()
+            deps[path] = dep
+            if deps_content is not None:
+                deps_filename = os.path.join(path, deps_file)
+                visit(deps_content, deps_filename, path, dep["url"], merged_vars)
+
+    return deps
+
+
+def write_vendor_files(chromium_version, target_os, deps):
+    """Write vendor-<version>.json with the hashes of `deps`, and the
+    vendor-<version>.nix file which loads it through vendor-lock.nix"""
+    with open("vendor-%s.json" % chromium_version, "w") as vendor_json:
+        json.dump(
+            {"version": chromium_version, "target_os": target_os, "deps": deps},
+            vendor_json,
+            sort_keys=True,
+            indent=2,
+            separators=(",", ": "),
         )
+        vendor_json.write("\n")
 
-    return "  %-90s = %s;\n" % ('"' + path + '"', src_str)
+    with open("vendor-%s.nix" % chromium_version, "w") as vendor_nix:
+        vendor_nix.write(
+            "# GENERATED BY 'mk-vendor-file.py %s' for %s\n"
+            % (chromium_version, ", ".join(target_os))
+        )
+        vendor_nix.write(
+            "import ./vendor-lock.nix (builtins.fromJSON (builtins.readFile ./vendor-%s.json))\n"
+            % chromium_version
+        )
 
 
-def make_vendor_file(chromium_version, target_os):
-    topdir = os.path.join(BASEDIR, chromium_version)
+def make_vendor_file(
+    chromium_version,
+    target_os,
+    cache,
+    jobs=1,
+    flatten=False,
+    prune_trees=False,
+    max_cache_size=None,
+    base_filename=None,
+):
+    base_deps = None
+    base = None
+    if base_filename is not None:
+        base_deps, url_hashes = load_vendor_file(base_filename)
+        base = base_hashes(base_deps, url_hashes)
+
+    topdir = cache.path(chromium_version)
     if not os.path.isdir(topdir):
         os.makedirs(topdir)
 
@@ -189,235 +799,166 @@ def make_vendor_file(chromium_version, target_os):
         )
         subprocess.check_call(["git", "checkout", "-f", "HEAD"], cwd=src_dir)
 
-    deps = {}
-    need_another_iteration = True
-    while need_another_iteration:
-        need_another_iteration = False
-
-        subprocess.check_call(
-            [
-                "python3",
-                "depot_tools/gclient.py",
-                "config",
-                "https://chromium.googlesource.com/chromium/src.git",
-            ],
-            cwd=topdir,
-        )
-        flat = subprocess.check_output(
-            ["python3", "depot_tools/gclient.py", "flatten", "--pin-all-deps"],
-            cwd=topdir,
-        ).decode()
-
-        content = gclient_eval.Parse(
-            flat, filename="DEPS", vars_override={}, builtin_vars=builtin_vars
-        )
-
-        merged_vars = dict(content["vars"])
-        merged_vars.update(builtin_vars)
+    pool = concurrent.futures.ThreadPoolExecutor(jobs)
+    try:
+        if flatten:
+            deps = resolve_deps_flatten(cache, gclient_eval, topdir, builtin_vars, pool)
+        else:
+            deps = resolve_deps_worklist(
+                cache, gclient_eval, topdir, builtin_vars, pool, base=base
+            )
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    if base_deps is not None:
+        print_changes(base_deps, deps)
+
+    # Some additional non-git/cipd sources
+    for path, name in [
+        ("src/third_party/node/node_modules.tar.gz", "chromium-nodejs"),
+        ("src/third_party/test_fonts/test_fonts.tar.gz", "chromium-fonts"),
+        (
+            "src/third_party/subresource-filter-ruleset/data/UnindexedRules",
+            "chromium-ads-detection",
+        ),
+    ]:
+        sha1 = open(os.path.join(topdir, path + ".sha1")).read().strip()
+        url = "https://commondatastorage.googleapis.com/%s/%s" % (name, sha1)
+        if path.endswith(".tar.gz"):
+            path = path[: -len(".tar.gz")]
+            deps[path] = {
+                "dep_type": "tarball",
+                "name": "download_from_google_storage-" + name,
+                "url": url,
+                "sha1": sha1,
+                "strip_components": 1,
+            }
+        else:
+            deps[path] = {"dep_type": "url", "url": url, "sha1": sha1}
 
-        for path, fields in content["deps"].items():
-            # Skip these
-            if path in SKIP_DEPS:
-                continue
+    # condition: checkout_android or checkout_linux
+    # TODO: Memoize
+    gs_url = (
+        open(os.path.join(topdir, "src/chrome/android/profiles/newest.txt"))
+        .read()
+        .strip()
+    )
+    GS_HTTP_URL = "https://storage.googleapis.com/"
+    gz_prefix = "gs://"
+    if gs_url.startswith(gz_prefix):
+        url = GS_HTTP_URL + gs_url[len(gz_prefix) :]
+    else:
+        url = GS_HTTP_URL + "chromeos-prebuilt/afdo-job/llvm/" + gs_url
+    deps["src/chrome/android/profiles/afdo.prof"] = {
+        "dep_type": "bzip2",
+        "name": "download_afdo_profile",
+        "url": url,
+        "sha256": prefetch_url(url, base),
+    }
 
-            # Skip dependency if its condition evaluates to False
-            if "condition" in fields and not gclient_eval.EvaluateCondition(
-                fields["condition"], merged_vars
-            ):
-                continue
+    local_scope = {}
+    global_scope = {"__file__": "update.py"}
+    exec(
+        open(os.path.join(topdir, "src/tools/clang/scripts/update.py")).read(),
+        local_scope,
+        global_scope,
+    )  # TODO: Safety?
+    url = "%s/Linux_x64/clang-%s.tgz" % (
+        global_scope["CDS_URL"],
+        global_scope["PACKAGE_VERSION"],
+    )
+    deps["src/third_party/llvm-build/Release+Asserts"] = {
+        "dep_type": "tarball",
+        "name": "download_upstream_clang",
+        "url": url,
+        "sha256": prefetch_url(url, base),
+        "strip_components": 0,
+    }
 
-            if path not in deps:
-                if fields["dep_type"] == "git":
-                    url, rev = fields["url"].split("@")
-                    wholepath = os.path.join(topdir, path)
-                    memoized_path = os.path.join(BASEDIR, rev)
-
-                    if os.path.exists(memoized_path + ".sha256"):  # memoize hash
-                        sha256 = open(memoized_path + ".sha256").read()
-                    else:
-                        shutil.rmtree(memoized_path, ignore_errors=True)
-                        sha256 = checkout_git(
-                            url,
-                            rev,
-                            memoized_path,
-                            fetch_submodules=(path not in NO_SUBMODULES),
-                        )
-                        open(memoized_path + ".sha256", "w").write(sha256)
-
-                    if path != "src":
-                        shutil.rmtree(wholepath, ignore_errors=True)
-                        if not os.path.isdir(os.path.dirname(wholepath)):
-                            os.makedirs(os.path.dirname(wholepath))
-                        # shutil.copytree(memoized_path, wholepath, copy_function=os.link) # copy_function isn't available in python 2
-                        subprocess.check_call(["cp", "-al", memoized_path, wholepath])
-
-                    if os.path.exists(
-                        os.path.join(memoized_path, "DEPS")
-                    ):  # Need to recurse
-                        need_another_iteration = True
-
-                    deps[path] = {
-                        "url": url,
-                        "rev": rev,
-                        "sha256": sha256,
-                        "dep_type": "git",
-                        "fetch_submodules": path not in NO_SUBMODULES,
-                    }
-
-                elif fields["dep_type"] == "cipd":
-                    packages = []
-                    for p in fields["packages"]:
-                        package, version = p["package"], p["version"]
-                        dirname = (
-                            (package + "_" + version).replace("/", "_").replace(":", "")
-                        )  # TODO: Better path normalization
-                        memoized_path = os.path.join(BASEDIR, dirname)
-
-                        if os.path.exists(memoized_path + ".sha256"):  # memoize hash
-                            sha256 = open(memoized_path + ".sha256").read()
-                        else:
-                            shutil.rmtree(memoized_path, ignore_errors=True)
-                            sha256 = checkout_cipd(package, version, memoized_path)
-                            open(memoized_path + ".sha256", "w").write(sha256)
-
-                        packages.append(
-                            {
-                                "package": package,
-                                "version": version,
-                                "sha256": sha256,
-                            }
-                        )
-
-                    deps[path] = {
-                        "packages": packages,
-                        "dep_type": "cipd",
-                    }
-
-                else:
-                    raise ValueError("Unrecognized dep_type", fields["dep_type"])
+    write_vendor_files(chromium_version, target_os, deps)
 
-    with open("vendor-%s.nix" % chromium_version, "w") as vendor_nix:
-        vendor_nix.write(
-            "# GENERATED BY 'mk-vendor-file.py %s' for %s\n"
-            % (chromium_version, ", ".join(target_os))
-        )
-        vendor_nix.write(
-            "{fetchgit, fetchcipd, fetchurl, runCommand, symlinkJoin, platform}:\n"
-        )
-        vendor_nix.write("{\n")
-        for path, dep in sorted(deps.items()):
-            if dep["dep_type"] == "git":
-                vendor_nix.write(nix_str_git(path, dep))
-            if dep["dep_type"] == "cipd":
-                vendor_nix.write(nix_str_cipd(path, dep))
-
-        # Some additional non-git/cipd sources
-        for path, name in [
-            ("src/third_party/node/node_modules.tar.gz", "chromium-nodejs"),
-            ("src/third_party/test_fonts/test_fonts.tar.gz", "chromium-fonts"),
-            (
-                "src/third_party/subresource-filter-ruleset/data/UnindexedRules",
-                "chromium-ads-detection",
-            ),
-        ]:
-            sha1 = open(os.path.join(topdir, path + ".sha1")).read().strip()
-            if path.endswith(".tar.gz"):
-                path = path[: -len(".tar.gz")]
-                vendor_nix.write(
-                    """
-"%(path)s" = runCommand "download_from_google_storage-%(name)s" {} ''
-    mkdir $out
-    tar xf ${fetchurl {
-                url  = "https://commondatastorage.googleapis.com/%(name)s/%(sha1)s";
-                sha1 = "%(sha1)s";
-            }} --strip-components=1 -C $out
-'';
-"""
-                    % {"path": path, "name": name, "sha1": sha1}
-                )
-            else:
-                vendor_nix.write(
-                    """
-"%(path)s" = fetchurl {
-                url  = "https://commondatastorage.googleapis.com/%(name)s/%(sha1)s";
-                sha1 = "%(sha1)s";
-            };
-"""
-                    % {"path": path, "name": name, "sha1": sha1}
-                )
-
-        # condition: checkout_android or checkout_linux
-        # TODO: Memoize
-        gs_url = (
-            open(os.path.join(topdir, "src/chrome/android/profiles/newest.txt"))
-            .read()
-            .strip()
-        )
-        GS_HTTP_URL = "https://storage.googleapis.com/"
-        gz_prefix = "gs://"
-        if gs_url.startswith(gz_prefix):
-            url = GS_HTTP_URL + gs_url[len(gz_prefix) :]
+    # The version work tree is only needed until the vendor file is written
+    cache.put_tree(chromium_version)
+    used_keys = [chromium_version]
+    for dep in deps.values():
+        if dep["dep_type"] == "git":
+            used_keys.append(dep["rev"])
         else:
-            url = GS_HTTP_URL + "chromeos-prebuilt/afdo-job/llvm/" + gs_url
-        sha256 = (
-            subprocess.check_output(["nix-prefetch-url", "--type", "sha256", url])
-            .decode()
-            .strip()
-        )
-        path = "src/chrome/android/profiles/afdo.prof"
-        vendor_nix.write(
-            """
-"%(path)s" = runCommand "download_afdo_profile" {} ''
-    bzip2 -d -c ${fetchurl {
-                url  = "%(url)s";
-                sha256 = "%(sha256)s";
-            }} > $out
-'';
-"""
-            % {"path": path, "url": url, "sha256": sha256}
-        )
-
-        local_scope = {}
-        global_scope = {"__file__": "update.py"}
-        exec(
-            open(os.path.join(topdir, "src/tools/clang/scripts/update.py")).read(),
-            local_scope,
-            global_scope,
-        )  # TODO: Safety?
-        url = "%s/Linux_x64/clang-%s.tgz" % (
-            global_scope["CDS_URL"],
-            global_scope["PACKAGE_VERSION"],
-        )
-        sha256 = (
-            subprocess.check_output(["nix-prefetch-url", "--type", "sha256", url])
-            .decode()
-            .strip()
-        )
-        path = "src/third_party/llvm-build/Release+Asserts"
-        vendor_nix.write(
-            """
-"%(path)s" = runCommand "download_upstream_clang" {} ''
-    mkdir $out
-    tar xf ${fetchurl {
-                url  = "%(url)s";
-                sha256 = "%(sha256)s";
-            }} -C $out
-'';
-"""
-            % {"path": path, "url": url, "sha256": sha256}
-        )
-
-        vendor_nix.write("}\n")
+            used_keys += [cipd_key(p["package"], p["version"]) for p in dep["packages"]]
+    cache.evict(max_cache_size, used_keys if prune_trees else None)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--target-os", type=str, default=["unix"], action="append")
-    parser.add_argument("version", nargs="+")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of deps to fetch and hash concurrently",
+    )
+    parser.add_argument(
+        "--flatten",
+        action="store_true",
+        help="resolve deps by running 'gclient flatten' repeatedly until no new "
+        + "DEPS files appear, instead of evaluating each DEPS file once",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("ROBOTNIX_CHROMIUM_CACHE", BASEDIR),
+        help="directory to keep checkouts of deps and their hashes in",
+    )
+    parser.add_argument(
+        "--max-cache-size",
+        type=parse_size,
+        help="after a run, delete the least recently used checkouts until the "
+        + "cache is at most this size (e.g. 100G). Their hashes are kept",
+    )
+    parser.add_argument(
+        "--prune-trees",
+        action="store_true",
+        help="after a run, delete the checkouts of the deps it used, keeping only "
+        + "their hashes",
+    )
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="print statistics about the cache and exit",
+    )
+    parser.add_argument(
+        "--base",
+        help="an existing vendor-<version>.nix or .json to reuse the hashes of "
+        + "unchanged deps from, without fetching them",
+    )
+    parser.add_argument(
+        "--verify-hashes",
+        action="store_true",
+        help="check every hash computed in-process against 'nix hash-path'",
+    )
+    parser.add_argument("version", nargs="*")
     args = parser.parse_args()
 
+    global VERIFY_HASHES
+    VERIFY_HASHES = args.verify_hashes
+
+    cache = DepCache(args.cache_dir)
+    if args.cache_stats:
+        cache.print_stats()
+        return
+    if not args.version:
+        parser.error("at least one version is required")
+
     for chromium_version in args.version:
-        make_vendor_file(chromium_version, args.target_os)
+        make_vendor_file(
+            chromium_version,
+            args.target_os,
+            cache,
+            jobs=args.jobs,
+            flatten=args.flatten,
+            prune_trees=args.prune_trees,
+            max_cache_size=args.max_cache_size,
+            base_filename=args.base,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,452 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import concurrent.futures
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+_spec = importlib.util.spec_from_file_location(
+    "mk_vendor_file", os.path.join(HERE, "mk-vendor-file.py")
+)
+assert _spec is not None and _spec.loader is not None
+mk_vendor_file = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mk_vendor_file)
+
+SRC_URL = "https://chromium.googlesource.com/chromium/src.git"
+
+
+class ConstantString:
+    """Like gclient_eval.ConstantString, a var declared with Str()"""
+
+    def __init__(self, value: str) -> None:
+        self.value = value
+
+
+class FakeGclientEval:
+    """Stands in for gclient_eval from depot_tools, for DEPS files without Var()"""
+
+    ConstantString = ConstantString
+
+    @staticmethod
+    def Parse(
+        content: str,
+        filename: str,
+        vars_override: Optional[Dict[str, Any]] = None,
+        builtin_vars: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        local_scope: Dict[str, Any] = {}
+        exec(content, {"Str": ConstantString}, local_scope)
+        return local_scope
+
+    @staticmethod
+    def EvaluateCondition(condition: str, variables: Dict[str, Any]) -> bool:
+        values = {
+            k: v.value if isinstance(v, ConstantString) else v
+            for k, v in variables.items()
+        }
+        return bool(eval(condition, {"__builtins__": {}}, values))
+
+
+def git_repo(path: str, files: Dict[str, str]) -> str:
+    """Commit `files` to a new git repo at `path`, returning its rev"""
+    os.makedirs(path)
+    for name, content in files.items():
+        with open(os.path.join(path, name), "w") as f:
+            f.write(content)
+    subprocess.check_call(["git", "init", "--quiet"], cwd=path)
+    subprocess.check_call(["git", "add", "."], cwd=path)
+    subprocess.check_call(
+        ["git", "-c", "user.name=testenv", "-c", "user.email=testenv@example.com"]
+        + ["commit", "--quiet", "-m", "Initial Commit"],
+        cwd=path,
+    )
+    return (
+        subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path).decode().strip()
+    )
+
+
+@pytest.fixture
+def repos(monkeypatch: Any) -> Dict[str, str]:
+    """Local repos by URL, which are checked out instead of fetching the URL"""
+    repos: Dict[str, str] = {}
+
+    def checkout_git(
+        url: str, rev: str, path: str, fetch_submodules: bool = True
+    ) -> str:
+        subprocess.check_call(["git", "clone", "--quiet", repos[url], path])
+        subprocess.check_call(["git", "checkout", "--quiet", rev], cwd=path)
+        shutil.rmtree(os.path.join(path, ".git"))
+        return str(mk_vendor_file.hash_path(path))
+
+    monkeypatch.setattr(mk_vendor_file, "checkout_git", checkout_git)
+    return repos
+
+
+# Run in place of depot_tools/gclient.py by resolve_deps_flatten
+FAKE_GCLIENT = """
+import sys
+
+if sys.argv[1] == "flatten":
+    print(open("flat.DEPS").read())
+"""
+
+
+def make_deps_tree(tmpdir: Any, repos: Dict[str, str]) -> Tuple[str, Dict[str, str]]:
+    """Make a Chromium work tree whose src/DEPS recurses into one of its deps
+
+    Conditions of the nested deps use vars of src/DEPS. The work tree also
+    holds what `gclient flatten` prints for it, along with a stand-in for
+    gclient.py printing it.
+
+    Returns the path of the work tree and the revs of the repos, by name.
+    """
+    top = str(tmpdir)
+    revs = {}
+
+    def add_repo(name: str, files: Dict[str, str]) -> None:
+        url = f"https://example.com/{name}.git"
+        repos[url] = os.path.join(top, "remote", name)
+        revs[name] = git_repo(repos[url], files)
+
+    for name in ["b", "c", "d", "e", "ios_only", "luci-go"]:
+        add_repo(name, {"README": name})
+    a_conditions = {
+        "b": "checkout_android",
+        "c": "checkout_extra",
+        "d": "shared == 'src'",
+        "e": "checkout_skipped",
+    }
+    a_deps = {
+        name: {"url": f"/{name}.git@{revs[name]}", "dep_type": "git", "condition": c}
+        for name, c in a_conditions.items()
+    }
+    add_repo(
+        "a",
+        {
+            "DEPS": "use_relative_paths = True\n"
+            "vars = {'shared': Str('a')}\n"
+            "deps = %r\n" % a_deps
+        },
+    )
+
+    src_deps = {
+        path: {"url": f"https://example.com/{name}.git@{revs[name]}", "dep_type": "git"}
+        for path, name in [
+            ("src/third_party/a", "a"),
+            ("src/third_party/ios_only", "ios_only"),
+            ("src/tools/luci-go", "luci-go"),
+        ]
+    }
+    src_deps["src/third_party/ios_only"]["condition"] = "checkout_ios"
+    src_vars = {"checkout_extra": True, "checkout_skipped": False, "shared": "src"}
+    topdir = os.path.join(top, "work")
+    repos[SRC_URL] = os.path.join(topdir, "src")
+    revs["src"] = git_repo(
+        repos[SRC_URL],
+        {
+            "DEPS": "vars = %r\ndeps = %r\nrecursedeps = ['src/third_party/a']\n"
+            % (src_vars, src_deps)
+        },
+    )
+
+    flat_deps = {"src": {"url": f"{SRC_URL}@{revs['src']}", "dep_type": "git"}}
+    flat_deps.update(src_deps)
+    for name, dep in a_deps.items():
+        url = f"https://example.com/{name}.git@{revs[name]}"
+        flat_deps["src/third_party/a/" + name] = {**dep, "url": url}
+    with open(os.path.join(topdir, "flat.DEPS"), "w") as f:
+        f.write("vars = %r\ndeps = %r\n" % (src_vars, flat_deps))
+    os.makedirs(os.path.join(topdir, "depot_tools"))
+    with open(os.path.join(topdir, "depot_tools", "gclient.py"), "w") as f:
+        f.write(FAKE_GCLIENT)
+    return topdir, revs
+
+
+BUILTIN_VARS = {"checkout_android": True, "checkout_ios": False}
+
+
+def test_merge_vars() -> None:
+    result = {"a": ConstantString("a"), "b": "b", "c": ConstantString("c")}
+    mk_vendor_file.merge_vars(
+        FakeGclientEval, result, {"a": "x", "b": "y", "c": ConstantString("z"), "d": 1}
+    )
+    assert isinstance(result["a"], ConstantString) and result["a"].value == "x"
+    assert result["b"] == "y"
+    assert isinstance(result["c"], ConstantString) and result["c"].value == "z"
+    assert result["d"] == 1
+
+
+def test_resolve_deps_worklist(tmpdir: Any, repos: Dict[str, str]) -> None:
+    topdir, revs = make_deps_tree(tmpdir, repos)
+    cache = mk_vendor_file.DepCache(str(tmpdir / "cache"))
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        deps = mk_vendor_file.resolve_deps_worklist(
+            cache, FakeGclientEval, topdir, BUILTIN_VARS, pool
+        )
+
+    assert sorted(deps) == [
+        "src",
+        "src/third_party/a",
+        "src/third_party/a/b",
+        "src/third_party/a/c",
+        "src/third_party/a/d",
+    ]
+    b = deps["src/third_party/a/b"]
+    assert b["url"] == "https://example.com/b.git"
+    assert b["rev"] == revs["b"]
+    assert deps["src"]["rev"] == revs["src"]
+    assert b["sha256"] == mk_vendor_file.hash_path(cache.path(b["rev"]))
+    assert cache.get(b["rev"]) == b["sha256"]
+
+    # Deps in a base file are not checked out, unless their DEPS file is needed
+    base = mk_vendor_file.base_hashes(deps, {})
+    cache = mk_vendor_file.DepCache(str(tmpdir / "cache2"))
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        base_deps = mk_vendor_file.resolve_deps_worklist(
+            cache, FakeGclientEval, topdir, BUILTIN_VARS, pool, base=base
+        )
+    assert base_deps == deps
+    assert os.path.isdir(cache.path(revs["a"]))
+    assert not os.path.exists(cache.path(revs["b"]))
+
+
+def test_resolve_deps_flatten(tmpdir: Any, repos: Dict[str, str]) -> None:
+    topdir, _ = make_deps_tree(tmpdir, repos)
+    cache = mk_vendor_file.DepCache(str(tmpdir / "cache"))
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        deps = mk_vendor_file.resolve_deps_worklist(
+            cache, FakeGclientEval, topdir, BUILTIN_VARS, pool
+        )
+        flat_deps = mk_vendor_file.resolve_deps_flatten(
+            cache, FakeGclientEval, topdir, BUILTIN_VARS, pool
+        )
+    assert deps == flat_deps
+
+
+VENDOR_100 = os.path.join(HERE, "vendor-100.0.4896.135.nix")
+
+
+def test_parse_vendor_nix() -> None:
+    deps, url_hashes = mk_vendor_file.parse_vendor_nix(VENDOR_100)
+    assert deps["src"] == {
+        "url": SRC_URL,
+        "rev": "1a90e060fd3231f69f387dd2ac33b4e3eeb0e3e3",
+        "sha256": "11nc6d2y29hpmxb619847n6kh4gciw6jl96d929j3jfcnnbvq9v1",
+        "dep_type": "git",
+        "fetch_submodules": True,
+    }
+    assert deps["src/buildtools/linux64"] == {
+        "packages": [
+            {
+                "package": "gn/gn/linux-amd64",
+                "version": "git_revision:0725d7827575b239594fbc8fd5192873a1d62f44",
+                "sha256": "1y8csayrd9653fwyzw07l29i1dmb5jvwzrygks3ayh1d1yqbq36p",
+            }
+        ],
+        "dep_type": "cipd",
+    }
+    sdk = deps["src/third_party/android_sdk/public"]["packages"]
+    assert len(sdk) > 1
+    assert (
+        sdk[0]["package"]
+        == "chromium/third_party/android_sdk/public/build-tools/31.0.0"
+    )
+
+    # Only downloads with a sha256 are of use as a base
+    assert len(url_hashes) == 2
+    assert (
+        url_hashes[
+            "https://commondatastorage.googleapis.com/chromium-browser-clang/"
+            "Linux_x64/clang-llvmorg-15-init-1995-g5bec1ea7-1.tgz"
+        ]
+        == "0pxx8jr958xi5szxl5hc7yq6gmppg1paw25v4myfnqb62gjzik62"
+    )
+
+    base = mk_vendor_file.base_hashes(deps, url_hashes)
+    src = deps["src"]
+    assert base["git", SRC_URL, src["rev"], True] == src["sha256"]
+    assert base["cipd", sdk[0]["package"], sdk[0]["version"]] == sdk[0]["sha256"]
+    assert len(base) == len(url_hashes) + sum(
+        len(dep["packages"]) if dep["dep_type"] == "cipd" else 1
+        for dep in deps.values()
+    )
+
+
+LOCKED_DEPS: Dict[str, Any] = {
+    "src": {
+        "url": SRC_URL,
+        "rev": "1" * 40,
+        "sha256": "0" * 52,
+        "dep_type": "git",
+        "fetch_submodules": True,
+    },
+    "src/buildtools/linux64": {
+        "packages": [
+            {
+                "package": "gn/gn/${platform}",
+                "version": "git_revision:2",
+                "sha256": "1" * 52,
+            },
+            {"package": "gn/other", "version": "3", "sha256": "2" * 52},
+        ],
+        "dep_type": "cipd",
+    },
+    "src/third_party/test_fonts/test_fonts": {
+        "dep_type": "tarball",
+        "name": "download_from_google_storage-chromium-fonts",
+        "url": "https://commondatastorage.googleapis.com/chromium-fonts/abc",
+        "sha1": "abc",
+        "strip_components": 1,
+    },
+    "src/chrome/android/profiles/afdo.prof": {
+        "dep_type": "bzip2",
+        "name": "download_afdo_profile",
+        "url": "https://storage.googleapis.com/afdo.prof.bz2",
+        "sha256": "3" * 52,
+    },
+}
+
+
+@pytest.fixture
+def vendor_dir(tmpdir: Any) -> Iterator[str]:
+    cwd = os.getcwd()
+    os.chdir(tmpdir)
+    shutil.copy(os.path.join(HERE, "vendor-lock.nix"), str(tmpdir))
+    mk_vendor_file.write_vendor_files("1.2.3.4", ["unix", "android"], LOCKED_DEPS)
+    yield str(tmpdir)
+    os.chdir(cwd)
+
+
+def test_load_vendor_file(vendor_dir: str) -> None:
+    lock = json.load(open(os.path.join(vendor_dir, "vendor-1.2.3.4.json")))
+    assert lock == {
+        "version": "1.2.3.4",
+        "target_os": ["unix", "android"],
+        "deps": LOCKED_DEPS,
+    }
+
+    deps, url_hashes = mk_vendor_file.load_vendor_file(
+        os.path.join(vendor_dir, "vendor-1.2.3.4.nix")
+    )
+    assert deps == {
+        path: dep
+        for path, dep in LOCKED_DEPS.items()
+        if dep["dep_type"] in ["git", "cipd"]
+    }
+    assert url_hashes == {"https://storage.googleapis.com/afdo.prof.bz2": "3" * 52}
+
+
+# Fetchers which return their arguments, to compare with the lock
+FAKE_FETCHERS = """
+import ./vendor-1.2.3.4.nix {
+  fetchgit = args: { fetcher = "fetchgit"; } // args;
+  fetchcipd = args: { fetcher = "fetchcipd"; } // args;
+  fetchurl = args: { fetcher = "fetchurl"; } // args;
+  runCommand = name: env: script: { fetcher = "runCommand"; inherit name; };
+  symlinkJoin = args: { fetcher = "symlinkJoin"; } // args;
+  platform = "linux-amd64";
+}
+"""
+
+
+@pytest.mark.skipif(
+    shutil.which("nix-instantiate") is None, reason="nix-instantiate is not available"
+)
+def test_vendor_lock_nix(vendor_dir: str) -> None:
+    output = subprocess.check_output(
+        ["nix-instantiate", "--eval", "--strict", "--json", "--expr", FAKE_FETCHERS],
+        cwd=vendor_dir,
+    )
+    assert json.loads(output) == {
+        "src": {
+            "fetcher": "fetchgit",
+            "url": SRC_URL,
+            "rev": "1" * 40,
+            "sha256": "0" * 52,
+            "fetchSubmodules": True,
+        },
+        "src/buildtools/linux64": {
+            "fetcher": "symlinkJoin",
+            "name": "cipd-joined",
+            "paths": [
+                {
+                    "fetcher": "fetchcipd",
+                    "package": "gn/gn/linux-amd64",
+                    "version": "git_revision:2",
+                    "sha256": "1" * 52,
+                },
+                {
+                    "fetcher": "fetchcipd",
+                    "package": "gn/other",
+                    "version": "3",
+                    "sha256": "2" * 52,
+                },
+            ],
+        },
+        "src/third_party/test_fonts/test_fonts": {
+            "fetcher": "runCommand",
+            "name": "download_from_google_storage-chromium-fonts",
+        },
+        "src/chrome/android/profiles/afdo.prof": {
+            "fetcher": "runCommand",
+            "name": "download_afdo_profile",
+        },
+    }
+
+
+def write_tree(path: str, size: int) -> None:
+    os.makedirs(path)
+    with open(os.path.join(path, "file"), "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_dep_cache_evict(tmpdir: Any) -> None:
+    cache = mk_vendor_file.DepCache(str(tmpdir / "cache"))
+    for key, size, last_used in [("old", 100, 1), ("new", 200, 3), ("used", 50, 2)]:
+        write_tree(cache.path(key), size)
+        cache.put(key, "sha256-" + key)
+        cache.index[key]["last_used"] = last_used
+    write_tree(cache.path(os.path.join("1.2.3.4", "depot_tools")), 10)
+    cache.put_tree("1.2.3.4")
+    cache.index["1.2.3.4"]["last_used"] = 0
+
+    # After pruning "used", the least recently used trees go until 220 bytes are left
+    cache.evict(220, ["used"])
+    for key, exists in [("old", False), ("new", True), ("used", False)]:
+        assert os.path.isdir(cache.path(key)) == exists
+    assert not os.path.exists(cache.path("1.2.3.4"))
+    assert cache.index == {
+        "old": {"sha256": "sha256-old", "size": 0, "last_used": 1},
+        "new": {"sha256": "sha256-new", "size": 200, "last_used": 3},
+        "used": {"sha256": "sha256-used", "size": 0, "last_used": 2},
+    }
+    assert mk_vendor_file.DepCache(str(tmpdir / "cache")).index == cache.index
+
+    # Hashes are kept for pruned checkouts
+    assert cache.get("old") == "sha256-old"
+    assert cache.get("old", need_tree=True) is None
+
+
+def test_dep_cache_import_sha256_files(tmpdir: Any) -> None:
+    basedir = tmpdir.mkdir("cache")
+    write_tree(str(basedir / "abc"), 10)
+    (basedir / "abc.sha256").write("sha256-abc\n")
+    (basedir / "def.sha256").write("sha256-def\n")
+
+    cache = mk_vendor_file.DepCache(str(basedir))
+    assert cache.get("abc", need_tree=True) == "sha256-abc"
+    assert cache.index["def"]["size"] == 0
+    # Kept for older versions of the script
+    assert (basedir / "abc.sha256").exists()
+
+    # Indexed entries are not imported again
+    cache.put("def", "sha256-new")
+    assert mk_vendor_file.DepCache(str(basedir)).get("def") == "sha256-new"
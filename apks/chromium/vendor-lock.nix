@@ -0,0 +1,67 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+# Turns a vendor-<version>.json lock written by mk-vendor-file.py into the
+# attrset of sources expected from vendor-<version>.nix
+lock:
+{
+  fetchgit,
+  fetchcipd,
+  fetchurl,
+  runCommand,
+  symlinkJoin,
+  platform,
+}:
+let
+  fetchurlLocked =
+    dep:
+    fetchurl (
+      {
+        inherit (dep) url;
+      }
+      // (if dep ? sha1 then { inherit (dep) sha1; } else { inherit (dep) sha256; })
+    );
+
+  fetchcipdLocked =
+    p:
+    fetchcipd {
+      # CIPD package names may refer to the platform as ${platform}
+      package = builtins.replaceStrings [ "\${platform}" ] [ platform ] p.package;
+      inherit (p) version sha256;
+    };
+
+  fetchers = {
+    git =
+      dep:
+      fetchgit {
+        inherit (dep) url rev sha256;
+        fetchSubmodules = dep.fetch_submodules;
+      };
+
+    cipd =
+      dep:
+      if builtins.length dep.packages == 1 then
+        fetchcipdLocked (builtins.head dep.packages)
+      else
+        symlinkJoin {
+          name = "cipd-joined";
+          paths = map fetchcipdLocked dep.packages;
+        };
+
+    url = fetchurlLocked;
+
+    tarball =
+      dep:
+      runCommand dep.name { } ''
+        mkdir $out
+        tar xf ${fetchurlLocked dep} --strip-components=${toString dep.strip_components} -C $out
+      '';
+
+    bzip2 =
+      dep:
+      runCommand dep.name { } ''
+        bzip2 -d -c ${fetchurlLocked dep} > $out
+      '';
+  };
+in
+builtins.mapAttrs (path: dep: fetchers.${dep.dep_type} dep) lock.deps
@@ -8,17 +8,18 @@ export TMPDIR=/tmp
 
 readarray -t devices < <(jq -r 'keys[]' <kernel-metadata.json)
 
+# Fetch all kernels in one run, so projects shared between them are only hashed once
+args=(
+  --ref-type branch
+  --cache-search-path ../../../../
+  --include-prefix private/                                   # Only get the projects under the private/ path
+  --exclude-path private/msm-google-modules/touch/fts/sunfish # Kernel manifest out-of-date, this repo is not tagged for current release.
+)
+branches=()
 for device in "${devices[@]}"; do
-  args=(
-    --ref-type branch
-    --cache-search-path ../../../../
-    --include-prefix private/                                   # Only get the projects under the private/ path
-    --exclude-path private/msm-google-modules/touch/fts/sunfish # Kernel manifest out-of-date, this repo is not tagged for current release.
-    --override-tag "$(jq -r ".${device}.tag" <kernel-metadata.json)"
-    "https://android.googlesource.com/kernel/manifest"
-    "$@"
-    "$(jq -r ".${device}.branch" <kernel-metadata.json)"
-  )
-  echo "### Fetching kernel sources for ${device} ###"
-  ../../../../scripts/mk_repo_file.py "${args[@]}"
+  args+=(--override-tag "$(jq -r ".${device}.tag" <kernel-metadata.json)")
+  branches+=("$(jq -r ".${device}.branch" <kernel-metadata.json)")
 done
+
+echo "### Fetching kernel sources for ${devices[*]} ###"
+../../../../scripts/mk_repo_file.py "${args[@]}" "$@" "https://android.googlesource.com/kernel/manifest" "${branches[@]}"
@@ -1,20 +1,404 @@
 #!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2020 Daniel Fullmer and robotnix contributors
+# SPDX-License-Identifier: MIT
 
-import zipfile
+"""Override the trichrome cert digest in already-built APKs
+
+Only AndroidManifest.xml is modified: strings in its binary XML string pool
+which are equal to the original digest are replaced. All other entries are
+copied into the output as raw compressed bytes, without inflating or
+deflating them. Stored entries are aligned the way `zipalign -p 4` would
+align them, so the result passes `zipalign -c -p 4` without being rewritten
+again.
+
+Usage:
+  chromium-trichrome-patcher.py IN OUT ORIG_DIGEST NEW_DIGEST
+  chromium-trichrome-patcher.py --orig-digest D --new-digest D IN:OUT...
+"""
+
+from typing import BinaryIO, Dict, List, Tuple
+
+import argparse
+import concurrent.futures
+import struct
 import sys
+import zipfile
+import zlib
+
+MANIFEST = "AndroidManifest.xml"
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+END_OF_CENTRAL_DIR = struct.Struct("<4s4H2LH")
+
+# Extra field used by zipalign/apksigner to pad local headers
+ALIGNMENT_EXTRA_ID = 0xD935
+ALIGNMENT = 4
+PAGE_ALIGNMENT = 4096
+
+FLAG_DATA_DESCRIPTOR = 0x08
+
+
+def alignment_extra(offset: int, name_len: int, alignment: int) -> bytes:
+    """Extra field which aligns the data of a local header starting at `offset`"""
+    data_start = offset + LOCAL_HEADER.size + name_len + 6
+    padding = -data_start % alignment
+    return struct.pack("<3H", ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + (
+        b"\0" * padding
+    )
+
 
-infilename, outfilename, orig_certdigest, new_certdigest = sys.argv[1:]
+def dos_date_time(info: zipfile.ZipInfo) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = info.date_time
+    return (
+        (year - 1980) << 9 | month << 5 | day,
+        hour << 11 | minute << 5 | second // 2,
+    )
 
-zin = zipfile.ZipFile(infilename, "r")
-zout = zipfile.ZipFile(outfilename, "w")
 
-for info in zin.infolist():
-    data = zin.read(info.filename)
-    if info.filename == "AndroidManifest.xml":
-        # Make sure we can find the certdigest
-        data.rindex(orig_certdigest.encode("utf-16-le"))
-        # Replace it
-        data = data.replace(
-            orig_certdigest.encode("utf-16-le"), new_certdigest.encode("utf-16-le")
+def copy_raw(src: BinaryIO, dst: BinaryIO, length: int) -> None:
+    while length > 0:
+        chunk = src.read(min(length, 1024 * 1024))
+        if not chunk:
+            raise Exception("Unexpected end of zip file")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def read_length(data: bytes, pos: int, utf8: bool) -> Tuple[int, int]:
+    """Read a string pool length prefix, returning (length, new position)"""
+    if utf8:
+        length = data[pos]
+        if length & 0x80:
+            return (length & 0x7F) << 8 | data[pos + 1], pos + 2
+        return length, pos + 1
+    (length,) = struct.unpack_from("<H", data, pos)
+    if length & 0x8000:
+        (low,) = struct.unpack_from("<H", data, pos + 2)
+        return (length & 0x7FFF) << 16 | low, pos + 4
+    return length, pos + 2
+
+
+def encode_length(length: int, utf8: bool) -> bytes:
+    if utf8:
+        if length > 0x7FFF:
+            raise Exception("String too long for a UTF-8 string pool")
+        if length > 0x7F:
+            return bytes([0x80 | length >> 8, length & 0xFF])
+        return bytes([length])
+    if length > 0x7FFF:
+        return struct.pack("<2H", 0x8000 | length >> 16, length & 0xFFFF)
+    return struct.pack("<H", length)
+
+
+def read_string(data: bytes, pos: int, utf8: bool) -> Tuple[str, int]:
+    """Decode the string pool entry at `pos`, returning (string, end position)"""
+    if utf8:
+        _, pos = read_length(data, pos, utf8)
+        length, pos = read_length(data, pos, utf8)
+        end = pos + length
+        return data[pos:end].decode("utf-8", errors="replace"), end + 1
+    length, pos = read_length(data, pos, utf8)
+    end = pos + 2 * length
+    return data[pos:end].decode("utf-16-le", errors="surrogatepass"), end + 2
+
+
+def encode_string(s: str, utf8: bool) -> bytes:
+    if utf8:
+        encoded = s.encode("utf-8")
+        utf16_len = len(s.encode("utf-16-le")) // 2
+        return (
+            encode_length(utf16_len, utf8)
+            + encode_length(len(encoded), utf8)
+            + encoded
+            + b"\0"
         )
-    zout.writestr(info, data)
+    encoded = s.encode("utf-16-le")
+    return encode_length(len(encoded) // 2, utf8) + encoded + b"\0\0"
+
+
+RES_XML_TYPE = 0x0003
+RES_STRING_POOL_TYPE = 0x0001
+STRING_POOL_HEADER = struct.Struct("<2HL5L")
+UTF8_FLAG = 0x100
+
+
+def rewrite_string_pool(data: bytes, replacements: Dict[str, str]) -> Tuple[bytes, int]:
+    """Replace whole strings in the string pool of a binary XML document
+
+    Returns the new document and the number of replaced strings. The string
+    data is re-encoded, so replacements may have a different length.
+    """
+    xml_type, xml_header_size, xml_size = struct.unpack_from("<2HL", data)
+    if xml_type != RES_XML_TYPE or xml_size != len(data):
+        raise Exception("Not a binary XML document")
+    pool_start = xml_header_size
+    (
+        pool_type,
+        pool_header_size,
+        pool_size,
+        string_count,
+        style_count,
+        flags,
+        strings_start,
+        styles_start,
+    ) = STRING_POOL_HEADER.unpack_from(data, pool_start)
+    if pool_type != RES_STRING_POOL_TYPE:
+        raise Exception("Binary XML document does not start with a string pool")
+    utf8 = bool(flags & UTF8_FLAG)
+    pool_end = pool_start + pool_size
+    header_end = pool_start + pool_header_size
+    offsets = struct.unpack_from(f"<{string_count}L", data, header_end)
+    style_offsets_start = header_end + 4 * string_count
+    style_offsets_end = style_offsets_start + 4 * style_count
+    style_offsets = data[style_offsets_start:style_offsets_end]
+    styles_pos = pool_start + styles_start
+    styles = data[styles_pos:pool_end] if style_count else b""
+
+    # Strings may share data, so each distinct offset is only copied once
+    string_data = bytearray()
+    new_offsets: Dict[int, int] = {}
+    replaced = 0
+    for offset in offsets:
+        if offset in new_offsets:
+            continue
+        new_offsets[offset] = len(string_data)
+        pos = pool_start + strings_start + offset
+        s, end = read_string(data, pos, utf8)
+        if s in replacements:
+            string_data += encode_string(replacements[s], utf8)
+            replaced += 1
+        else:
+            string_data += data[pos:end]
+    string_data += b"\0" * (-len(string_data) % 4)
+
+    header_extra_start = pool_start + STRING_POOL_HEADER.size
+    header_extra = data[header_extra_start:header_end]
+    new_strings_start = pool_header_size + 4 * (string_count + style_count)
+    new_styles_start = new_strings_start + len(string_data) if style_count else 0
+    new_pool_size = new_strings_start + len(string_data) + len(styles)
+    pool = (
+        STRING_POOL_HEADER.pack(
+            pool_type,
+            pool_header_size,
+            new_pool_size,
+            string_count,
+            style_count,
+            flags,
+            new_strings_start,
+            new_styles_start,
+        )
+        + header_extra
+        + struct.pack(f"<{string_count}L", *(new_offsets[o] for o in offsets))
+        + style_offsets
+        + string_data
+        + styles
+    )
+    rest = data[pool_end:]
+    header = struct.pack(
+        "<2HL", xml_type, xml_header_size, pool_start + len(pool) + len(rest)
+    )
+    return header + data[8:pool_start] + pool + rest, replaced
+
+
+def patch_manifest(
+    data: bytes, orig_certdigest: str, new_certdigest: str, expected_count: int
+) -> bytes:
+    data, replaced = rewrite_string_pool(data, {orig_certdigest: new_certdigest})
+    if replaced != expected_count:
+        raise Exception(
+            f"Expected to replace {expected_count} occurrences of {orig_certdigest}"
+            f" in {MANIFEST}, replaced {replaced}"
+        )
+    return data
+
+
+def compress(data: bytes, compress_type: int) -> bytes:
+    if compress_type == zipfile.ZIP_STORED:
+        return data
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+    raise Exception(f"Unsupported compression method {compress_type}")
+
+
+def patch_apk(
+    infilename: str,
+    outfilename: str,
+    orig_certdigest: str,
+    new_certdigest: str,
+    expected_count: int = 1,
+) -> None:
+    with zipfile.ZipFile(infilename, "r") as zin, open(infilename, "rb") as fin, open(
+        outfilename, "wb"
+    ) as fout:
+        central_dir: List[bytes] = []
+        for info in zin.infolist():
+            fin.seek(info.header_offset)
+            header = LOCAL_HEADER.unpack(fin.read(LOCAL_HEADER.size))
+            if header[0] != b"PK\x03\x04":
+                raise Exception(f"Bad local header for {info.filename}")
+            name_len, extra_len = header[9], header[10]
+            name = fin.read(name_len)
+            fin.seek(extra_len, 1)
+
+            crc, compress_size, file_size = info.CRC, info.compress_size, info.file_size
+            data = None
+            if info.filename == MANIFEST:
+                manifest = patch_manifest(
+                    zin.read(info), orig_certdigest, new_certdigest, expected_count
+                )
+                crc, file_size = zlib.crc32(manifest), len(manifest)
+                data = compress(manifest, info.compress_type)
+                compress_size = len(data)
+
+            offset = fout.tell()
+            if max(offset, compress_size, file_size) >= 0xFFFFFFFF:
+                raise Exception("Zip64 output is not supported")
+            if info.compress_type == zipfile.ZIP_STORED:
+                alignment = (
+                    PAGE_ALIGNMENT if info.filename.endswith(".so") else ALIGNMENT
+                )
+                extra = alignment_extra(offset, len(name), alignment)
+            else:
+                extra = b""
+
+            # Sizes are known upfront, so no data descriptor is written
+            flags = info.flag_bits & ~FLAG_DATA_DESCRIPTOR
+            date, time = dos_date_time(info)
+            fout.write(
+                LOCAL_HEADER.pack(
+                    b"PK\x03\x04",
+                    info.extract_version,
+                    flags,
+                    info.compress_type,
+                    time,
+                    date,
+                    crc,
+                    compress_size,
+                    file_size,
+                    len(name),
+                    len(extra),
+                )
+            )
+            fout.write(name)
+            fout.write(extra)
+            if data is None:
+                copy_raw(fin, fout, compress_size)
+            else:
+                fout.write(data)
+
+            central_dir.append(
+                CENTRAL_HEADER.pack(
+                    b"PK\x01\x02",
+                    info.create_system << 8 | info.create_version,
+                    info.extract_version,
+                    flags,
+                    info.compress_type,
+                    time,
+                    date,
+                    crc,
+                    compress_size,
+                    file_size,
+                    len(name),
+                    len(info.extra),
+                    len(info.comment),
+                    0,
+                    info.internal_attr,
+                    info.external_attr,
+                    offset,
+                )
+                + name
+                + info.extra
+                + info.comment
+            )
+
+        central_dir_offset = fout.tell()
+        for entry in central_dir:
+            fout.write(entry)
+        central_dir_size = fout.tell() - central_dir_offset
+        if len(central_dir) > 0xFFFF or central_dir_offset >= 0xFFFFFFFF:
+            raise Exception("Zip64 output is not supported")
+        fout.write(
+            END_OF_CENTRAL_DIR.pack(
+                b"PK\x05\x06",
+                0,
+                0,
+                len(central_dir),
+                len(central_dir),
+                central_dir_size,
+                central_dir_offset,
+                len(zin.comment),
+            )
+        )
+        fout.write(zin.comment)
+
+
+def main() -> None:
+    if len(sys.argv) == 5 and not any(arg.startswith("-") for arg in sys.argv[1:]):
+        infilename, outfilename, orig_certdigest, new_certdigest = sys.argv[1:]
+        patch_apk(infilename, outfilename, orig_certdigest, new_certdigest)
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orig-digest", required=True, help="cert digest to replace")
+    parser.add_argument("--new-digest", required=True, help="replacement cert digest")
+    parser.add_argument(
+        "--expected-count",
+        type=int,
+        default=1,
+        help="number of string pool entries which must be replaced in each APK",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="number of APKs to patch in parallel"
+    )
+    parser.add_argument("apks", nargs="+", metavar="IN:OUT", help="APKs to patch")
+    args = parser.parse_args()
+
+    pairs = []
+    for spec in args.apks:
+        infilename, sep, outfilename = spec.rpartition(":")
+        if not sep:
+            parser.error(f"Expected IN:OUT, got {spec}")
+        pairs.append((infilename, outfilename))
+
+    failed = False
+    if len(pairs) == 1 or args.jobs == 1:
+        # Not worth starting worker processes
+        for infilename, outfilename in pairs:
+            try:
+                patch_apk(
+                    infilename,
+                    outfilename,
+                    args.orig_digest,
+                    args.new_digest,
+                    args.expected_count,
+                )
+            except Exception as e:
+                print(f"Failed to patch {infilename}: {e}", file=sys.stderr)
+                failed = True
+    else:
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            futures = {
+                executor.submit(
+                    patch_apk,
+                    infilename,
+                    outfilename,
+                    args.orig_digest,
+                    args.new_digest,
+                    args.expected_count,
+                ): infilename
+                for infilename, outfilename in pairs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed to patch {futures[future]}: {e}", file=sys.stderr)
+                    failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -64,8 +64,13 @@ let
         nativeBuildInputs = with pkgs; [ python3 ];
       }
       ''
-        python3 ${./chromium-trichrome-patcher.py} ${src} patched.apk ${lib.toLower defaultTrichromeCertDigest} ${lib.toLower newCertDigest}
-        ${pkgs.robotnix.build-tools}/zipalign -p -f 4 patched.apk $out
+        python3 ${./chromium-trichrome-patcher.py} \
+          --orig-digest ${lib.toLower defaultTrichromeCertDigest} \
+          --new-digest ${lib.toLower newCertDigest} \
+          --expected-count 1 \
+          ${src}:$out
+        # The patcher keeps entries aligned, so only verify instead of rewriting
+        ${pkgs.robotnix.build-tools}/zipalign -c -p 4 $out
       '';
 in
 {
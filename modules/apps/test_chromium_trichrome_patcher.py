@@ -0,0 +1,205 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import importlib.util
+import os
+import struct
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from typing import Any, Dict, List, Tuple
+
+PATCHER = os.path.join(os.path.dirname(__file__), "chromium-trichrome-patcher.py")
+_spec = importlib.util.spec_from_file_location("chromium_trichrome_patcher", PATCHER)
+assert _spec is not None and _spec.loader is not None
+patcher = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(patcher)
+
+ORIG_DIGEST = "32a2fc74d731105859e5a85df16d95f102d85b22099b8064c5d8915c61dad1e0"
+# Long enough to need a two byte length prefix in a UTF-8 pool
+NEW_DIGEST = "ab" * 100
+
+# Chunk following the string pool, which must be copied unchanged
+RESOURCE_MAP = struct.pack("<2HL2L", 0x0180, 8, 16, 0x01010003, 0x01010024)
+
+
+def make_manifest(strings: List[str], utf8: bool) -> bytes:
+    """Binary XML document with a string pool holding `strings`"""
+    string_data = b""
+    offsets = []
+    for s in strings:
+        offsets.append(len(string_data))
+        string_data += patcher.encode_string(s, utf8)
+    string_data += b"\0" * (-len(string_data) % 4)
+    header_size = patcher.STRING_POOL_HEADER.size
+    strings_start = header_size + 4 * len(strings)
+    pool: bytes = (
+        patcher.STRING_POOL_HEADER.pack(
+            patcher.RES_STRING_POOL_TYPE,
+            header_size,
+            strings_start + len(string_data),
+            len(strings),
+            0,
+            patcher.UTF8_FLAG if utf8 else 0,
+            strings_start,
+            0,
+        )
+        + struct.pack(f"<{len(strings)}L", *offsets)
+        + string_data
+    )
+    size = 8 + len(pool) + len(RESOURCE_MAP)
+    return struct.pack("<2HL", patcher.RES_XML_TYPE, 8, size) + pool + RESOURCE_MAP
+
+
+def parse_manifest(data: bytes) -> Tuple[List[str], bool]:
+    """Check the chunk sizes of a document from make_manifest and decode its strings"""
+    _, header_size, size = struct.unpack_from("<2HL", data)
+    assert size == len(data)
+    (
+        pool_type,
+        pool_header_size,
+        pool_size,
+        string_count,
+        _,
+        flags,
+        strings_start,
+        _,
+    ) = patcher.STRING_POOL_HEADER.unpack_from(data, header_size)
+    assert pool_type == patcher.RES_STRING_POOL_TYPE
+    assert pool_size % 4 == 0
+    pool_end = header_size + pool_size
+    assert data[pool_end:] == RESOURCE_MAP
+    utf8 = bool(flags & patcher.UTF8_FLAG)
+    offsets = struct.unpack_from(
+        f"<{string_count}L", data, header_size + pool_header_size
+    )
+    strings = []
+    for offset in offsets:
+        pos = header_size + strings_start + offset
+        s, end = patcher.read_string(data, pos, utf8)
+        assert end <= pool_end
+        strings.append(s)
+    return strings, utf8
+
+
+@pytest.mark.parametrize("utf8", [True, False])
+def test_rewrite_string_pool(utf8: bool) -> None:
+    strings = ["manifest", ORIG_DIGEST, "uses-static-library", ORIG_DIGEST + "x"]
+    data = make_manifest(strings, utf8)
+    assert parse_manifest(data) == (strings, utf8)
+
+    new_data, replaced = patcher.rewrite_string_pool(data, {ORIG_DIGEST: NEW_DIGEST})
+    assert replaced == 1
+    assert len(new_data) > len(data)
+    assert parse_manifest(new_data) == (
+        ["manifest", NEW_DIGEST, "uses-static-library", ORIG_DIGEST + "x"],
+        utf8,
+    )
+
+    # A shorter replacement shrinks the document again
+    old_data, replaced = patcher.rewrite_string_pool(
+        new_data, {NEW_DIGEST: ORIG_DIGEST}
+    )
+    assert replaced == 1
+    assert old_data == data
+
+
+def make_apk(path: str, manifest: bytes) -> Dict[str, bytes]:
+    entries = {
+        "AndroidManifest.xml": (manifest, zipfile.ZIP_DEFLATED),
+        "classes.dex": (b"dex\n035\0" + bytes(range(256)) * 20, zipfile.ZIP_DEFLATED),
+        "odd": (b"x" * 13, zipfile.ZIP_STORED),
+        "resources.arsc": (b"\x02\0\x0c\0" + b"\0" * 100, zipfile.ZIP_STORED),
+        "lib/arm64-v8a/libfoo.so": (b"\x7fELF" + b"\0" * 5000, zipfile.ZIP_STORED),
+        "res/raw/a.txt": (b"y" * 7, zipfile.ZIP_STORED),
+    }
+    with zipfile.ZipFile(path, "w") as z:
+        for name, (data, compress_type) in entries.items():
+            z.writestr(name, data, compress_type=compress_type)
+    return {name: data for name, (data, _) in entries.items()}
+
+
+def data_offset(path: str, info: zipfile.ZipInfo) -> int:
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        header = patcher.LOCAL_HEADER.unpack(f.read(patcher.LOCAL_HEADER.size))
+    name_len, extra_len = header[9], header[10]
+    offset: int = info.header_offset + patcher.LOCAL_HEADER.size + name_len + extra_len
+    return offset
+
+
+def test_patch_apk(tmpdir: Any) -> None:
+    inpath, outpath = str(tmpdir / "in.apk"), str(tmpdir / "out.apk")
+    manifest = make_manifest(["manifest", ORIG_DIGEST], utf8=False)
+    entries = make_apk(inpath, manifest)
+
+    patcher.patch_apk(inpath, outpath, ORIG_DIGEST, NEW_DIGEST)
+
+    with zipfile.ZipFile(inpath) as zin, zipfile.ZipFile(outpath) as zout:
+        assert zout.testzip() is None
+        assert zout.namelist() == zin.namelist()
+        for info in zout.infolist():
+            assert info.compress_type == zin.getinfo(info.filename).compress_type
+            if info.filename == "AndroidManifest.xml":
+                assert parse_manifest(zout.read(info)) == (
+                    ["manifest", NEW_DIGEST],
+                    False,
+                )
+            else:
+                assert zout.read(info) == entries[info.filename]
+            if info.compress_type == zipfile.ZIP_STORED:
+                alignment = 4096 if info.filename.endswith(".so") else 4
+                assert data_offset(outpath, info) % alignment == 0
+
+
+def test_expected_count(tmpdir: Any) -> None:
+    inpath, outpath = str(tmpdir / "in.apk"), str(tmpdir / "out.apk")
+    make_apk(inpath, make_manifest(["manifest", ORIG_DIGEST], utf8=True))
+
+    with pytest.raises(Exception, match="Expected to replace 2 occurrences"):
+        patcher.patch_apk(inpath, outpath, ORIG_DIGEST, NEW_DIGEST, expected_count=2)
+
+    cmd = [sys.executable, PATCHER, "--orig-digest", ORIG_DIGEST]
+    cmd += ["--new-digest", NEW_DIGEST, f"{inpath}:{outpath}"]
+    result = subprocess.run(
+        cmd + ["--expected-count", "2"], capture_output=True, text=True
+    )
+    assert result.returncode == 1
+    assert "Failed to patch" in result.stderr
+
+    subprocess.check_call(cmd + ["--expected-count", "1"])
+
+
+def test_main_jobs(tmpdir: Any, monkeypatch: Any) -> None:
+    manifest = make_manifest(["manifest", ORIG_DIGEST], utf8=True)
+    specs = []
+    for name in ["a", "b"]:
+        make_apk(str(tmpdir / f"{name}.apk"), manifest)
+        specs.append(f"{tmpdir / name}.apk:{tmpdir / name}-out.apk")
+    cmd = ["--orig-digest", ORIG_DIGEST, "--new-digest", NEW_DIGEST]
+
+    def check_output() -> None:
+        for name in ["a", "b"]:
+            with zipfile.ZipFile(str(tmpdir / f"{name}-out.apk")) as z:
+                strings, _ = parse_manifest(z.read("AndroidManifest.xml"))
+                assert strings == ["manifest", NEW_DIGEST]
+            os.unlink(str(tmpdir / f"{name}-out.apk"))
+
+    # A single APK, or --jobs 1, is patched without starting worker processes
+    def no_pool(*args: Any, **kwargs: Any) -> None:
+        raise AssertionError("Started a process pool")
+
+    monkeypatch.setattr("concurrent.futures.ProcessPoolExecutor", no_pool)
+    for spec in specs:
+        monkeypatch.setattr("sys.argv", ["patcher"] + cmd + [spec])
+        patcher.main()
+    check_output()
+    monkeypatch.setattr("sys.argv", ["patcher"] + cmd + ["--jobs", "1"] + specs)
+    patcher.main()
+    check_output()
+
+    subprocess.check_call([sys.executable, PATCHER] + cmd + ["--jobs", "2"] + specs)
+    check_output()
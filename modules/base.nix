@@ -570,6 +570,11 @@ in
           '';
         };
 
+        # SQLite index of moduleInfo, for looking up many modules without parsing all of it
+        moduleInfoIndex = pkgs.runCommand "robotnix-module-info-${config.device}-${config.buildNumber}.sqlite" { } ''
+          ${pkgs.python3.interpreter} ${../scripts/module_info.py} index ${config.build.moduleInfo} $out
+        '';
+
         # Save significant build time by building components simultaneously.
         mkAndroidComponents =
           targets:
@@ -577,24 +582,8 @@ in
             name = "robotnix-android-components";
             makeTargets = targets ++ [ "$(get_build_var PRODUCT_OUT)/module-info.json" ];
             installPhase = ''
-              ${pkgs.python3.interpreter} - "$out" "$ANDROID_PRODUCT_OUT/module-info.json" ${lib.escapeShellArgs targets} << EOF
-              import json
-              import os
-              import shutil
-              import sys
-              outdir = sys.argv[1]
-              module_info = json.load(open(sys.argv[2]))
-              targets = sys.argv[3:]
-              for target in targets:
-                  if target in module_info:
-                      for item in module_info[target]['installed']:
-                          if item.startswith('out/'):
-                              output = outdir + item[3:]
-                          else:
-                              output = outdir + '/' + item
-                          os.makedirs(os.path.dirname(output), exist_ok=True)
-                          shutil.copyfile(item, output)
-              EOF
+              ${pkgs.python3.interpreter} ${../scripts/module_info.py} install --jobs "$NIX_BUILD_CORES" \
+                "$out" "$ANDROID_PRODUCT_OUT/module-info.json" ${lib.escapeShellArgs targets}
             '';
           };
 
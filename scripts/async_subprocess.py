@@ -0,0 +1,173 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""asyncio-based execution of git and nix-prefetch-git subprocesses
+
+Each remote host gets its own concurrency limit, so many cheap ref lookups
+can run at once without overloading a single server, while "heavy" commands
+(checkouts) share a separate, smaller limit, and can reserve part of a disk
+budget. Commands which talk to a remote are retried with exponential backoff.
+Cancelling a task (e.g. on Ctrl-C) kills its subprocess.
+"""
+
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    TypeVar,
+)
+
+import asyncio
+import contextlib
+import subprocess
+import sys
+from urllib.parse import urlparse
+
+T = TypeVar("T")
+
+DEFAULT_HOST_LIMITS = {
+    "android.googlesource.com": 16,
+    "github.com": 8,
+}
+
+
+def parse_host_limits(specs: List[str]) -> Dict[str, int]:
+    """Parse a list of HOST=N strings"""
+    limits = dict(DEFAULT_HOST_LIMITS)
+    for spec in specs:
+        host, limit = spec.split("=")
+        limits[host] = int(limit)
+    return limits
+
+
+class AsyncRunner:
+    def __init__(
+        self,
+        heavy_limit: int,
+        host_limits: Optional[Dict[str, int]] = None,
+        default_host_limit: int = 32,
+        retries: int = 3,
+        backoff: float = 2.0,
+        disk_budget: Optional[int] = None,
+    ) -> None:
+        self.heavy = asyncio.Semaphore(heavy_limit)
+        self.disk_budget = disk_budget
+        self.disk_reserved = 0
+        self.disk_users = 0
+        self.disk_released = asyncio.Condition()
+        self.host_limits = DEFAULT_HOST_LIMITS if host_limits is None else host_limits
+        self.default_host_limit = default_host_limit
+        self.hosts: Dict[str, asyncio.Semaphore] = {}
+        self.retries = retries
+        self.backoff = backoff
+
+    def host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).hostname or "local"
+        if host not in self.hosts:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            self.hosts[host] = asyncio.Semaphore(limit)
+        return self.hosts[host]
+
+    @contextlib.asynccontextmanager
+    async def disk(self, nbytes: int) -> AsyncIterator[None]:
+        """Reserve `nbytes` of the disk budget, waiting until they fit.
+
+        As with run_longest_first, a reservation is granted whenever no other
+        is held, so tasks larger than the whole budget still run on their own.
+        """
+        if self.disk_budget is None:
+            yield
+            return
+        budget = self.disk_budget
+        async with self.disk_released:
+            await self.disk_released.wait_for(
+                lambda: self.disk_users == 0 or self.disk_reserved + nbytes <= budget
+            )
+            self.disk_reserved += nbytes
+            self.disk_users += 1
+        try:
+            yield
+        finally:
+            async with self.disk_released:
+                self.disk_reserved -= nbytes
+                self.disk_users -= 1
+                self.disk_released.notify_all()
+
+    async def _run_once(self, args: List[str], cwd: Optional[str]) -> bytes:
+        proc = await asyncio.create_subprocess_exec(
+            *args, cwd=cwd, stdout=subprocess.PIPE
+        )
+        try:
+            stdout, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode or 0, args, stdout)
+        return stdout
+
+    async def _with_retries(
+        self, url: str, name: str, attempt: Callable[[], Awaitable[T]]
+    ) -> T:
+        """Await `attempt()`, retrying with backoff if a command fails"""
+        for i in range(self.retries + 1):
+            try:
+                return await attempt()
+            except subprocess.CalledProcessError as e:
+                if i == self.retries:
+                    raise
+                delay = self.backoff * 2**i
+                print(
+                    f"{name} failed for {url} with code {e.returncode}, "
+                    f"retrying in {delay:.0f}s",
+                    file=sys.stderr,
+                )
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def run(
+        self,
+        args: List[str],
+        url: Optional[str] = None,
+        cwd: Optional[str] = None,
+        heavy: bool = False,
+    ) -> bytes:
+        """Run a command and return its stdout.
+
+        If `url` is given, the command is limited by the concurrency limit of
+        its host and retried on failure.
+        """
+        if url is None:
+            if heavy:
+                async with self.heavy:
+                    return await self._run_once(args, cwd)
+            return await self._run_once(args, cwd)
+
+        host_url = url
+
+        async def attempt() -> bytes:
+            if heavy:
+                async with self.heavy, self.host_semaphore(host_url):
+                    return await self._run_once(args, cwd)
+            async with self.host_semaphore(host_url):
+                return await self._run_once(args, cwd)
+
+        return await self._with_retries(url, args[0], attempt)
+
+    async def run_in_thread(self, url: str, func: Callable[..., T], *args: Any) -> T:
+        """Call `func` in a thread, limited and retried like commands for `url`
+
+        For blocking functions which run git themselves, such as ls_remote.
+        """
+
+        async def attempt() -> T:
+            async with self.host_semaphore(url):
+                return await asyncio.to_thread(func, *args)
+
+        return await self._with_retries(url, func.__name__, attempt)
@@ -0,0 +1,237 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""Read objects from a git repository without checking out a working tree"""
+
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import os
+import subprocess
+import tempfile
+import threading
+
+from git_protocol import ProtocolError, capabilities
+
+CHUNK_SIZE = 1024 * 1024
+
+GitTreeEntry = Tuple[str, bytes, str]  # (mode, name, sha1)
+
+
+def find_git_dir(path: str) -> Optional[str]:
+    """Get the git directory for a local (possibly bare) repository path"""
+    for candidate in [path, path + ".git"]:
+        if os.path.isdir(os.path.join(candidate, ".git")):
+            return os.path.join(candidate, ".git")
+        if os.path.isfile(os.path.join(candidate, "HEAD")) and os.path.isdir(
+            os.path.join(candidate, "objects")
+        ):
+            return candidate
+    return None
+
+
+class CatFile:
+    """A long-lived `git cat-file --batch` process for a single repository.
+
+    Requests are answered in order, so callers must fully consume each
+    object before requesting the next one.  A lock is provided for callers
+    sharing an instance between threads.
+    """
+
+    def __init__(self, git_dir: str) -> None:
+        self.git_dir = git_dir
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(
+            ["git", "--git-dir", git_dir, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    @property
+    def _stdin(self) -> IO[bytes]:
+        assert self.proc.stdin is not None
+        return self.proc.stdin
+
+    @property
+    def _stdout(self) -> IO[bytes]:
+        assert self.proc.stdout is not None
+        return self.proc.stdout
+
+    def close(self) -> None:
+        if self.proc.poll() is None:
+            self._stdin.close()
+            self.proc.wait()
+
+    def __enter__(self) -> "CatFile":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def header(self, obj: str) -> Tuple[str, str, int]:
+        """Request `obj` and return its (sha1, type, size).
+
+        The object contents must then be consumed with `stream`.
+        """
+        self._stdin.write(obj.encode() + b"\n")
+        self._stdin.flush()
+        line = self._stdout.readline().decode().rstrip("\n")
+        fields = line.split(" ")
+        if len(fields) != 3:
+            raise Exception(f"{obj} not found in {self.git_dir}: {line}")
+        sha1, obj_type, size = fields
+        return sha1, obj_type, int(size)
+
+    def stream(self, size: int) -> Iterator[bytes]:
+        """Yield the contents of the object whose header was just read"""
+        remaining = size
+        while remaining > 0:
+            chunk = self._stdout.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                raise Exception(f"Unexpected EOF from git cat-file in {self.git_dir}")
+            remaining -= len(chunk)
+            yield chunk
+        self._stdout.read(1)  # Trailing newline
+
+    def read(self, obj: str) -> Tuple[str, str, bytes]:
+        """Return (sha1, type, contents) of `obj`"""
+        sha1, obj_type, size = self.header(obj)
+        return sha1, obj_type, b"".join(self.stream(size))
+
+
+def parse_tree(data: bytes) -> List[GitTreeEntry]:
+    entries = []
+    pos = 0
+    while pos < len(data):
+        nul = data.index(b"\0", pos)
+        mode, _, name = data[pos:nul].partition(b" ")
+        start, pos = nul + 1, nul + 21
+        entries.append((mode.decode(), name, data[start:pos].hex()))
+    return entries
+
+
+def parse_commit_tree(data: bytes) -> str:
+    """Get the tree hash from the contents of a commit object"""
+    first_line = data.split(b"\n", 1)[0]
+    if not first_line.startswith(b"tree "):
+        raise Exception("Malformed commit object")
+    return first_line.split(b" ", 1)[1].decode()
+
+
+def lookup_trees(git_dirs: Iterable[str], revs: Iterable[str]) -> Dict[str, str]:
+    """Get the tree hashes of many commits found in any of `git_dirs`.
+
+    The object stores of all repositories are joined using a temporary
+    repository with alternates, so a single `git cat-file --batch-check`
+    process resolves every commit. Commits which cannot be found are
+    missing from the result.
+    """
+    revs = sorted(set(revs))
+    if not revs:
+        return {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subprocess.check_call(["git", "init", "--quiet", "--bare", tmpdir])
+        with open(os.path.join(tmpdir, "objects", "info", "alternates"), "w") as f:
+            for git_dir in sorted(set(git_dirs)):
+                f.write(os.path.abspath(os.path.join(git_dir, "objects")) + "\n")
+
+        output = subprocess.run(
+            ["git", "--git-dir", tmpdir, "cat-file", "--batch-check"],
+            input="".join(f"{rev}^{{tree}}\n" for rev in revs).encode(),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.decode()
+
+    trees = {}
+    for rev, line in zip(revs, output.splitlines()):
+        fields = line.split(" ")
+        if len(fields) == 3 and fields[1] == "tree":
+            trees[rev] = fields[0]
+    return trees
+
+
+def present_objects(git_dir: str) -> Set[str]:
+    """Get the names of all objects in `git_dir`.
+
+    Unlike asking for objects by name, this never triggers a lazy fetch from
+    a promisor remote.
+    """
+    output = subprocess.check_output(
+        [
+            "git",
+            "--git-dir",
+            git_dir,
+            "cat-file",
+            "--batch-all-objects",
+            "--batch-check=%(objectname)",
+        ]
+    )
+    return set(output.decode().split())
+
+
+def supports_filter(url: str) -> bool:
+    """Whether the server of `url` supports partial fetches.
+
+    Servers which don't would send every object, as git only warns that the
+    filter is ignored.
+    """
+    try:
+        return "filter" in capabilities(url).get("fetch", [])
+    except (ProtocolError, subprocess.CalledProcessError):
+        return False
+
+
+def fetch_commits(git_dir: str, fetch_url: str, revs: List[str]) -> bool:
+    """Shallowly fetch only the commit objects of `revs`, without any trees"""
+    result = subprocess.run(
+        [
+            "git",
+            "--git-dir",
+            git_dir,
+            "fetch",
+            "--quiet",
+            "--depth=1",
+            "--filter=tree:0",
+            "--no-tags",
+            "--no-write-fetch-head",
+            fetch_url,
+            *revs,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def lookup_remote_trees(
+    git_dir: str, fetch_url: str, revs: Iterable[str]
+) -> Dict[str, str]:
+    """Get the tree hashes of commits of a remote repository.
+
+    Commits are fetched from `fetch_url` with a partial fetch which leaves
+    out all trees and blobs, into `git_dir`, which is created if needed and
+    kept between runs. Nothing is fetched from servers which do not support
+    filters. Commits which cannot be fetched are missing from the result.
+    """
+    revs = sorted(set(revs))
+    if not os.path.exists(os.path.join(git_dir, "HEAD")):
+        subprocess.check_call(["git", "init", "--quiet", "--bare", git_dir])
+
+    present = present_objects(git_dir)
+    missing = [rev for rev in revs if rev not in present]
+    if missing and supports_filter(fetch_url):
+        # One unavailable commit fails the whole fetch, so retry one by one
+        if not fetch_commits(git_dir, fetch_url, missing) and len(missing) > 1:
+            for rev in missing:
+                fetch_commits(git_dir, fetch_url, [rev])
+        present = present_objects(git_dir)
+
+    trees = {}
+    with CatFile(git_dir) as cat_file:
+        for rev in revs:
+            if rev not in present:
+                continue
+            _, obj_type, data = cat_file.read(rev)
+            if obj_type == "commit":
+                trees[rev] = parse_commit_tree(data)
+    return trees
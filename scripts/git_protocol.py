@@ -0,0 +1,150 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""List refs of a remote by prefix, using git protocol v2
+
+`git ls-remote <url> <patterns>` matches patterns on the client, after the
+server has sent every ref of the repository. The ls-refs command of protocol
+v2 instead takes ref prefixes which the server filters by, so listing a few
+refs of a repository with thousands of tags stays cheap.
+
+HTTP(S) remotes are reached through git's own remote helper (so credentials,
+proxies and `http.*` config apply), and local repositories through
+`git upload-pack`. Other remotes raise ProtocolError, as do servers which do
+not support protocol v2.
+"""
+
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import contextlib
+import os
+import subprocess
+from urllib.parse import urlparse
+
+FLUSH = b"0000"
+DELIM = b"0001"
+RESPONSE_END = b"0002"
+
+
+class ProtocolError(Exception):
+    """The remote cannot be queried with protocol v2"""
+
+
+def pkt_line(data: bytes) -> bytes:
+    return b"%04x" % (len(data) + 4) + data
+
+
+def read_pkt_lines(f: IO[bytes]) -> List[bytes]:
+    """Read pkt-lines up to the next flush packet"""
+    lines: List[bytes] = []
+    while True:
+        header = f.read(4)
+        if len(header) != 4:
+            raise ProtocolError("Unexpected end of stream")
+        length = int(header, 16)
+        if length == 0:
+            return lines
+        if length < 4:
+            continue  # Delimiter or response end
+        data = f.read(length - 4)
+        if len(data) != length - 4:
+            raise ProtocolError("Unexpected end of stream")
+        lines.append(data)
+
+
+def ls_refs_request(prefixes: Iterable[str]) -> bytes:
+    return (
+        pkt_line(b"command=ls-refs\n")
+        + DELIM
+        + b"".join(pkt_line(f"ref-prefix {p}\n".encode()) for p in sorted(prefixes))
+        + FLUSH
+    )
+
+
+def parse_ls_refs(lines: List[bytes]) -> Dict[str, str]:
+    refs = {}
+    for line in lines:
+        fields = line.decode().rstrip("\n").split(" ")
+        refs[fields[1]] = fields[0]
+    return refs
+
+
+def parse_capabilities(lines: List[bytes]) -> Dict[str, List[str]]:
+    """Parse a v2 capability advertisement into the values of each capability"""
+    if not lines or lines[0].rstrip(b"\n") != b"version 2":
+        raise ProtocolError("Remote does not support protocol v2")
+    capabilities = {}
+    for line in lines[1:]:
+        key, _, value = line.decode().rstrip("\n").partition("=")
+        capabilities[key] = value.split()
+    return capabilities
+
+
+def _query(
+    proc: "subprocess.Popen[bytes]",
+    capabilities: Dict[str, List[str]],
+    prefixes: Iterable[str],
+) -> Dict[str, str]:
+    assert proc.stdin is not None and proc.stdout is not None
+    if "ls-refs" not in capabilities:
+        raise ProtocolError("Remote does not support ls-refs")
+    proc.stdin.write(ls_refs_request(prefixes))
+    proc.stdin.flush()
+    return parse_ls_refs(read_pkt_lines(proc.stdout))
+
+
+def local_repo_path(url: str) -> Optional[str]:
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return parsed.path
+    if parsed.scheme == "" and os.path.isdir(url):
+        return url
+    return None
+
+
+@contextlib.contextmanager
+def _connect(
+    url: str,
+) -> Iterator[Tuple["subprocess.Popen[bytes]", Dict[str, List[str]]]]:
+    """Connect to the upload-pack of `url`, yielding it and its capabilities"""
+    path = local_repo_path(url)
+    if path is not None:
+        args = ["git", "upload-pack", path]
+        env = dict(os.environ, GIT_PROTOCOL="version=2")
+    elif urlparse(url).scheme in ("http", "https"):
+        args = ["git", "-c", "protocol.version=2", "remote-https", url, url]
+        env = None
+    else:
+        raise ProtocolError(f"Unsupported transport for {url}")
+
+    proc = subprocess.Popen(
+        args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env
+    )
+    assert proc.stdin is not None and proc.stdout is not None
+    try:
+        if path is None:
+            proc.stdin.write(b"stateless-connect git-upload-pack\n")
+            proc.stdin.flush()
+            if proc.stdout.readline() != b"\n":
+                raise ProtocolError(f"{url} does not support protocol v2")
+        yield proc, parse_capabilities(read_pkt_lines(proc.stdout))
+        proc.stdin.close()
+        proc.stdout.read()  # Such as the response end packet of the helper
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+def capabilities(url: str) -> Dict[str, List[str]]:
+    """Get the protocol v2 capabilities advertised by `url`"""
+    with _connect(url) as (_, result):
+        return result
+
+
+def ls_refs(url: str, prefixes: Iterable[str]) -> Dict[str, str]:
+    """Get the refs of `url` whose names start with any of `prefixes`"""
+    with _connect(url) as (proc, caps):
+        return _query(proc, caps, prefixes)
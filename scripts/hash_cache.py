@@ -0,0 +1,290 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""Persistent cache of project hashes used by mk_repo_file.py
+
+Hashes are stored in an SQLite database keyed by `(rev, fetchSubmodules,
+fetchLFS)` and `(tree, fetchSubmodules, fetchLFS)`.  Lockfiles which have already been imported are
+recorded by path, size and mtime so they are only parsed again once they
+change.  The duration and checkout size of the last fetch of each project
+are kept as well, to schedule work in later runs.
+"""
+
+from typing import Any, Iterator, MutableMapping, Optional, Tuple, TypedDict
+
+import os
+import sqlite3
+import threading
+
+from robotnix_common import cache_path
+
+
+class CachedInfo(TypedDict, total=False):
+    sha256: str
+    dateTime: int
+    tree: str
+
+
+CacheKey = Tuple[str, bool, bool]  # (rev or treeHash, fetch_submodules, fetch_lfs)
+
+# Bumped with PRAGMA user_version whenever the tables change
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revs (
+    key TEXT NOT NULL,
+    fetch_submodules INTEGER NOT NULL,
+    fetch_lfs INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    date_time INTEGER,
+    tree TEXT,
+    PRIMARY KEY (key, fetch_submodules, fetch_lfs)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trees (
+    key TEXT NOT NULL,
+    fetch_submodules INTEGER NOT NULL,
+    fetch_lfs INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    date_time INTEGER,
+    tree TEXT,
+    PRIMARY KEY (key, fetch_submodules, fetch_lfs)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS project_stats (
+    url TEXT PRIMARY KEY,
+    seconds REAL NOT NULL,
+    size INTEGER
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+# Version 0 did not key hashes by fetch_lfs. mk_repo_file fetches with LFS
+# unless --disable-lfs is given, so existing hashes are assumed to include it.
+RENAME_V0 = """
+ALTER TABLE revs RENAME TO revs_v0;
+ALTER TABLE trees RENAME TO trees_v0;
+"""
+COPY_V0 = """
+INSERT INTO revs SELECT key, fetch_submodules, 1, sha256, date_time, tree FROM revs_v0;
+INSERT INTO trees SELECT key, fetch_submodules, 1, sha256, date_time, tree FROM trees_v0;
+DROP TABLE revs_v0;
+DROP TABLE trees_v0;
+"""
+
+
+def default_cache_path() -> str:
+    return cache_path("mk_repo_file.sqlite")
+
+
+class CacheTable(MutableMapping[CacheKey, CachedInfo]):
+    """Dict-like view over one of the tables of a HashCache"""
+
+    def __init__(self, cache: "HashCache", table: str) -> None:
+        self.cache = cache
+        self.table = table
+
+    def __getitem__(self, key: CacheKey) -> CachedInfo:
+        row = self.cache.query_one(
+            f"SELECT sha256, date_time, tree FROM {self.table} "
+            "WHERE key = ? AND fetch_submodules = ? AND fetch_lfs = ?",
+            (key[0], int(key[1]), int(key[2])),
+        )
+        if row is None:
+            raise KeyError(key)
+        info: CachedInfo = {"sha256": row[0]}
+        if row[1] is not None:
+            info["dateTime"] = row[1]
+        if row[2] is not None:
+            info["tree"] = row[2]
+        return info
+
+    def __setitem__(self, key: CacheKey, info: CachedInfo) -> None:
+        self.cache.execute(
+            f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key[0],
+                int(key[1]),
+                int(key[2]),
+                info["sha256"],
+                info.get("dateTime"),
+                info.get("tree"),
+            ),
+        )
+
+    def __delitem__(self, key: CacheKey) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.cache.execute(
+            f"DELETE FROM {self.table} "
+            "WHERE key = ? AND fetch_submodules = ? AND fetch_lfs = ?",
+            (key[0], int(key[1]), int(key[2])),
+        )
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, tuple) or len(key) != 3:
+            return False
+        return (
+            self.cache.query_one(
+                f"SELECT 1 FROM {self.table} "
+                "WHERE key = ? AND fetch_submodules = ? AND fetch_lfs = ?",
+                (key[0], int(key[1]), int(key[2])),
+            )
+            is not None
+        )
+
+    def __iter__(self) -> Iterator[CacheKey]:
+        rows = self.cache.query_all(
+            f"SELECT key, fetch_submodules, fetch_lfs FROM {self.table}", ()
+        )
+        return iter([(row[0], bool(row[1]), bool(row[2])) for row in rows])
+
+    def __len__(self) -> int:
+        row = self.cache.query_one(f"SELECT COUNT(*) FROM {self.table}", ())
+        assert row is not None
+        return int(row[0])
+
+
+class HashCache:
+    """Content-addressed store of sha256 hashes for git revisions and trees.
+
+    `path` may be ":memory:" for a cache which only lives as long as the
+    process.  The connection is shared between threads and guarded by a lock.
+    """
+
+    def __init__(self, path: str = ":memory:") -> None:
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+        self.revs = CacheTable(self, "revs")
+        self.trees = CacheTable(self, "trees")
+
+    def migrate(self) -> None:
+        """Create the tables, or update them from an older schema version"""
+        if self.schema_version() == SCHEMA_VERSION:
+            return
+        with self._lock:
+            # Other processes may be opening the same database
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.schema_version() != SCHEMA_VERSION:
+                    columns = [
+                        row[1] for row in self._db.execute("PRAGMA table_info(revs)")
+                    ]
+                    script = SCHEMA
+                    if columns and "fetch_lfs" not in columns:
+                        script = RENAME_V0 + SCHEMA + COPY_V0
+                    for statement in script.split(";"):
+                        if statement.strip():
+                            self._db.execute(statement)
+                    self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+
+    def schema_version(self) -> int:
+        (version,) = self._db.execute("PRAGMA user_version").fetchone()
+        return int(version)
+
+    def commit(self) -> None:
+        with self._lock:
+            self._db.commit()
+
+    def backup(self, path: str) -> None:
+        """Copy the cache into a new database at `path`"""
+        with self._lock:
+            dest = sqlite3.connect(path)
+            self._db.backup(dest)
+            dest.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def execute(self, sql: str, params: Tuple[Any, ...]) -> None:
+        with self._lock:
+            self._db.execute(sql, params)
+            self._db.commit()
+
+    def query_one(self, sql: str, params: Tuple[Any, ...]) -> Optional[Tuple[Any, ...]]:
+        with self._lock:
+            row: Optional[Tuple[Any, ...]] = self._db.execute(sql, params).fetchone()
+            return row
+
+    def query_all(self, sql: str, params: Tuple[Any, ...]) -> Any:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def add(
+        self,
+        rev: str,
+        fetch_submodules: bool,
+        fetch_lfs: bool,
+        sha256: str,
+        date_time: Optional[int] = None,
+        tree: Optional[str] = None,
+        commit: bool = True,
+    ) -> None:
+        """Record the hash for a revision, merging with existing information"""
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO revs VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key, fetch_submodules, fetch_lfs) DO UPDATE SET "
+                "sha256 = excluded.sha256, "
+                "date_time = COALESCE(excluded.date_time, date_time), "
+                "tree = COALESCE(excluded.tree, tree)",
+                (rev, int(fetch_submodules), int(fetch_lfs), sha256, date_time, tree),
+            )
+            if tree is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO trees "
+                    "SELECT tree, fetch_submodules, fetch_lfs, sha256, date_time, tree "
+                    "FROM revs WHERE key = ? AND fetch_submodules = ? AND fetch_lfs = ?",
+                    (rev, int(fetch_submodules), int(fetch_lfs)),
+                )
+            if commit:
+                self._db.commit()
+
+    def record_stats(self, url: str, seconds: float, size: Optional[int]) -> None:
+        """Record how long fetching a project took, and its checkout size"""
+        self.execute(
+            "INSERT INTO project_stats VALUES (?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET "
+            "seconds = excluded.seconds, size = COALESCE(excluded.size, size)",
+            (url, seconds, size),
+        )
+
+    def stats(self, url: str) -> Tuple[Optional[float], Optional[int]]:
+        """Get the (seconds, size) recorded for the last fetch of a project"""
+        row = self.query_one(
+            "SELECT seconds, size FROM project_stats WHERE url = ?", (url,)
+        )
+        return (row[0], row[1]) if row is not None else (None, None)
+
+    def is_imported(self, filepath: str) -> bool:
+        """Whether `filepath` was already imported in its current state"""
+        st = os.stat(filepath)
+        row = self.query_one(
+            "SELECT size, mtime_ns FROM sources WHERE path = ?",
+            (os.path.abspath(filepath),),
+        )
+        return row is not None and row == (st.st_size, st.st_mtime_ns)
+
+    def mark_imported(self, filepath: str) -> None:
+        st = os.stat(filepath)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                (os.path.abspath(filepath), st.st_size, st.st_mtime_ns),
+            )
+            self._db.commit()
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""Crash-safe incremental saving of repo json files
+
+Completed projects are appended to `<filename>.journal`, one JSON record per
+line. The journal is periodically compacted into `<filename>` itself, which
+is replaced atomically, so an interrupted run never leaves a corrupt file
+behind and can be resumed by replaying the journal.
+"""
+
+from typing import Any, Dict, Optional, TextIO
+
+import copy
+import json
+import os
+import threading
+
+from robotnix_common import save
+
+
+class Journal:
+    def __init__(self, filename: str, compact_every: int = 200) -> None:
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.compact_every = compact_every
+        self.data: Dict[str, Any] = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.journal_file: Optional[TextIO] = None
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Load the saved file and replay the journal on top of it"""
+        if not os.path.exists(self.filename) and not os.path.exists(
+            self.journal_filename
+        ):
+            return None
+
+        data = json.load(open(self.filename)) if os.path.exists(self.filename) else {}
+        if os.path.exists(self.journal_filename):
+            replayed = 0
+            for line in open(self.journal_filename):
+                try:
+                    relpath, p = json.loads(line)
+                except ValueError:
+                    break  # Partially written record from an interrupted run
+                data[relpath] = p
+                replayed += 1
+            print(f"Replayed {replayed} projects from {self.journal_filename}")
+        return data
+
+    def save(self, data: Dict[str, Any]) -> None:
+        """Save a full snapshot of `data` and start a new, empty journal"""
+        with self.lock:
+            self.data = copy.deepcopy(data)
+            self._compact()
+
+    def record(self, relpath: str, p: Any) -> None:
+        """Append a completed project to the journal"""
+        line = json.dumps([relpath, p], sort_keys=True) + "\n"
+        with self.lock:
+            self.data[relpath] = copy.deepcopy(p)
+            if self.journal_file is None:
+                self.journal_file = open(self.journal_filename, "a")
+            self.journal_file.write(line)
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.pending += 1
+            if self.pending >= self.compact_every:
+                self._compact()
+
+    def _compact(self) -> None:
+        save(self.filename, self.data)
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        if os.path.exists(self.journal_filename):
+            os.unlink(self.journal_filename)
+        self.pending = 0
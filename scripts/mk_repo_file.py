@@ -2,28 +2,59 @@
 # SPDX-FileCopyrightText: 2020 Daniel Fullmer and robotnix contributors
 # SPDX-License-Identifier: MIT
 
-from typing import Any, Callable, Optional, Dict, List, Tuple, TypedDict, cast
+from typing import (
+    Any,
+    Callable,
+    Optional,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Set,
+    Tuple,
+    TypedDict,
+    cast,
+)
 from enum import Enum
 
 import argparse
+import asyncio
+import concurrent.futures
 import copy
 import json
 import multiprocessing
-import multiprocessing.pool
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import time
 from datetime import datetime
 
+from async_subprocess import AsyncRunner, parse_host_limits
+from hash_cache import CacheKey, CachedInfo, HashCache, default_cache_path
 from robotnix_common import (
+    GitCheckoutInfoDict,
+    HashMethod,
     save,
-    checkout_git,
+    checkout_git_args,
+    prefetch_git,
     ls_remote,
+    expand_ref_pattern,
+    remote_refs_missing,
+    prefetch_remote_refs,
+    load_remote_refs,
+    save_remote_refs,
     get_mirrored_url,
+    url_cache_dir,
     check_free_space,
+    tmpdir_free_space,
 )
+from git_objects import find_git_dir, lookup_remote_trees, lookup_trees
+from journal import Journal
+from nar import to_nix_base32
+from repo_manifest import UnsupportedManifest, fetch_manifest
+from scheduler import Task, estimate_task, run_longest_first
 
 REPO_FLAGS = [
     "--quiet",
@@ -39,6 +70,26 @@ class ManifestRefType(Enum):
     TAG = "tags"
 
 
+# How projects get fetched and hashed in parallel.
+# These are used for the --backend CLI arg.
+class Backend(Enum):
+    THREADS = "threads"
+    PROCESSES = "processes"
+    ASYNCIO = "asyncio"  # Subprocesses driven from a single asyncio event loop
+
+
+# How the manifest is turned into a list of projects.
+# These are used for the --manifest-engine CLI arg.
+class ManifestEngine(Enum):
+    NATIVE = "native"  # Only fetch the manifest repo, and resolve it ourselves
+    REPO = "repo"  # `repo init` and `repo dumpjson`
+
+
+# Time spent in each step for a single project. Also holds "size", the size
+# of its checkout, and "cached", whether it was found by "rev" or "tree".
+ProjectProfile = Dict[str, Any]
+
+
 class ProjectInfoDict(TypedDict, total=False):
     url: str
     rev: str
@@ -52,34 +103,473 @@ class ProjectInfoDict(TypedDict, total=False):
     linkfiles: List[Dict[str, str]]
 
 
-class CachedInfo(TypedDict, total=False):
-    sha256: str
-    dateTime: int
-    tree: str
+cache = HashCache()
+revInfo = cache.revs  # (rev, fetch_submodules, fetch_lfs) -> CachedInfo
+treeInfo = cache.trees  # (treeHash, fetch_submodules, fetch_lfs) -> CachedInfo
+
+
+def use_cache(path: str) -> None:
+    """Replace the in-memory hash cache with a persistent one at `path`"""
+    global cache, revInfo, treeInfo
+    cache.close()
+    cache = HashCache(path)
+    revInfo = cache.revs
+    treeInfo = cache.trees
+
+
+def add_to_cache(p: ProjectInfoDict, fetch_lfs: bool, commit: bool = True) -> None:
+    cache.add(
+        p["rev"],
+        p.get("fetchSubmodules", False),
+        fetch_lfs,
+        p["sha256"],
+        p.get("dateTime"),
+        p.get("tree"),
+        commit=commit,
+    )
+
+
+def path_size(path: str) -> Optional[int]:
+    """Get the total size of the files under `path`, if it exists"""
+    if not path or not os.path.exists(path):
+        return None
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            size += os.lstat(os.path.join(root, filename)).st_size
+    return size
+
+
+def is_sha1(rev: str) -> bool:
+    return re.match("[0-9a-f]{40}", rev) is not None
+
+
+def needs_ls_remote(p: ProjectInfoDict) -> bool:
+    return "rev" not in p and not is_sha1(p["revisionExpr"])
+
+
+def is_unchanged(p: ProjectInfoDict, base_p: ProjectInfoDict) -> bool:
+    """Whether project `p` is known to be at the same revision as `base_p`"""
+    if p["url"] != base_p["url"] or "rev" not in base_p:
+        return False
+    if "rev" in p:
+        return p["rev"] == base_p["rev"]
+    if is_sha1(p["revisionExpr"]):
+        return p["revisionExpr"] == base_p["rev"]
+    # Tags are not expected to move, unlike branches
+    if not p["revisionExpr"].startswith("refs/tags/"):
+        return False
+    return p["revisionExpr"] == base_p.get("revisionExpr")
+
+
+def copy_from_base(
+    data: Dict[str, ProjectInfoDict],
+    base_data: Dict[str, ProjectInfoDict],
+    project_fetch_submodules: List[str],
+) -> None:
+    """Reuse hashes of projects which are unchanged relative to `base_data`"""
+    for relpath, p in data.items():
+        base_p = base_data.get(relpath)
+        if (
+            base_p is None
+            or "sha256" in p
+            or "sha256" not in base_p
+            or base_p.get("fetchSubmodules", False)
+            != (relpath in project_fetch_submodules)
+            or not is_unchanged(p, base_p)
+        ):
+            continue
+        p["rev"] = base_p["rev"]
+        p.update(
+            cast(
+                ProjectInfoDict,
+                {
+                    key: value
+                    for key, value in base_p.items()
+                    if key in ["sha256", "dateTime", "tree", "fetchSubmodules"]
+                },
+            )
+        )
+
+
+def diff_repo_files(
+    base_data: Dict[str, ProjectInfoDict], data: Dict[str, ProjectInfoDict]
+) -> Dict[str, List[str]]:
+    changes: Dict[str, List[str]] = {
+        "unchanged": [],
+        "changed": [],
+        "added": [],
+        "removed": sorted(set(base_data) - set(data)),
+    }
+    for relpath, p in sorted(data.items()):
+        base_p = base_data.get(relpath)
+        if base_p is None:
+            changes["added"].append(relpath)
+        elif p.get("rev") == base_p.get("rev") and p["url"] == base_p["url"]:
+            changes["unchanged"].append(relpath)
+        else:
+            changes["changed"].append(relpath)
+    return changes
+
+
+def print_changes(changes: Dict[str, List[str]]) -> None:
+    print(
+        "Changes relative to base: "
+        + ", ".join(f"{len(relpaths)} {kind}" for kind, relpaths in changes.items())
+    )
+    for kind in ["changed", "added", "removed"]:
+        for relpath in changes[kind]:
+            print(f"  {kind}: {relpath}")
+
+
+def resolve_rev(p: ProjectInfoDict) -> None:
+    """Fill out the rev of a project from its revisionExpr"""
+    if is_sha1(p["revisionExpr"]):
+        # Fill out rev if we already have the information available
+        # Use revisionExpr if it is already a SHA1 hash
+        p["rev"] = p["revisionExpr"]
+        return
+
+    # Otherwise, fetch this information from the git remote
+    remote_revs = ls_remote(p["url"], [p["revisionExpr"]])
+    for resolved_rev in expand_ref_pattern(p["revisionExpr"]):
+        if resolved_rev in remote_revs:
+            p["rev"] = remote_revs[resolved_rev]
+            return
+    raise Exception(f"{p['url']} is missing {p['revisionExpr']}")
+
+
+def update_from_cache(
+    p: ProjectInfoDict,
+    table: Mapping[CacheKey, CachedInfo],
+    key: str,
+    fetch_lfs: bool,
+) -> bool:
+    """Fill out p from the cache, if `key` (a rev or tree) is in `table`"""
+    cache_key = (key, p.get("fetchSubmodules", False), fetch_lfs)
+    if cache_key not in table:
+        return False
+    p.update(cast(ProjectInfoDict, table.get(cache_key, {})))
+    return True
+
+
+def local_mirror(p: ProjectInfoDict) -> Optional[str]:
+    """Get the path of the local mirror of a project, if there is one"""
+    p_url = get_mirrored_url(p["url"])
+    if p["url"] != p_url and p_url.startswith("/"):
+        return p_url
+    return None
+
+
+def tree_lookup_args(rev: str) -> List[str]:
+    return ["git", "log", "-1", "--pretty=%T", rev]
+
+
+def checkout_rev(p: ProjectInfoDict) -> str:
+    # Use revisionExpr if it is a tag so we use the tag in the name of the
+    # nix derivation instead of the revision
+    if p["revisionExpr"].startswith("refs/tags/"):
+        return p["revisionExpr"]
+    return p["rev"]
+
 
+def apply_git_info(
+    p: ProjectInfoDict, git_info: GitCheckoutInfoDict, timings: ProjectProfile
+) -> None:
+    size = path_size(git_info["path"])
+    if size is not None:
+        timings["size"] = size
 
-revInfo: Dict[
-    Tuple[str, bool], CachedInfo
-] = {}  # (rev, fetch_submodules) -> CachedInfo
-treeInfo: Dict[
-    Tuple[str, bool], CachedInfo
-] = {}  # (treeHash, fetch_submodules) -> CachedInfo
+    p["dateTime"] = int(datetime.fromisoformat(git_info["date"]).timestamp())
+    p["sha256"] = git_info["sha256"]
 
 
-def add_to_cache(p: ProjectInfoDict) -> None:
-    revIndex = (p["rev"], p.get("fetchSubmodules", False))
+def fetch_item(
+    p: ProjectInfoDict,
+    fetch_lfs: bool,
+    hash_method: HashMethod,
+    tree: Optional[str] = None,
+) -> Tuple[ProjectInfoDict, ProjectProfile]:
+    """Fill out the sha256 of a project, from the cache or by fetching it.
 
-    cached_info: CachedInfo = revInfo.get(revIndex, {})
-    revInfo[revIndex] = cached_info
+    Returns the updated project and the time spent in each step. This may run
+    in a worker process, so the cache is only read here, never written.
+    """
+    timings: ProjectProfile = {}
 
-    cached_info.update({"sha256": p["sha256"]})
-    if "dateTime" in p:
-        cached_info.update({"dateTime": p["dateTime"]})
-    if "tree" in p:
-        cached_info.update({"tree": p["tree"]})
-        treeInfo[p["tree"], p.get("fetchSubmodules", False)] = cast(
-            CachedInfo, dict(cached_info)
+    print("Fetching information for %s %s" % (p["url"], p["rev"]))
+    # Used cached copies if available
+    if update_from_cache(p, revInfo, p["rev"], fetch_lfs):
+        timings["cached"] = "rev"
+        return p, timings
+
+    mirror = local_mirror(p)
+    if tree is not None:
+        # Already looked up in bulk, by lookup_mirror_trees or fetch_remote_trees
+        p["tree"] = tree
+    elif mirror is not None:
+        # Get treehash if mirror is local
+        start_time = time.monotonic()
+        p["tree"] = (
+            subprocess.check_output(tree_lookup_args(p["rev"]), cwd=mirror + ".git")
+            .decode()
+            .strip()
         )
+        timings["tree_lookup"] = time.monotonic() - start_time
+    if (tree is not None or mirror is not None) and update_from_cache(
+        p, treeInfo, p["tree"], fetch_lfs
+    ):
+        timings["cached"] = "tree"
+        return p, timings
+
+    start_time = time.monotonic()
+    git_info = prefetch_git(
+        get_mirrored_url(p["url"]),
+        checkout_rev(p),
+        p.get("fetchSubmodules", False),
+        fetch_lfs,
+        hash_method,
+    )
+    timings["checkout"] = time.monotonic() - start_time
+    apply_git_info(p, git_info, timings)
+
+    return p, timings
+
+
+async def fetch_item_async(
+    runner: AsyncRunner,
+    p: ProjectInfoDict,
+    fetch_lfs: bool,
+    hash_method: HashMethod,
+    tree: Optional[str] = None,
+    disk_bytes: int = 0,
+) -> ProjectProfile:
+    """Like fetch_item, but running subprocesses through `runner`
+
+    `disk_bytes` of the runner's disk budget are reserved during a checkout.
+    """
+    timings: ProjectProfile = {}
+
+    print("Fetching information for %s %s" % (p["url"], p["rev"]))
+    if update_from_cache(p, revInfo, p["rev"], fetch_lfs):
+        timings["cached"] = "rev"
+        return timings
+
+    mirror = local_mirror(p)
+    if tree is not None:
+        p["tree"] = tree
+    elif mirror is not None:
+        start_time = time.monotonic()
+        output = await runner.run(tree_lookup_args(p["rev"]), cwd=mirror + ".git")
+        p["tree"] = output.decode().strip()
+        timings["tree_lookup"] = time.monotonic() - start_time
+    if (tree is not None or mirror is not None) and update_from_cache(
+        p, treeInfo, p["tree"], fetch_lfs
+    ):
+        timings["cached"] = "tree"
+        return timings
+
+    start_time = time.monotonic()
+    p_url = get_mirrored_url(p["url"])
+    fetch_submodules = p.get("fetchSubmodules", False)
+    git_info: GitCheckoutInfoDict
+    async with runner.disk(disk_bytes):
+        if hash_method == HashMethod.NIX_PREFETCH_GIT:
+            print("Checking out %s %s" % (p_url, checkout_rev(p)))
+            args = checkout_git_args(
+                p_url, checkout_rev(p), fetch_submodules, fetch_lfs
+            )
+            output = await runner.run(args, url=p_url, heavy=True)
+            git_info = json.loads(output)
+        else:
+            async with runner.heavy:
+                git_info = await asyncio.to_thread(
+                    prefetch_git,
+                    p_url,
+                    checkout_rev(p),
+                    fetch_submodules,
+                    fetch_lfs,
+                    hash_method,
+                )
+    timings["checkout"] = time.monotonic() - start_time
+    apply_git_info(p, git_info, timings)
+
+    return timings
+
+
+async def prefetch_remote_refs_async(
+    runner: AsyncRunner, patterns: Dict[str, Set[str]]
+) -> None:
+    """List the refs named by `patterns` (url: revisionExprs) of each remote"""
+
+    async def list_remote_refs(url: str) -> None:
+        await runner.run_in_thread(url, ls_remote, url, patterns[url])
+
+    urls = sorted(url for url in patterns if remote_refs_missing(url, patterns[url]))
+    if urls:
+        print(f"Listing refs of {len(urls)} remotes")
+        await asyncio.gather(*(list_remote_refs(url) for url in urls))
+
+
+def lookup_mirror_trees(items: List[Tuple[str, ProjectInfoDict]]) -> Dict[str, str]:
+    """Find the tree hashes of all projects with local mirrors in one pass"""
+    git_dirs = set()
+    revs = set()
+    for _, p in items:
+        mirror = local_mirror(p)
+        if "sha256" in p or mirror is None:
+            continue
+        git_dir = find_git_dir(mirror)
+        if git_dir is None:
+            continue
+        if "rev" not in p:
+            resolve_rev(p)
+        git_dirs.add(git_dir)
+        revs.add(p["rev"])
+    if not revs:
+        return {}
+
+    print(f"Looking up trees of {len(revs)} revisions in local mirrors")
+    return lookup_trees(git_dirs, revs)
+
+
+def fetch_remote_trees(
+    items: List[Tuple[str, ProjectInfoDict]], jobs: int = 1, fetch_lfs: bool = True
+) -> Dict[str, str]:
+    """Find the tree hashes of projects without local mirrors
+
+    Only the commits are fetched, which is cheap compared to a checkout, so
+    projects whose tree was already hashed under another revision (e.g. in a
+    fork) can be found in the cache. Nothing is fetched while the tree cache
+    is empty.
+    """
+    revs: Dict[str, Set[str]] = {}
+    for _, p in items:
+        if (
+            "sha256" in p
+            or local_mirror(p) is not None
+            or (p["rev"], p.get("fetchSubmodules", False), fetch_lfs) in revInfo
+        ):
+            continue
+        revs.setdefault(p["url"], set()).add(p["rev"])
+    if not revs or len(treeInfo) == 0:
+        return {}
+
+    print(f"Fetching commits of {sum(map(len, revs.values()))} revisions to find trees")
+    trees: Dict[str, str] = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        futures = [
+            executor.submit(
+                lookup_remote_trees,
+                url_cache_dir("commits", url),
+                get_mirrored_url(url),
+                url_revs,
+            )
+            for url, url_revs in sorted(revs.items())
+        ]
+        for future in futures:
+            trees.update(future.result())
+    return trees
+
+
+def init_worker(cache_path: str) -> None:
+    global cache, revInfo, treeInfo
+    # Don't touch the connection inherited from the parent, if any
+    cache = HashCache(cache_path)
+    revInfo = cache.revs
+    treeInfo = cache.trees
+
+
+def write_profile(
+    filename: str,
+    profile: Dict[str, ProjectProfile],
+    prefetch_time: float,
+    wall_time: float,
+) -> None:
+    totals: Dict[str, float] = {"ls_remote_prefetch": prefetch_time}
+    for timings in profile.values():
+        for step in ["ls_remote", "tree_lookup", "checkout"]:
+            totals[step] = totals.get(step, 0) + timings.get(step, 0)
+    save(
+        filename,
+        {"wall_time": wall_time, "totals": totals, "projects": profile},
+    )
+
+    print(f"Finished in {wall_time:.0f}s. Time spent per step, summed over projects:")
+    for step, seconds in totals.items():
+        print(f"  {step}: {seconds:.0f}s")
+    print("Slowest projects:")
+    slowest = sorted(profile.items(), key=lambda i: i[1]["total"], reverse=True)
+    for relpath, timings in slowest[:10]:
+        print(f"  {relpath}: {timings['total']:.0f}s")
+
+
+def load_manifest(
+    url: str,
+    ref: str,
+    ref_type: ManifestRefType,
+    local_manifests: List[str],
+    local_only: bool,
+    manifest_engine: ManifestEngine,
+) -> Dict[str, ProjectInfoDict]:
+    """Get the projects of the manifest at `ref`, as produced by `repo dumpjson`"""
+    print("Fetching information for %s %s" % (url, ref))
+    if manifest_engine == ManifestEngine.NATIVE:
+        try:
+            return cast(
+                Dict[str, ProjectInfoDict],
+                fetch_manifest(
+                    str(url),
+                    f"refs/{ref_type.value}/{ref}",
+                    local_manifests=local_manifests,
+                ),
+            )
+        except UnsupportedManifest as e:
+            print(f"Falling back to repo: {e}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subprocess.check_call(
+            [
+                "repo",
+                "init",
+                f"--manifest-url={url}",
+                f"--manifest-branch=refs/{ref_type.value}/{ref}",
+                *REPO_FLAGS,
+            ],
+            cwd=tmpdir,
+            stdin=open("/dev/null"),
+        )  # repo becomes non-interactive when a file is attached to stdin
+
+        local_manifests_dir = os.path.join(tmpdir, ".repo/local_manifests")
+        os.makedirs(local_manifests_dir, exist_ok=True)
+        for local_manifest in local_manifests:
+            shutil.copyfile(
+                local_manifest,
+                os.path.join(local_manifests_dir, os.path.basename(local_manifest)),
+            )
+
+        json_text = subprocess.check_output(
+            ["repo", "dumpjson"] + (["--local-only"] if local_only else []),
+            cwd=tmpdir,
+        ).decode()
+        return cast(Dict[str, ProjectInfoDict], json.loads(json_text))
+
+
+class RefSpec(NamedTuple):
+    """A manifest ref to make a repo file for, and where its results go"""
+
+    ref: str
+    prev_data: Optional[Dict[str, ProjectInfoDict]] = None
+    override_tag: Optional[str] = None
+    callback: Optional[Callable[[Any], Any]] = None
+    progress: Optional[Callable[[str, ProjectInfoDict], Any]] = None
+
+
+# A project of one of the refs: (index into refs, relpath, project info)
+RefItem = Tuple[int, str, ProjectInfoDict]
+
+# Keys filled out by fetching a project, shared by all projects at a revision
+FETCHED_KEYS = ["sha256", "dateTime", "tree"]
 
 
 def make_repo_file(
@@ -87,6 +577,7 @@ def make_repo_file(
     ref: str,
     ref_type: ManifestRefType = ManifestRefType.TAG,
     prev_data: Optional[Dict[str, ProjectInfoDict]] = None,
+    base_data: Optional[Dict[str, ProjectInfoDict]] = None,
     local_manifests: Optional[List[str]] = None,
     override_project_revs: Optional[Dict[str, str]] = None,
     project_fetch_submodules: Optional[List[str]] = None,
@@ -94,9 +585,67 @@ def make_repo_file(
     include_prefix: Optional[List[str]] = None,
     exclude_path: Optional[List[str]] = None,
     callback: Optional[Callable[[Any], Any]] = None,
+    progress: Optional[Callable[[str, ProjectInfoDict], Any]] = None,
     jobs: int = 1,
     fetch_lfs: bool = True,
+    hash_method: HashMethod = HashMethod.NIX_PREFETCH_GIT,
+    backend: Backend = Backend.THREADS,
+    profile_path: Optional[str] = None,
+    host_limits: Optional[Dict[str, int]] = None,
+    manifest_engine: ManifestEngine = ManifestEngine.NATIVE,
+    remote_trees: bool = False,
 ) -> Dict[str, ProjectInfoDict]:
+    return make_repo_files(
+        url,
+        [RefSpec(ref, prev_data, override_tag, callback, progress)],
+        ref_type,
+        base_data=base_data,
+        local_manifests=local_manifests,
+        override_project_revs=override_project_revs,
+        project_fetch_submodules=project_fetch_submodules,
+        include_prefix=include_prefix,
+        exclude_path=exclude_path,
+        jobs=jobs,
+        fetch_lfs=fetch_lfs,
+        hash_method=hash_method,
+        backend=backend,
+        profile_path=profile_path,
+        host_limits=host_limits,
+        manifest_engine=manifest_engine,
+        remote_trees=remote_trees,
+    )[0]
+
+
+def make_repo_files(
+    url: str,
+    refs: List[RefSpec],
+    ref_type: ManifestRefType = ManifestRefType.TAG,
+    base_data: Optional[Dict[str, ProjectInfoDict]] = None,
+    local_manifests: Optional[List[str]] = None,
+    override_project_revs: Optional[Dict[str, str]] = None,
+    project_fetch_submodules: Optional[List[str]] = None,
+    include_prefix: Optional[List[str]] = None,
+    exclude_path: Optional[List[str]] = None,
+    jobs: int = 1,
+    fetch_lfs: bool = True,
+    hash_method: HashMethod = HashMethod.NIX_PREFETCH_GIT,
+    backend: Backend = Backend.THREADS,
+    profile_path: Optional[str] = None,
+    host_limits: Optional[Dict[str, int]] = None,
+    manifest_engine: ManifestEngine = ManifestEngine.NATIVE,
+    remote_trees: bool = False,
+) -> List[Dict[str, ProjectInfoDict]]:
+    """Make the repo files of several refs of a manifest in a single run
+
+    Remotes are listed once for all refs, and projects are deduplicated by
+    (rev, fetchSubmodules), so a revision shared by several refs is only
+    fetched once. Returns the data of each ref, in the order of `refs`.
+
+    If `remote_trees` is set, the trees of projects without local mirrors
+    are found with fetch_remote_trees, to look them up in the tree cache.
+    This costs a fetch per remote project, and the fetched commits are kept
+    under the "commits" cache directory, so it is off by default.
+    """
     if local_manifests is None:
         local_manifests = []
     if override_project_revs is None:
@@ -108,63 +657,38 @@ def make_repo_file(
     if exclude_path is None:
         exclude_path = []
 
-    data: Dict[str, ProjectInfoDict]
-
-    if prev_data is not None:
-        data = copy.deepcopy(prev_data)
-    else:
-        data = {}
-
-        print("Fetching information for %s %s" % (url, ref))
-        with tempfile.TemporaryDirectory() as tmpdir:
-            subprocess.check_call(
-                [
-                    "repo",
-                    "init",
-                    f"--manifest-url={url}",
-                    f"--manifest-branch=refs/{ref_type.value}/{ref}",
-                    *REPO_FLAGS,
-                ],
-                cwd=tmpdir,
-                stdin=open("/dev/null"),
-            )  # repo becomes non-interactive when a file is attached to stdin
-
-            local_manifests_dir = os.path.join(tmpdir, ".repo/local_manifests")
-            os.makedirs(local_manifests_dir, exist_ok=True)
-            for local_manifest in local_manifests:
-                shutil.copyfile(
-                    local_manifest,
-                    os.path.join(local_manifests_dir, os.path.basename(local_manifest)),
-                )
-
-            json_text = subprocess.check_output(
-                ["repo", "dumpjson"]
-                + (["--local-only"] if override_project_revs else []),
-                cwd=tmpdir,
-            ).decode()
-            data = json.loads(json_text)
-
-            if callback is not None:
-                callback(data)
+    datas: List[Dict[str, ProjectInfoDict]] = []
+    for spec in refs:
+        if spec.prev_data is not None:
+            data = copy.deepcopy(spec.prev_data)
+        else:
+            data = load_manifest(
+                url,
+                spec.ref,
+                ref_type,
+                local_manifests,
+                bool(override_project_revs),
+                manifest_engine,
+            )
+        if spec.callback is not None:
+            spec.callback(data)
+        datas.append(data)
 
-    pool = multiprocessing.pool.ThreadPool(jobs)
-    cb_lock = multiprocessing.Lock()
-
-    def process_item(item: Tuple[str, ProjectInfoDict]) -> None:
+    def prepare_item(
+        relpath: str, p: ProjectInfoDict, override_tag: Optional[str]
+    ) -> bool:
+        """Apply overrides to a project. Returns False if it is filtered out"""
         assert override_project_revs is not None
-        assert project_fetch_submodules is not None
         assert include_prefix is not None
         assert exclude_path is not None
 
-        relpath, p = item
-
         if len(include_prefix) > 0 and (
             not any(relpath.startswith(p) for p in include_prefix)
         ):
-            return
+            return False
 
         if relpath in exclude_path:
-            return
+            return False
 
         for project, rev in override_project_revs.items():
             # We have to iterate over the whole output since we don't save
@@ -176,103 +700,267 @@ def make_repo_file(
         if override_tag is not None:
             p["revisionExpr"] = override_tag
 
+        return True
+
+    profile: Dict[str, ProjectProfile] = {}
+    executor: Optional[concurrent.futures.Executor] = None
+    snapshot_dir: Optional[str] = None
+    if backend == Backend.PROCESSES:
+        worker_cache_path = cache.path
+        if worker_cache_path == ":memory:":
+            # Worker processes cannot see an in-memory cache, give them a copy
+            snapshot_dir = tempfile.mkdtemp()
+            worker_cache_path = os.path.join(snapshot_dir, "cache.sqlite")
+            cache.backup(worker_cache_path)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(worker_cache_path,),
+        )
+
+    def profile_key(index: int, relpath: str) -> str:
+        return relpath if len(refs) == 1 else f"{refs[index].ref}:{relpath}"
+
+    def start_item(relpath: str, p: ProjectInfoDict) -> ProjectProfile:
+        assert project_fetch_submodules is not None
+
+        timings: ProjectProfile = {}
         if "rev" not in p:
-            if re.match("[0-9a-f]{40}", p["revisionExpr"]):
-                # Fill out rev if we already have the information available
-                # Use revisionExpr if it is already a SHA1 hash
-                p["rev"] = p["revisionExpr"]
-            else:
-                # Otherwise, fetch this information from the git remote
-                remote_revs = ls_remote(p["url"])
-                if p["revisionExpr"] in remote_revs:
-                    resolved_rev = p["revisionExpr"]
-                elif ("refs/tags/" + p["revisionExpr"]) in remote_revs:
-                    resolved_rev = "refs/tags/" + p["revisionExpr"]
-                elif ("refs/heads/" + p["revisionExpr"]) in remote_revs:
-                    resolved_rev = "refs/heads/" + p["revisionExpr"]
-                else:
-                    raise Exception(f"{p['url']} is missing {p['revisionExpr']}")
-                p["rev"] = remote_revs[resolved_rev]
+            start_time = time.monotonic()
+            resolve_rev(p)
+            timings["ls_remote"] = time.monotonic() - start_time
 
         # TODO: Incorporate "sync-s" setting from upstream manifest if it exists
-        fetch_submodules = relpath in project_fetch_submodules
-
-        if fetch_submodules:
+        if relpath in project_fetch_submodules:
             p["fetchSubmodules"] = True
 
+        return timings
+
+    def finish_item(item: RefItem, timings: ProjectProfile) -> None:
+        index, relpath, p = item
+        # Time spent in the queue is not included
+        timings["total"] = (
+            time.monotonic() - timings.pop("start") + timings.get("ls_remote", 0)
+        )
+        profile[profile_key(index, relpath)] = timings
+
+        progress = refs[index].progress
+        if progress is not None and "sha256" in p:
+            progress(relpath, p)
+
+    def finish_group(group: List[RefItem], timings: ProjectProfile) -> None:
+        """Record the result of the first project of `group` for all of them"""
+        _, _, p = group[0]
+        if "checkout" in timings:
+            cache.record_stats(p["url"], timings["checkout"], timings.get("size"))
+        if "sha256" in p:
+            add_to_cache(p, fetch_lfs)
+
+        finish_item(group[0], timings)
+        for item in group[1:]:
+            _, _, other = item
+            start_time = time.monotonic()
+            other.update(
+                cast(ProjectInfoDict, {k: v for k, v in p.items() if k in FETCHED_KEYS})
+            )
+            finish_item(
+                item, {**start_timings[id(other)], "start": start_time, "cached": "ref"}
+            )
+
+    def process_group(group: List[RefItem]) -> None:
+        _, _, p = group[0]
+        timings = {**start_timings[id(p)], "start": time.monotonic()}
         if "sha256" not in p:
-            print("Fetching information for %s %s" % (p["url"], p["rev"]))
-            # Used cached copies if available
-            if (p["rev"], fetch_submodules) in revInfo:
-                p.update(
-                    cast(ProjectInfoDict, revInfo.get((p["rev"], fetch_submodules), {}))
+            if executor is not None:
+                future = executor.submit(
+                    fetch_item, p, fetch_lfs, hash_method, known_trees.get(p["rev"])
                 )
-                return
-
-            p_url = get_mirrored_url(p["url"])
-            found_treehash = False
-            if p["url"] != p_url and p_url.startswith("/"):
-                # Get treehash if mirror is local
-                p["tree"] = (
-                    subprocess.check_output(
-                        ["git", "log", "-1", "--pretty=%T", p["rev"]],
-                        cwd=p_url + ".git",
-                    )
-                    .decode()
-                    .strip()
+                result, fetch_timings = future.result()
+                p.update(result)
+            else:
+                _, fetch_timings = fetch_item(
+                    p, fetch_lfs, hash_method, known_trees.get(p["rev"])
                 )
-                if (p["tree"], fetch_submodules) in treeInfo:
-                    p.update(
-                        cast(
-                            ProjectInfoDict,
-                            treeInfo.get((p["tree"], fetch_submodules), {}),
-                        )
-                    )
-                    found_treehash = True
-            if found_treehash:
-                return
-
-            # Fetch information. Use revisionExpr if it is a tag so we use the
-            # tag in the name of the nix derivation instead of the revision
-            if p["revisionExpr"].startswith("refs/tags/"):
-                git_info = checkout_git(
-                    p_url, p["revisionExpr"], fetch_submodules, fetch_lfs
+            timings.update(fetch_timings)
+        finish_group(group, timings)
+
+    async def process_groups_async(
+        tasks: List[Task], disk_budget: Optional[int]
+    ) -> None:
+        runner = AsyncRunner(jobs, host_limits, disk_budget=disk_budget)
+
+        async def process_group_async(task: Task) -> None:
+            group: List[RefItem] = task.item
+            _, _, p = group[0]
+            timings = {**start_timings[id(p)], "start": time.monotonic()}
+            if "sha256" not in p:
+                fetch_timings = await fetch_item_async(
+                    runner,
+                    p,
+                    fetch_lfs,
+                    hash_method,
+                    known_trees.get(p["rev"]),
+                    task.disk_bytes,
                 )
-            else:
-                git_info = checkout_git(p_url, p["rev"], fetch_submodules, fetch_lfs)
+                timings.update(fetch_timings)
+            finish_group(group, timings)
+
+        # Heavy commands are queued in the order tasks are started
+        tasks = sorted(tasks, key=lambda t: t.cost, reverse=True)
+        await asyncio.gather(*(process_group_async(t) for t in tasks))
+
+    items: List[RefItem] = [
+        (index, relpath, p)
+        for index, data in enumerate(datas)
+        for relpath, p in data.items()
+        if prepare_item(relpath, p, refs[index].override_tag)
+    ]
+
+    if base_data is not None:
+        # Projects at the same revision as in the base file need no work at
+        # all, and changed projects may still resolve to a hashed revision
+        for p in base_data.values():
+            if "sha256" in p and "rev" in p:
+                add_to_cache(p, fetch_lfs, commit=False)
+        cache.commit()
+        for index in range(len(datas)):
+            copy_from_base(
+                {relpath: p for i, relpath, p in items if i == index},
+                base_data,
+                project_fetch_submodules,
+            )
+        items = [item for item in items if "sha256" not in item[2]]
+        print(f"{len(items)} projects differ from base file")
+
+    # Resolve all remotes up front, so workers don't block on ls-remote
+    run_start_time = time.monotonic()
+    patterns: Dict[str, Set[str]] = {}
+    for _, _, p in items:
+        if needs_ls_remote(p):
+            patterns.setdefault(p["url"], set()).add(p["revisionExpr"])
+    if backend == Backend.ASYNCIO:
+        runner = AsyncRunner(jobs, host_limits)
+        asyncio.run(prefetch_remote_refs_async(runner, patterns))
+    else:
+        prefetch_remote_refs(patterns.keys(), jobs=jobs, patterns=patterns)
+    # Avoid spawning a git process per project to find the trees of local mirrors
+    known_trees = lookup_mirror_trees([(relpath, p) for _, relpath, p in items])
 
-            p["dateTime"] = int(datetime.fromisoformat(git_info["date"]).timestamp())
-            p["sha256"] = git_info["sha256"]
+    # With all revisions known, each (rev, fetchSubmodules) only needs to be
+    # fetched once, for whichever ref has it first (or already has a hash)
+    start_timings: Dict[int, ProjectProfile] = {}
+    groups: Dict[Tuple[str, bool], List[RefItem]] = {}
+    for item in items:
+        _, relpath, p = item
+        start_timings[id(p)] = start_item(relpath, p)
+        group = groups.setdefault((p["rev"], p.get("fetchSubmodules", False)), [])
+        if "sha256" in p:
+            group.insert(0, item)
+        else:
+            group.append(item)
+    if len(refs) > 1:
+        print(f"{len(groups)} unique revisions among {len(items)} projects")
+    if remote_trees:
+        known_trees.update(
+            fetch_remote_trees(
+                [group[0][1:] for group in groups.values()], jobs, fetch_lfs
+            )
+        )
+    prefetch_time = time.monotonic() - run_start_time
+
+    # Start the longest-running projects first. Unless hashing directly from
+    # git objects, hold back checkouts which would likely run $TMPDIR out of space
+    disk_budget = None
+    if hash_method != HashMethod.GIT_OBJECTS:
+        disk_budget = tmpdir_free_space()[1] * 8 // 10
+    tasks = [
+        estimate_task(group, group[0][1], *cache.stats(group[0][2]["url"]))
+        for group in groups.values()
+    ]
+    try:
+        if backend == Backend.ASYNCIO:
+            asyncio.run(process_groups_async(tasks, disk_budget))
+        else:
+            run_longest_first(process_group, tasks, jobs, disk_budget)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if snapshot_dir is not None:
+            shutil.rmtree(snapshot_dir)
+
+    if profile_path is not None:
+        write_profile(
+            profile_path, profile, prefetch_time, time.monotonic() - run_start_time
+        )
+
+    for spec, data in zip(refs, datas):
+        # Save at the end as well!
+        if spec.callback is not None:
+            spec.callback(data)
+
+        if base_data is not None:
+            if len(refs) > 1:
+                print(f"{spec.ref}:")
+            print_changes(diff_repo_files(base_data, data))
 
-            add_to_cache(p)
+    return datas
 
-            with cb_lock:
-                if callback is not None:
-                    callback(data)
 
-    pool.map(process_item, data.items())
+def lockfile_projects(data: Dict[str, Any]) -> List[Tuple[ProjectInfoDict, bool]]:
+    """Get the hashed projects of a repo.lock file, like in a repo json file,
+    along with whether each was fetched with LFS"""
+    projects = []
+    for entry in data.get("entries", {}).values():
+        lock = entry.get("lock")
+        if not lock or "nix_hash" not in lock:
+            continue
+        repo_ref = entry["project"]["repo_ref"]
+        p: ProjectInfoDict = {
+            "url": repo_ref["repo_url"],
+            "rev": lock["commit"],
+            "sha256": lock["nix_hash"],
+            "fetchSubmodules": repo_ref.get("fetch_submodules", False),
+        }
+        if "date" in lock:
+            p["dateTime"] = lock["date"]
+        projects.append((p, repo_ref.get("fetch_lfs", False)))
+    return projects
 
-    # Save at the end as well!
-    if callback is not None:
-        callback(data)
 
-    return data
+def is_cached_repo_file(filename: str) -> bool:
+    return (
+        filename.startswith("repo-")
+        and filename.endswith(".json")
+        or filename in ("repo.json", "repo.lock")
+    )
 
 
 def read_cached_repo_json(path: str) -> None:
+    """Import the hashes of all repo json files and repo.lock files under `path`
+
+    Repo json files don't record whether LFS was used, so like mk_repo_file
+    by default, they are assumed to be fetched with LFS.
+    """
     for root, dirs, files in os.walk(path):
         for filename in files:
-            if (
-                filename.startswith("repo-")
-                and filename.endswith(".json")
-                or filename == "repo.json"
-            ):
+            if is_cached_repo_file(filename):
                 filepath = os.path.join(root, filename)
+                if cache.is_imported(filepath):
+                    # Already indexed and unchanged since
+                    continue
                 print(f"Loading cached sha256s from {filepath}")
                 data = json.load(open(filepath))
-                for name, p in data.items():
-                    if "sha256" in p:
-                        add_to_cache(p)
+                if filename == "repo.lock":
+                    projects = lockfile_projects(data)
+                else:
+                    projects = [(p, True) for p in data.values()]
+                for p, fetch_lfs in projects:
+                    if "sha256" in p and "rev" in p:
+                        # Lockfiles use SRI hashes, unlike nix-prefetch-git
+                        p["sha256"] = to_nix_base32(p["sha256"])
+                        add_to_cache(p, fetch_lfs, commit=False)
+                cache.mark_imported(filepath)
 
 
 def main() -> None:
@@ -280,7 +968,11 @@ def main() -> None:
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--out", default=None, help="path to output file, defaults to repo-{rev}.json"
+        "--out",
+        action="append",
+        default=[],
+        help="path to output file, defaults to repo-{ref}.json. "
+        + "With several refs, give it once per ref",
     )
     parser.add_argument(
         "--ref-type",
@@ -291,6 +983,11 @@ def main() -> None:
     parser.add_argument(
         "--resume", help="resume a previous download", action="store_true"
     )
+    parser.add_argument(
+        "--base",
+        help="previous repo json file to diff against. Projects at unchanged "
+        + "revisions are copied over instead of being fetched again",
+    )
     parser.add_argument(
         "--local-manifest",
         help="path or URL to a .xml file to include in local_manifests",
@@ -302,16 +999,77 @@ def main() -> None:
         default=[],
         help="path to search for any existing repo json files to use for cached sha256s",
     )
+    parser.add_argument(
+        "--cache-db",
+        default=default_cache_path(),
+        help="path to the persistent sha256 cache database",
+    )
+    parser.add_argument(
+        "--no-cache-db",
+        action="store_true",
+        help="only keep cached sha256s in memory for this run",
+    )
+    parser.add_argument(
+        "--ls-remote-cache",
+        help="path to a file caching the refs of remotes between runs",
+    )
+    parser.add_argument(
+        "--ls-remote-ttl",
+        default=3600,
+        type=int,
+        help="number of seconds entries in --ls-remote-cache stay valid",
+    )
     parser.add_argument(
         "--repo-prop", help="repo.prop file to use as source for project git revisions"
     )
     parser.add_argument(
         "--override-tag",
-        help="tag to fetch for subrepos, ignoring revisions from manifest",
+        action="append",
+        default=[],
+        help="tag to fetch for subrepos, ignoring revisions from manifest. "
+        + "With several refs, give it once for all refs or once per ref",
     )
     parser.add_argument(
         "--disable-lfs", action="store_true", help="disables Git LFS support"
     )
+    parser.add_argument(
+        "--hash-method",
+        help="how to compute project hashes: using nix-prefetch-git, directly "
+        + "from git objects without a checkout, or both and cross-checking them",
+        choices=[m.value for m in HashMethod],
+        default=HashMethod.NIX_PREFETCH_GIT.value,
+    )
+    parser.add_argument(
+        "--backend",
+        help="run fetches in threads, in separate processes, or as asyncio "
+        + "subprocesses with per-host concurrency limits",
+        choices=[b.value for b in Backend],
+        default=Backend.THREADS.value,
+    )
+    parser.add_argument(
+        "--manifest-engine",
+        help="resolve the manifest natively, fetching only the manifest repo, "
+        + "or with `repo init` and `repo dumpjson`",
+        choices=[e.value for e in ManifestEngine],
+        default=ManifestEngine.NATIVE.value,
+    )
+    parser.add_argument(
+        "--remote-trees",
+        action="store_true",
+        help="fetch the commits of remotes without local mirrors to look up "
+        + "their trees in the cache. The commits are kept in the cache directory",
+    )
+    parser.add_argument(
+        "--host-limit",
+        action="append",
+        default=[],
+        help="maximum concurrent commands for a remote host with the asyncio "
+        + "backend, as HOST=N",
+    )
+    parser.add_argument(
+        "--profile",
+        help="path to write a report of the time spent on each project to",
+    )
     parser.add_argument(
         "--project-fetch-submodules",
         action="append",
@@ -338,9 +1096,19 @@ def main() -> None:
         help="number of concurrent jobs",
     )
     parser.add_argument("url", help="manifest URL")
-    parser.add_argument("ref", help="manifest ref")
+    parser.add_argument(
+        "ref",
+        nargs="+",
+        help="manifest refs. Several refs are fetched together, sharing the "
+        + "work for projects at the same revision",
+    )
     args = parser.parse_args()
 
+    if args.out and len(args.out) != len(args.ref):
+        parser.error("--out must be given once per ref")
+    if len(args.override_tag) > 1 and len(args.override_tag) != len(args.ref):
+        parser.error("--override-tag must be given once, or once per ref")
+
     ref_type = ManifestRefType[args.ref_type.upper()]
 
     # Extract project revisions from repo.prop
@@ -352,36 +1120,57 @@ def main() -> None:
                 project, rev = line.split()
                 override_project_revs[project] = rev
 
-    # Walk all cache_search_paths files to populate hashtables
+    if not args.no_cache_db:
+        use_cache(args.cache_db)
+
+    # Walk all cache_search_paths files to import any new or changed lockfiles
     for path in args.cache_search_path:
         read_cached_repo_json(path)
 
-    if args.out is not None:
-        filename = args.out
-    else:
-        filename = f"repo-{args.ref}.json"
+    filenames = args.out or [f"repo-{ref}.json" for ref in args.ref]
+    override_tags = args.override_tag or [None]
+    if len(override_tags) == 1:
+        override_tags = override_tags * len(args.ref)
 
-    if args.resume and os.path.exists(filename):
-        prev_data = json.load(open(filename))
-    else:
-        prev_data = None
+    refs = []
+    for ref, filename, override_tag in zip(args.ref, filenames, override_tags):
+        journal = Journal(filename)
+        refs.append(
+            RefSpec(
+                ref,
+                prev_data=journal.load() if args.resume else None,
+                override_tag=override_tag,
+                callback=journal.save,
+                progress=journal.record,
+            )
+        )
 
-    make_repo_file(
+    if args.ls_remote_cache is not None:
+        load_remote_refs(args.ls_remote_cache, args.ls_remote_ttl)
+
+    make_repo_files(
         args.url,
-        args.ref,
+        refs,
         ref_type,
-        prev_data,
+        base_data=json.load(open(args.base)) if args.base is not None else None,
         local_manifests=args.local_manifest,
         override_project_revs=override_project_revs,
         project_fetch_submodules=args.project_fetch_submodules,
-        override_tag=args.override_tag,
         include_prefix=args.include_prefix,
         exclude_path=args.exclude_path,
-        callback=lambda dirs: save(filename, dirs),
         jobs=args.jobs,
         fetch_lfs=not args.disable_lfs,
+        hash_method=HashMethod(args.hash_method),
+        backend=Backend(args.backend),
+        profile_path=args.profile,
+        host_limits=parse_host_limits(args.host_limit),
+        manifest_engine=ManifestEngine(args.manifest_engine),
+        remote_trees=args.remote_trees,
     )
 
+    if args.ls_remote_cache is not None:
+        save_remote_refs(args.ls_remote_cache)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""Tools for the module-info.json file produced by the Android build
+
+module-info.json is read incrementally, one module at a time, so memory use
+does not grow with the size of the whole document. It can also be converted
+into an SQLite index, which answers lookups of module names without reading
+the whole file again. Commands which take a module-info file accept either.
+"""
+
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+import argparse
+import concurrent.futures
+import fcntl
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# A module name, preceded by the opening brace or a separating comma
+KEY = re.compile(r'\s*[{,]\s*("(?:[^"\\]|\\.)*")\s*:\s*', re.S)
+END = re.compile(r"\s*(\{\s*)?}\s*\Z")
+
+# Fields of each module which are kept in the index
+INDEXED_FIELDS = ("class", "path", "installed")
+
+SCHEMA = """
+CREATE TABLE modules (
+    name TEXT PRIMARY KEY,
+    class TEXT NOT NULL,
+    path TEXT NOT NULL,
+    installed TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+SQLITE_MAGIC = b"SQLite format 3\0"
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+QUERY_BATCH_SIZE = 500
+
+
+def iter_module_info(
+    f: TextIO, names: Optional[Collection[str]] = None, chunk_size: int = CHUNK_SIZE
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield (name, info) for the modules of a module-info.json file
+
+    Modules are decoded one at a time, as the file is read in chunks. If
+    `names` is given, only those modules are returned and the scan stops once
+    all of them have been found.
+    """
+    remaining = None if names is None else set(names)
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    while remaining is None or remaining:
+        match = KEY.match(buf, pos)
+        if match is not None:
+            try:
+                value, end = decoder.raw_decode(buf, match.end())
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                match = None
+        if match is None:
+            if eof:
+                if END.match(buf, pos):
+                    return
+                raise ValueError("Invalid or truncated module-info.json")
+            # Read more data, dropping what has already been decoded
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        pos = end
+        name = json.loads(match.group(1))
+        if remaining is None or name in remaining:
+            if remaining is not None:
+                remaining.discard(name)
+            yield name, value
+
+
+def build_index(module_info: TextIO, filename: str) -> None:
+    """Write an SQLite index of `module_info` to `filename`
+
+    Each indexed field is stored as a JSON list. The database is built under
+    $TMPDIR and then moved into place, so nothing but the finished index is
+    ever created next to `filename`, e.g. in /nix/store.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_filename = os.path.join(tmpdir, "index.sqlite")
+        db = sqlite3.connect(tmp_filename)
+        try:
+            db.executescript(SCHEMA)
+            db.executemany(
+                "INSERT OR REPLACE INTO modules VALUES (?, ?, ?, ?)",
+                (
+                    (
+                        name,
+                        *(json.dumps(info.get(field, [])) for field in INDEXED_FIELDS),
+                    )
+                    for name, info in iter_module_info(module_info)
+                ),
+            )
+            db.commit()
+        finally:
+            db.close()
+        shutil.move(tmp_filename, filename)
+
+
+class ModuleIndex:
+    """Read-only access to an index written by build_index"""
+
+    def __init__(self, filename: str) -> None:
+        self._db = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> "ModuleIndex":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def lookup(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Return the indexed fields of each module in `names` which exists"""
+        names = list(dict.fromkeys(names))
+        result = {}
+        for start in range(0, len(names), QUERY_BATCH_SIZE):
+            end = start + QUERY_BATCH_SIZE
+            batch = names[start:end]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self._db.execute(
+                f"SELECT name, {', '.join(INDEXED_FIELDS)} FROM modules "
+                f"WHERE name IN ({placeholders})",
+                batch,
+            )
+            for row in rows:
+                result[row[0]] = {
+                    field: json.loads(value)
+                    for field, value in zip(INDEXED_FIELDS, row[1:])
+                }
+        return result
+
+
+def is_index(filename: str) -> bool:
+    with open(filename, "rb") as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def lookup_modules(filename: str, names: Collection[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up `names` in either a module-info.json file or an index of it"""
+    if is_index(filename):
+        with ModuleIndex(filename) as index:
+            return index.lookup(names)
+    with open(filename) as f:
+        return {
+            name: {field: info.get(field, []) for field in INDEXED_FIELDS}
+            for name, info in iter_module_info(f, names)
+        }
+
+
+def installed_outputs(
+    modules: Dict[str, Dict[str, Any]], outdir: str
+) -> Dict[str, str]:
+    """Map output paths under `outdir` to the installed files of `modules`
+
+    Files installed by several modules are only included once.
+    """
+    outputs: Dict[str, str] = {}
+    for info in modules.values():
+        for item in info["installed"]:
+            if item.startswith("out/"):
+                output = outdir + item[3:]
+            else:
+                output = outdir + "/" + item
+            outputs.setdefault(output, item)
+    return outputs
+
+
+def copy_file(src: str, dst: str) -> None:
+    """Copy the contents of `src` to `dst`, sharing extents where possible"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+
+        # copy_file_range copies within the kernel, and can still reflink on
+        # filesystems which support it for individual ranges (e.g. NFS, XFS)
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE * 64):
+                pass
+            return
+        except OSError:
+            pass
+
+        # Continues from wherever copy_file_range left off
+        shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+
+def install(
+    outdir: str, module_info_filename: str, targets: List[str], jobs: Optional[int]
+) -> None:
+    outputs = installed_outputs(lookup_modules(module_info_filename, targets), outdir)
+
+    for directory in sorted({os.path.dirname(output) for output in outputs}):
+        os.makedirs(directory, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(copy_file, item, output) for output, item in outputs.items()
+        ]
+        for future in futures:
+            future.result()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    install_parser = subparsers.add_parser(
+        "install", help="copy the installed files of some modules into a directory"
+    )
+    install_parser.add_argument(
+        "--jobs", type=int, default=None, help="number of files to copy in parallel"
+    )
+    install_parser.add_argument("outdir", help="output directory")
+    install_parser.add_argument(
+        "module_info", help="path to module-info.json or an index of it"
+    )
+    install_parser.add_argument("targets", nargs="*", help="modules to install")
+
+    index_parser = subparsers.add_parser(
+        "index", help="convert module-info.json into an SQLite index"
+    )
+    index_parser.add_argument("module_info", help="path to module-info.json")
+    index_parser.add_argument("output", help="path of the index to write")
+
+    query_parser = subparsers.add_parser(
+        "query", help="print the class, path and installed files of modules as JSON"
+    )
+    query_parser.add_argument(
+        "module_info", help="path to module-info.json or an index of it"
+    )
+    query_parser.add_argument("names", nargs="+", help="module names")
+
+    args = parser.parse_args()
+
+    if args.command == "install":
+        install(args.outdir, args.module_info, args.targets, args.jobs)
+    elif args.command == "index":
+        with open(args.module_info) as f:
+            build_index(f, args.output)
+    elif args.command == "query":
+        modules = lookup_modules(args.module_info, args.names)
+        json.dump(modules, sys.stdout, indent=2, sort_keys=True)
+        print()
+        missing = [name for name in args.names if name not in modules]
+        if missing:
+            print(f"Unknown modules: {' '.join(missing)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""In-process computation of Nix NAR hashes
+
+The NAR serialization is streamed directly into the hash, either from a
+filesystem path (like `nix hash-path`) or from a git tree object (like
+hashing the output of `nix-prefetch-git`, without materializing a checkout).
+"""
+
+from typing import Callable, Iterable, Iterator, Union
+
+import base64
+import hashlib
+import mmap
+import os
+import re
+import stat
+import struct
+
+from git_objects import CatFile, parse_tree
+
+NIX_BASE32_CHARS = "0123456789abcdfghijklmnpqrsvwxyz"
+
+CHUNK_SIZE = 1024 * 1024
+# Files at least this large are hashed straight from a memory mapping, which
+# avoids copying them through read() buffers. hashlib releases the GIL while
+# hashing, so paths hashed from several threads are processed in parallel.
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+
+class UnsupportedTree(Exception):
+    """The tree cannot be hashed without a real checkout"""
+
+
+def nix_base32_encode(digest: bytes) -> str:
+    """Encode `digest` using the base32 alphabet and ordering used by Nix"""
+    length = (len(digest) * 8 - 1) // 5 + 1
+    chars = []
+    for n in range(length - 1, -1, -1):
+        b = n * 5
+        i, j = divmod(b, 8)
+        c = digest[i] >> j
+        if i + 1 < len(digest):
+            c |= digest[i + 1] << (8 - j)
+        chars.append(NIX_BASE32_CHARS[c & 0x1F])
+    return "".join(chars)
+
+
+def to_nix_base32(sha256: str) -> str:
+    """Convert a sha256 hash in SRI or base16 form to Nix base32
+
+    Hashes which are already in Nix base32 (or are not recognized) are
+    returned unchanged.
+    """
+    if sha256.startswith("sha256-"):
+        return nix_base32_encode(base64.b64decode(sha256.removeprefix("sha256-")))
+    if re.fullmatch("[0-9a-f]{64}", sha256):
+        return nix_base32_encode(bytes.fromhex(sha256))
+    return sha256
+
+
+# File contents are read into bytes, or viewed in a memory mapping
+Chunk = Union[bytes, memoryview]
+
+
+class NarWriter:
+    """Writes a NAR serialization to `write`, one node at a time"""
+
+    def __init__(self, write: Callable[[Chunk], None]) -> None:
+        self.write = write
+        self.string(b"nix-archive-1")
+
+    def string(self, s: bytes) -> None:
+        self.write(struct.pack("<Q", len(s)))
+        self.write(s)
+        self.pad(len(s))
+
+    def pad(self, length: int) -> None:
+        if length % 8:
+            self.write(b"\0" * (8 - length % 8))
+
+    def regular(self, size: int, chunks: Iterable[Chunk], executable: bool) -> None:
+        self.string(b"(")
+        self.string(b"type")
+        self.string(b"regular")
+        if executable:
+            self.string(b"executable")
+            self.string(b"")
+        self.string(b"contents")
+        self.write(struct.pack("<Q", size))
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            self.write(chunk)
+        if written != size:
+            raise Exception(f"Expected {size} bytes of file contents, got {written}")
+        self.pad(size)
+        self.string(b")")
+
+    def symlink(self, target: bytes) -> None:
+        self.string(b"(")
+        self.string(b"type")
+        self.string(b"symlink")
+        self.string(b"target")
+        self.string(target)
+        self.string(b")")
+
+    def begin_directory(self) -> None:
+        self.string(b"(")
+        self.string(b"type")
+        self.string(b"directory")
+
+    def begin_entry(self, name: bytes) -> None:
+        self.string(b"entry")
+        self.string(b"(")
+        self.string(b"name")
+        self.string(name)
+        self.string(b"node")
+
+    def end_entry(self) -> None:
+        self.string(b")")
+
+    def end_directory(self) -> None:
+        self.string(b")")
+
+
+def _read_chunks(path: str, size: int) -> Iterator[Chunk]:
+    with open(path, "rb") as f:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    yield view
+            return
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def dump_path(nar: NarWriter, path: str) -> None:
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        nar.symlink(os.fsencode(os.readlink(path)))
+    elif stat.S_ISREG(st.st_mode):
+        executable = bool(st.st_mode & stat.S_IXUSR)
+        nar.regular(st.st_size, _read_chunks(path, st.st_size), executable)
+    elif stat.S_ISDIR(st.st_mode):
+        nar.begin_directory()
+        for name in sorted(os.listdir(os.fsencode(path))):
+            nar.begin_entry(name)
+            dump_path(nar, os.path.join(path, os.fsdecode(name)))
+            nar.end_entry()
+        nar.end_directory()
+    else:
+        raise Exception(f"Unsupported file type: {path}")
+
+
+def hash_path(path: str) -> str:
+    """Equivalent to `nix hash-path --base32 --type sha256 <path>`"""
+    h = hashlib.sha256()
+    dump_path(NarWriter(h.update), path)
+    return nix_base32_encode(h.digest())
+
+
+def dump_git_tree(
+    nar: NarWriter, cat_file: CatFile, tree: str, fetch_submodules: bool
+) -> None:
+    _, obj_type, data = cat_file.read(tree)
+    if obj_type != "tree":
+        raise Exception(f"{tree} is a {obj_type}, not a tree")
+
+    nar.begin_directory()
+    # git sorts directories as if they had a trailing slash, NAR sorts by name
+    for mode, name, sha1 in sorted(parse_tree(data), key=lambda e: e[1]):
+        if name == b".gitattributes":
+            # Attributes can change checked out contents (eol, lfs filters, ...)
+            raise UnsupportedTree(".gitattributes present")
+
+        nar.begin_entry(name)
+        if mode == "40000":
+            dump_git_tree(nar, cat_file, sha1, fetch_submodules)
+        elif mode == "160000":
+            if fetch_submodules:
+                raise UnsupportedTree("submodules present")
+            # An uninitialized submodule is checked out as an empty directory
+            nar.begin_directory()
+            nar.end_directory()
+        elif mode == "120000":
+            nar.symlink(cat_file.read(sha1)[2])
+        elif mode.startswith("100"):
+            _, _, size = cat_file.header(sha1)
+            nar.regular(size, cat_file.stream(size), mode == "100755")
+        else:
+            raise Exception(f"Unknown git mode {mode} for {name!r} in {tree}")
+        nar.end_entry()
+    nar.end_directory()
+
+
+def hash_git_tree(git_dir: str, rev: str, fetch_submodules: bool = False) -> str:
+    """Hash the tree of `rev` as if it had been checked out by nix-prefetch-git
+
+    Raises UnsupportedTree if the result could differ from a real checkout.
+    """
+    h = hashlib.sha256()
+    with CatFile(git_dir) as cat_file:
+        dump_git_tree(
+            NarWriter(h.update), cat_file, f"{rev}^{{tree}}", fetch_submodules
+        )
+    return nix_base32_encode(h.digest())
@@ -0,0 +1,349 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""Resolve repo manifests without the repo tool
+
+Only the manifest repository itself is fetched (shallowly, into a persistent
+cache), and the manifest XML is interpreted here, following the semantics of
+repo v2.45. The result has the same format as our patched `repo dumpjson`:
+a dict from project path to url, revisionExpr, groups, and any linkfiles and
+copyfiles.
+
+Manifests using features which are not implemented here raise
+UnsupportedManifest, so callers can fall back to the repo tool.
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+
+import os
+import re
+import subprocess
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+from git_objects import CatFile
+from robotnix_common import get_mirrored_url, url_cache_dir
+
+# Read a file from the manifest repository, by path relative to its root
+ReadFile = Callable[[str], bytes]
+
+# Groups used by `repo init` when no groups are given
+DEFAULT_MANIFEST_GROUPS = ["default", "platform-linux"]
+
+LOCAL_MANIFEST_GROUP_PREFIX = "local"
+
+
+class ManifestError(Exception):
+    """The manifest is invalid"""
+
+
+class UnsupportedManifest(ManifestError):
+    """The manifest uses features which are only handled by the repo tool"""
+
+
+def parse_list(field: str) -> List[str]:
+    return [x for x in re.split(r"[,\s]+", field) if x]
+
+
+def resolve_fetch_url(manifest_url: str, fetch: str) -> str:
+    """Resolve the fetch attribute of a remote, like repo's _resolveFetchUrl"""
+    url = fetch.rstrip("/")
+    manifest_url = manifest_url.rstrip("/")
+    # urljoin does not handle base URLs without a scheme, like <host>:<path>
+    if manifest_url.find(":") != manifest_url.find("/") - 1:
+        url = urllib.parse.urljoin("gopher://" + manifest_url, url)
+        return re.sub(r"^gopher://", "", url)
+    return urllib.parse.urljoin(manifest_url, url)
+
+
+def matches_groups(groups: List[str], manifest_groups: List[str]) -> bool:
+    """Whether a project is synced by repo, like repo's Project.MatchesGroups"""
+    project_groups = ["all"] + groups
+    if "notdefault" not in project_groups:
+        project_groups.append("default")
+    matched = False
+    for group in manifest_groups:
+        if group.startswith("-") and group[1:] in project_groups:
+            matched = False
+        elif group in project_groups:
+            matched = True
+    return matched
+
+
+class Remote:
+    def __init__(self, node: ET.Element, manifest_url: str) -> None:
+        self.name = node.attrib["name"]
+        self.fetch = node.get("fetch", "")
+        self.url = resolve_fetch_url(manifest_url, self.fetch)
+        self.revision = node.get("revision", "")
+        self.attrib = dict(node.attrib)
+
+
+class Project:
+    def __init__(
+        self, name: str, path: str, remote: Remote, revision: str, groups: List[str]
+    ) -> None:
+        self.name = name
+        self.path = path
+        self.remote = remote
+        self.revision = revision
+        self.groups = groups
+        self.linkfiles: List[Dict[str, str]] = []
+        self.copyfiles: List[Dict[str, str]] = []
+
+    def add_files(self, node: ET.Element) -> None:
+        for child in node:
+            if child.tag in ("linkfile", "copyfile"):
+                files = self.linkfiles if child.tag == "linkfile" else self.copyfiles
+                files.append({"src": child.attrib["src"], "dest": child.attrib["dest"]})
+            elif child.tag == "project":
+                raise UnsupportedManifest(f"Nested projects in {self.name}")
+
+    def to_json(self) -> Dict[str, Any]:
+        hidden = ("all", f"name:{self.name}", f"path:{self.path}")
+        data: Dict[str, Any] = {
+            "url": self.remote.url.rstrip("/") + "/" + self.name,
+            "revisionExpr": self.revision,
+            "groups": sorted(g for g in self.groups if g not in hidden),
+        }
+        if self.linkfiles:
+            data["linkfiles"] = self.linkfiles
+        if self.copyfiles:
+            data["copyfiles"] = self.copyfiles
+        return data
+
+
+class Manifest:
+    def __init__(self, manifest_url: str) -> None:
+        self.manifest_url = manifest_url
+        self.remotes: Dict[str, Remote] = {}
+        self.default: Dict[str, str] = {}
+        self.projects: Dict[str, Project] = {}  # By path
+
+    @staticmethod
+    def expand(
+        read_file: ReadFile,
+        name: str,
+        parent_groups: str = "",
+        parent: Optional[ET.Element] = None,
+    ) -> List[ET.Element]:
+        """Parse a manifest file, replacing <include> with the included nodes"""
+        try:
+            root = ET.fromstring(read_file(name))
+        except ET.ParseError as e:
+            raise ManifestError(f"Failed to parse {name}: {e}")
+        if root.tag != "manifest":
+            raise ManifestError(f"No <manifest> in {name}")
+
+        nodes = []
+        for node in root:
+            if node.tag == "include":
+                include_groups = parent_groups
+                if "groups" in node.attrib:
+                    include_groups = node.attrib["groups"] + "," + include_groups
+                nodes.extend(
+                    Manifest.expand(
+                        read_file, node.attrib["name"], include_groups, node
+                    )
+                )
+                continue
+            if node.tag == "submanifest":
+                raise UnsupportedManifest(f"<submanifest> in {name}")
+            if node.tag == "project":
+                if parent_groups:
+                    groups = parent_groups
+                    if "groups" in node.attrib:
+                        groups = node.attrib["groups"] + "," + groups
+                    node.set("groups", groups)
+                if parent is not None and "revision" not in node.attrib:
+                    node.set("revision", parent.get("revision", ""))
+            nodes.append(node)
+        return nodes
+
+    def get_remote(self, node: ET.Element) -> Remote:
+        name = node.get("remote") or self.default.get("remote")
+        if not name:
+            raise ManifestError(f"No remote for project {node.get('name')}")
+        if name not in self.remotes:
+            raise ManifestError(f"Remote {name} is not defined")
+        return self.remotes[name]
+
+    def named_projects(self, name: str) -> List[Project]:
+        return [p for p in self.projects.values() if p.name == name]
+
+    def add_project(self, node: ET.Element) -> None:
+        name = node.attrib["name"]
+        path = node.get("path") or name
+        remote = self.get_remote(node)
+        revision = (
+            node.get("revision") or remote.revision or self.default.get("revision")
+        )
+        if not revision:
+            raise ManifestError(f"No revision for project {name}")
+        groups = parse_list(node.get("groups", ""))
+        for group in ["all", f"name:{name}", f"path:{path}"]:
+            if group not in groups:
+                groups.append(group)
+        if path in self.projects:
+            raise ManifestError(f"Duplicate path {path}")
+
+        project = Project(name, path, remote, revision, groups)
+        project.add_files(node)
+        self.projects[path] = project
+
+    def extend_project(self, node: ET.Element) -> None:
+        name = node.attrib["name"]
+        projects = self.named_projects(name)
+        if not projects:
+            raise ManifestError(f"extend-project of non-existent project {name}")
+        path = node.get("path")
+        if node.get("dest-path"):
+            raise UnsupportedManifest(f"extend-project with dest-path for {name}")
+        for p in projects:
+            if path and p.path != path:
+                continue
+            p.groups.extend(parse_list(node.get("groups", "")))
+            if node.get("revision"):
+                p.revision = node.attrib["revision"]
+            if node.get("remote"):
+                p.remote = self.get_remote(node)
+            p.add_files(node)
+
+    def remove_project(self, node: ET.Element) -> None:
+        name = node.get("name")
+        path = node.get("path")
+        if not name and not path:
+            raise ManifestError("remove-project must have name and/or path")
+        removed = [
+            p.path
+            for p in self.projects.values()
+            if (name == p.name and not path)
+            or (path == p.path and (not name or name == p.name))
+        ]
+        for p_path in removed:
+            del self.projects[p_path]
+        if not removed and node.get("optional") != "true":
+            raise ManifestError(
+                f"remove-project of non-existent project {name or path}"
+            )
+
+    def load(self, nodes: List[ET.Element]) -> None:
+        for node in nodes:
+            if node.tag == "remote":
+                remote = Remote(node, self.manifest_url)
+                existing = self.remotes.get(remote.name)
+                if existing is not None and existing.attrib != remote.attrib:
+                    raise ManifestError(f"Remote {remote.name} defined differently")
+                self.remotes[remote.name] = remote
+        for node in nodes:
+            if node.tag == "default":
+                default = dict(node.attrib)
+                if self.default and default != self.default:
+                    raise ManifestError("Duplicate <default> with different values")
+                self.default = default
+        for node in nodes:
+            if node.tag == "project":
+                self.add_project(node)
+            elif node.tag == "extend-project":
+                self.extend_project(node)
+            elif node.tag == "remove-project":
+                self.remove_project(node)
+
+    def to_json(
+        self, manifest_groups: Optional[List[str]] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        if manifest_groups is None:
+            manifest_groups = DEFAULT_MANIFEST_GROUPS
+        return {
+            path: p.to_json()
+            for path, p in sorted(self.projects.items())
+            if matches_groups(p.groups, manifest_groups)
+        }
+
+
+def resolve_manifest(
+    manifest_url: str,
+    read_file: ReadFile,
+    manifest_name: str = "default.xml",
+    local_manifests: Optional[List[str]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """Resolve a manifest into the format produced by `repo dumpjson`
+
+    `local_manifests` are paths of files which would be copied into
+    .repo/local_manifests. Like with repo, they are applied in order of their
+    file names, after the main manifest.
+    """
+    nodes = Manifest.expand(read_file, manifest_name)
+    for local_manifest in sorted(
+        local_manifests or [], key=lambda f: os.path.basename(f)
+    ):
+        basename = os.path.basename(local_manifest)
+        if not basename.endswith(".xml"):
+            continue
+        local_dir = os.path.dirname(os.path.abspath(local_manifest))
+
+        def read_local_file(name: str) -> bytes:
+            with open(os.path.join(local_dir, name), "rb") as f:
+                return f.read()
+
+        group = f"{LOCAL_MANIFEST_GROUP_PREFIX}:{basename[:-4]}"
+        nodes.extend(Manifest.expand(read_local_file, basename, group))
+
+    manifest = Manifest(manifest_url)
+    manifest.load(nodes)
+    return manifest.to_json()
+
+
+def fetch_manifest_repo(url: str, ref: str) -> str:
+    """Shallowly fetch `ref` of a manifest repository into the cache
+
+    Tags which were fetched before are not fetched again. Returns the git dir.
+    """
+    git_dir = url_cache_dir("manifests", url)
+    if not os.path.exists(os.path.join(git_dir, "HEAD")):
+        subprocess.check_call(["git", "init", "--quiet", "--bare", git_dir])
+
+    if ref.startswith("refs/tags/"):
+        cached = subprocess.run(
+            ["git", "--git-dir", git_dir, "rev-parse", "--verify", "--quiet", ref],
+            stdout=subprocess.DEVNULL,
+        )
+        if cached.returncode == 0:
+            return git_dir
+
+    subprocess.check_call(
+        [
+            "git",
+            "--git-dir",
+            git_dir,
+            "fetch",
+            "--quiet",
+            "--depth=1",
+            "--no-tags",
+            get_mirrored_url(url),
+            f"+{ref}:{ref}",
+        ]
+    )
+    return git_dir
+
+
+def fetch_manifest(
+    url: str,
+    ref: str,
+    manifest_name: str = "default.xml",
+    local_manifests: Optional[List[str]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """Fetch and resolve the manifest at `ref` (e.g. refs/tags/android-12.0.0_r1)"""
+    git_dir = fetch_manifest_repo(url, ref)
+    with CatFile(git_dir) as cat_file:
+
+        def read_file(name: str) -> bytes:
+            try:
+                _, obj_type, data = cat_file.read(f"{ref}:{name}")
+            except Exception:
+                raise ManifestError(f"{name} not found in {url} {ref}")
+            if obj_type != "blob":
+                raise ManifestError(f"{name} in {url} {ref} is a {obj_type}")
+            return data
+
+        return resolve_manifest(url, read_file, manifest_name, local_manifests)
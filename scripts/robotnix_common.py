@@ -1,36 +1,137 @@
 # SPDX-FileCopyrightText: 2021 Daniel Fullmer and robotnix contributors
 # SPDX-License-Identifier: MIT
 
-from typing import Any, Dict, TypedDict, cast
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, TypedDict, cast
+from enum import Enum
 
+import hashlib
 import json
+import multiprocessing.pool
 import os
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from pathlib import Path
 
+from git_objects import find_git_dir
+from git_protocol import ProtocolError, ls_refs
+from nar import UnsupportedTree, hash_git_tree
+
+
+class MirrorTrie:
+    """Maps remote URL prefixes to lists of mirrors, by longest prefix match.
+
+    Lookups walk the URL once, so their cost does not depend on the number
+    of mirrors. As with git's `url.<base>.insteadOf`, the longest matching
+    prefix wins; mirrors added for the same prefix are tried in order.
+    """
+
+    def __init__(self) -> None:
+        # Each node maps a character to a child node. The "" key holds the
+        # mirrors of the prefix ending at that node.
+        self.root: Dict[str, Any] = {}
+        self.size = 0
+
+    def add(self, remote_url: str, local_url: str) -> None:
+        node = self.root
+        for char in remote_url:
+            node = node.setdefault(char, {})
+        node.setdefault("", []).append(local_url)
+        self.size += 1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def lookup(self, url: str) -> Tuple[int, List[str]]:
+        """Get the length of the longest matching prefix, and its mirrors"""
+        node = self.root
+        match: Tuple[int, List[str]] = (0, node.get("", []))
+        for i, char in enumerate(url):
+            if char not in node:
+                break
+            node = node[char]
+            if "" in node:
+                match = (i + 1, node[""])
+        return match
+
+
+def parse_mirrors(spec: str, separator: str = "|") -> List[Tuple[str, str]]:
+    """Parse `<remote_url>=<local_url>` mappings, as in ROBOTNIX_GIT_MIRRORS"""
+    mirrors = []
+    for mapping in spec.split(separator):
+        mapping = mapping.strip()
+        if mapping and not mapping.startswith("#"):
+            remote_url, local_url = mapping.split("=", 1)
+            mirrors.append((remote_url, local_url))
+    return mirrors
+
+
+def load_mirrors() -> MirrorTrie:
+    """Load mirrors from ROBOTNIX_GIT_MIRRORS and ROBOTNIX_GIT_MIRRORS_FILE.
+
+    Mappings from the environment variable come before those from the file,
+    so they are tried first if both have the same remote URL.
+    """
+    mirrors = MirrorTrie()
+    for remote_url, local_url in parse_mirrors(ROBOTNIX_GIT_MIRRORS):
+        mirrors.add(remote_url, local_url)
+    if ROBOTNIX_GIT_MIRRORS_FILE:
+        with open(ROBOTNIX_GIT_MIRRORS_FILE) as f:
+            for remote_url, local_url in parse_mirrors(f.read(), separator="\n"):
+                mirrors.add(remote_url, local_url)
+    return mirrors
+
 
 ROBOTNIX_GIT_MIRRORS = os.environ.get("ROBOTNIX_GIT_MIRRORS", "")
-if ROBOTNIX_GIT_MIRRORS:
-    MIRRORS: Dict[str, str] = dict(
-        (mirror.split("=")[0], mirror.split("=")[1])
-        for mirror in ROBOTNIX_GIT_MIRRORS.split("|")
-    )
-else:
-    MIRRORS = {}
+ROBOTNIX_GIT_MIRRORS_FILE = os.environ.get("ROBOTNIX_GIT_MIRRORS_FILE", "")
+MIRRORS = load_mirrors()
+
+
+def get_mirrored_urls(url: str) -> List[str]:
+    """Get all mirrors of `url` in order of preference, followed by `url`"""
+    prefix_len, mirrors = MIRRORS.lookup(url)
+    rest = url[prefix_len:]
+    return [mirror + rest for mirror in mirrors] + [url]
 
 
 def get_mirrored_url(url: str) -> str:
-    for mirror_url, mirror_path in MIRRORS.items():
-        if url.startswith(mirror_url):
-            url = url.replace(mirror_url, mirror_path)
+    """Get the first mirror of `url` which is usable.
+
+    Local mirrors are skipped if they do not contain the repository, so
+    later mirrors, and finally `url` itself, act as fallbacks.
+    """
+    for mirrored_url in get_mirrored_urls(url):
+        if (
+            not mirrored_url.startswith("/")
+            or os.path.exists(mirrored_url)
+            or os.path.exists(mirrored_url + ".git")
+        ):
+            return mirrored_url
     return url
 
 
+def cache_path(*parts: str) -> str:
+    """Get a path in robotnix's directory under $XDG_CACHE_HOME"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "robotnix", *parts)
+
+
+def url_cache_dir(kind: str, url: str) -> str:
+    """Get the path of a cached repository of `url`, e.g. "manifests" kind"""
+    name = hashlib.sha256(url.encode()).hexdigest()[:32]
+    return cache_path(kind, name + ".git")
+
+
 def save(filename: str, data: Any) -> None:
-    open(filename, "w").write(
-        json.dumps(data, sort_keys=True, indent=2, separators=(",", ": "))
-    )
+    """Write `data` as json, atomically replacing `filename`"""
+    tmp_filename = f"{filename}.tmp{os.getpid()}"
+    with open(tmp_filename, "w") as f:
+        f.write(json.dumps(data, sort_keys=True, indent=2, separators=(",", ": ")))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
 
 
 def get_store_path(path):
@@ -76,21 +177,120 @@ def checkout_git(
     fetch_lfs: bool = True,
 ) -> GitCheckoutInfoDict:
     print("Checking out %s %s" % (url, rev))
+    args = checkout_git_args(url, rev, fetch_submodules, fetch_lfs)
+    json_text = subprocess.check_output(args).decode()
+    return cast(GitCheckoutInfoDict, json.loads(json_text))
+
+
+def checkout_git_args(
+    url: str, rev: str, fetch_submodules: bool, fetch_lfs: bool
+) -> List[str]:
     args = ["nix-prefetch-git", "--url", url, "--rev", rev]
     if fetch_submodules:
         args.append("--fetch-submodules")
     if fetch_lfs:
         args.append("--fetch-lfs")
-    json_text = subprocess.check_output(args).decode()
-    return cast(GitCheckoutInfoDict, json.loads(json_text))
+    return args
 
 
-def check_free_space() -> None:
+def prefetch_git_objects(
+    url: str,
+    rev: str,
+    fetch_submodules: bool = False,
+) -> GitCheckoutInfoDict:
+    """Like checkout_git, but hash the git tree objects without a checkout.
+
+    Local repositories are read in place. Remote ones are shallow-fetched
+    into a temporary bare repository. Raises UnsupportedTree if the tree
+    needs a real checkout to be hashed correctly.
+    """
+    print("Hashing git objects for %s %s" % (url, rev))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        git_dir = find_git_dir(url) if url.startswith("/") else None
+        commitish = rev
+        if git_dir is None:
+            git_dir = tmpdir
+            subprocess.check_call(["git", "init", "--quiet", "--bare", git_dir])
+            subprocess.check_call(
+                ["git", "fetch", "--quiet", "--depth=1", "--no-tags", url, rev],
+                cwd=git_dir,
+            )
+            commitish = "FETCH_HEAD"
+
+        full_rev = (
+            subprocess.check_output(
+                ["git", "rev-parse", commitish + "^{commit}"], cwd=git_dir
+            )
+            .decode()
+            .strip()
+        )
+        date = (
+            subprocess.check_output(
+                ["git", "show", "-s", "--format=%cI", full_rev], cwd=git_dir
+            )
+            .decode()
+            .strip()
+        )
+        sha256 = hash_git_tree(git_dir, full_rev, fetch_submodules)
+
+    return GitCheckoutInfoDict(
+        url=url,
+        rev=full_rev,
+        date=date,
+        path="",
+        sha256=sha256,
+        fetchSubmodules=str(fetch_submodules).lower(),
+        deepClone="false",
+        leaveDotGit="false",
+    )
+
+
+# How the sha256 of a git checkout gets computed.
+# These are used for the --hash-method CLI arg.
+class HashMethod(Enum):
+    NIX_PREFETCH_GIT = "nix-prefetch-git"
+    GIT_OBJECTS = "git-objects"
+    CROSS_CHECK = "cross-check"  # Compute both and fail if they differ
+
+
+def prefetch_git(
+    url: str,
+    rev: str,
+    fetch_submodules: bool = False,
+    fetch_lfs: bool = True,
+    method: HashMethod = HashMethod.NIX_PREFETCH_GIT,
+) -> GitCheckoutInfoDict:
+    if method == HashMethod.NIX_PREFETCH_GIT:
+        return checkout_git(url, rev, fetch_submodules, fetch_lfs)
+
+    try:
+        git_info = prefetch_git_objects(url, rev, fetch_submodules)
+    except UnsupportedTree as e:
+        print(f"Falling back to nix-prefetch-git for {url} {rev}: {e}")
+        return checkout_git(url, rev, fetch_submodules, fetch_lfs)
+
+    if method == HashMethod.CROSS_CHECK:
+        expected = checkout_git(url, rev, fetch_submodules, fetch_lfs)
+        if expected["sha256"] != git_info["sha256"]:
+            raise Exception(
+                f"Hash mismatch for {url} {rev}: nix-prefetch-git gave "
+                f"{expected['sha256']}, git objects gave {git_info['sha256']}"
+            )
+
+    return git_info
+
+
+def tmpdir_free_space() -> Tuple[str, int]:
+    """Get the path and free bytes where nix-prefetch-git checks out"""
     # nix-prefetch-git will check out under $TMPDIR (if it exists), or /tmp (otherwise)
     path = os.environ["TMPDIR"] if "TMPDIR" in os.environ else "/tmp"
 
     st = os.statvfs(path)
-    free_bytes = st.f_bavail * st.f_bsize
+    return path, st.f_bavail * st.f_bsize
+
+
+def check_free_space() -> None:
+    path, free_bytes = tmpdir_free_space()
 
     desired_gb = 10
     if free_bytes < (desired_gb * 1024**3):
@@ -104,19 +304,175 @@ def check_free_space() -> None:
 
 
 REMOTE_REFS: Dict[str, Dict[str, str]] = {}  # url: { ref: rev }
+REMOTE_REFS_TIME: Dict[str, float] = {}  # url: time the oldest refs were listed
+# Remotes whose refs were only listed for some patterns: url: patterns.
+# Remotes in REMOTE_REFS but not in here had all of their refs listed.
+REMOTE_REF_PATTERNS: Dict[str, Set[str]] = {}
+_remote_refs_lock = threading.Lock()
+_remote_refs_pending: Dict[str, threading.Event] = {}
 
 
-def ls_remote(url: str) -> Dict[str, str]:
-    if url in REMOTE_REFS:
-        return REMOTE_REFS[url]
-
-    orig_url = url
-    url = get_mirrored_url(url)
-
-    remote_info = subprocess.check_output(["git", "ls-remote", url]).decode()
-    REMOTE_REFS[orig_url] = {}
+def parse_ls_remote(remote_info: str) -> Dict[str, str]:
+    refs = {}
     for line in remote_info.split("\n"):
         if line:
             ref, rev = reversed(line.split("\t"))
-            REMOTE_REFS[orig_url][ref] = rev
-    return REMOTE_REFS[orig_url]
+            refs[ref] = rev
+    return refs
+
+
+def expand_ref_pattern(pattern: str) -> List[str]:
+    """Names of the refs which a revisionExpr may refer to, in order of preference"""
+    return [pattern, "refs/tags/" + pattern, "refs/heads/" + pattern]
+
+
+def filter_refs(refs: Dict[str, str], patterns: Iterable[str]) -> Dict[str, str]:
+    """Keep only refs named by `patterns`, sharing ref name strings between remotes"""
+    wanted = {name for pattern in patterns for name in expand_ref_pattern(pattern)}
+    return {sys.intern(ref): rev for ref, rev in refs.items() if ref in wanted}
+
+
+def _list_remote_refs(url: str, patterns: Optional[Set[str]] = None) -> Dict[str, str]:
+    mirrored_url = get_mirrored_url(url)
+    if patterns is not None:
+        prefixes = [
+            name for pattern in patterns for name in expand_ref_pattern(pattern)
+        ]
+        try:
+            return filter_refs(ls_refs(mirrored_url, prefixes), patterns)
+        except ProtocolError:
+            pass  # The server sends all refs, and they are filtered here
+    remote_info = subprocess.check_output(["git", "ls-remote", mirrored_url]).decode()
+    refs = parse_ls_remote(remote_info)
+    return refs if patterns is None else filter_refs(refs, patterns)
+
+
+def _missing_patterns(
+    url: str, patterns: Optional[Set[str]]
+) -> Tuple[bool, Optional[Set[str]]]:
+    """Get (whether listing is needed, patterns to list). Call with the lock held."""
+    if url not in REMOTE_REFS:
+        return True, patterns
+    listed = REMOTE_REF_PATTERNS.get(url)
+    if listed is None:
+        return False, None
+    if patterns is None:
+        return True, None
+    missing = patterns - listed
+    return bool(missing), missing
+
+
+def remote_refs_missing(url: str, patterns: Optional[Set[str]] = None) -> bool:
+    """Whether ls_remote(url, patterns) would have to list the remote"""
+    with _remote_refs_lock:
+        return _missing_patterns(url, patterns)[0]
+
+
+def set_remote_refs(
+    url: str, refs: Dict[str, str], patterns: Optional[Iterable[str]] = None
+) -> None:
+    """Store refs of a remote which were listed by some other means
+
+    If `patterns` is given, `refs` only holds the refs matching them, and is
+    merged with refs listed before for other patterns. The time of an entry
+    is that of its oldest refs, so merging refs does not renew it.
+    """
+    with _remote_refs_lock:
+        if patterns is None:
+            REMOTE_REFS[url] = refs
+            REMOTE_REF_PATTERNS.pop(url, None)
+            REMOTE_REFS_TIME[url] = time.time()
+        elif url in REMOTE_REFS and url in REMOTE_REF_PATTERNS:
+            REMOTE_REFS[url].update(refs)
+            REMOTE_REF_PATTERNS[url].update(patterns)
+        elif url not in REMOTE_REFS:
+            REMOTE_REFS[url] = refs
+            REMOTE_REF_PATTERNS[url] = set(patterns)
+            REMOTE_REFS_TIME[url] = time.time()
+
+
+def ls_remote(url: str, patterns: Optional[Iterable[str]] = None) -> Dict[str, str]:
+    """Get the refs of a remote.
+
+    If `patterns` is given, only refs named by them (see expand_ref_pattern)
+    are listed and the result may contain nothing else. Only a single
+    `git ls-remote` runs per URL. Concurrent callers for the same URL wait
+    for its result instead of listing the remote again.
+    """
+    wanted = None if patterns is None else set(patterns)
+    while True:
+        with _remote_refs_lock:
+            needed, missing = _missing_patterns(url, wanted)
+            if not needed:
+                return REMOTE_REFS[url]
+            pending = _remote_refs_pending.get(url)
+            if pending is None:
+                pending = threading.Event()
+                _remote_refs_pending[url] = pending
+                break
+        # Another thread is listing this remote. If it fails, or lists other
+        # patterns, try ourselves.
+        pending.wait()
+
+    try:
+        if missing is None:
+            refs = _list_remote_refs(url)
+        else:
+            refs = _list_remote_refs(url, missing)
+        set_remote_refs(url, refs, missing)
+        with _remote_refs_lock:
+            return REMOTE_REFS[url]
+    finally:
+        with _remote_refs_lock:
+            del _remote_refs_pending[url]
+        pending.set()
+
+
+def prefetch_remote_refs(
+    urls: Iterable[str],
+    jobs: int = 1,
+    patterns: Optional[Dict[str, Set[str]]] = None,
+) -> None:
+    """List the refs of all `urls`, running at most `jobs` at once
+
+    If `patterns` is given, only the refs it lists for each URL are fetched.
+    """
+    urls = sorted(
+        url
+        for url in set(urls)
+        if remote_refs_missing(url, None if patterns is None else patterns.get(url))
+    )
+    if not urls:
+        return
+    print(f"Listing refs of {len(urls)} remotes")
+    with multiprocessing.pool.ThreadPool(max(1, min(jobs, len(urls)))) as pool:
+        pool.map(
+            lambda url: ls_remote(url, None if patterns is None else patterns.get(url)),
+            urls,
+        )
+
+
+def load_remote_refs(filename: str, ttl: float) -> None:
+    """Load remote refs saved by save_remote_refs, if newer than `ttl` seconds"""
+    if not os.path.exists(filename):
+        return
+    now = time.time()
+    with _remote_refs_lock:
+        for url, entry in json.load(open(filename)).items():
+            if now - entry["time"] < ttl and url not in REMOTE_REFS:
+                REMOTE_REFS[url] = entry["refs"]
+                REMOTE_REFS_TIME[url] = entry["time"]
+                if "patterns" in entry:
+                    REMOTE_REF_PATTERNS[url] = set(entry["patterns"])
+
+
+def save_remote_refs(filename: str) -> None:
+    with _remote_refs_lock:
+        data = {}
+        for url, refs in REMOTE_REFS.items():
+            if url not in REMOTE_REFS_TIME:
+                continue
+            data[url] = {"time": REMOTE_REFS_TIME[url], "refs": refs}
+            if url in REMOTE_REF_PATTERNS:
+                data[url]["patterns"] = sorted(REMOTE_REF_PATTERNS[url])
+    save(filename, data)
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+"""Longest-first scheduling of project hashing work
+
+Tasks are started in order of decreasing estimated cost so that the largest
+projects do not end up running alone at the end of a run. Tasks may also
+reserve an estimated amount of disk space; tasks are held back while the
+running ones would exceed the disk budget.
+"""
+
+from typing import Any, Callable, List, NamedTuple, Optional
+
+import threading
+
+# Paths which are known to contain very large projects, used to estimate the
+# cost of projects which have never been fetched before
+LARGE_PATH_PREFIXES = [
+    "prebuilts/",
+    "kernel/prebuilts/",
+    "external/chromium-webview/",
+]
+
+DEFAULT_COST = 1.0
+LARGE_COST = 30.0
+LARGE_DISK_BYTES = 4 * 1024**3
+
+
+class Task(NamedTuple):
+    item: Any
+    cost: float  # Estimated relative duration
+    disk_bytes: int  # Estimated disk space used while running
+
+
+def estimate_task(
+    item: Any,
+    relpath: str,
+    seconds: Optional[float],
+    size: Optional[int],
+) -> Task:
+    """Estimate the cost of a project from previous runs, or its path"""
+    large = any(relpath.startswith(prefix) for prefix in LARGE_PATH_PREFIXES)
+    if seconds is None:
+        seconds = LARGE_COST if large else DEFAULT_COST
+    if size is None:
+        size = LARGE_DISK_BYTES if large else 0
+    return Task(item, seconds, size)
+
+
+def run_longest_first(
+    func: Callable[[Any], None],
+    tasks: List[Task],
+    jobs: int,
+    disk_budget: Optional[int] = None,
+) -> None:
+    """Run `func` on all tasks using `jobs` threads, most expensive first.
+
+    If `disk_budget` is set, a task only starts if the disk space reserved
+    by running tasks stays within budget, unless nothing else is running.
+    The first exception raised by `func` is re-raised once running tasks
+    have finished; tasks which have not started yet are dropped.
+    """
+    pending = sorted(tasks, key=lambda t: t.cost, reverse=True)
+    cond = threading.Condition()
+    running = 0
+    reserved = 0
+    errors: List[BaseException] = []
+
+    def next_task() -> Optional[Task]:
+        nonlocal running, reserved
+        with cond:
+            while pending and not errors:
+                for i, task in enumerate(pending):
+                    if (
+                        disk_budget is None
+                        or running == 0
+                        or reserved + task.disk_bytes <= disk_budget
+                    ):
+                        del pending[i]
+                        running += 1
+                        reserved += task.disk_bytes
+                        return task
+                cond.wait()
+            return None
+
+    def worker() -> None:
+        nonlocal running, reserved
+        while True:
+            task = next_task()
+            if task is None:
+                return
+            try:
+                func(task.item)
+            except BaseException as e:
+                with cond:
+                    errors.append(e)
+            finally:
+                with cond:
+                    running -= 1
+                    reserved -= task.disk_bytes
+                    cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, jobs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
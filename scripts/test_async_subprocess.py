@@ -0,0 +1,82 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import asyncio
+import subprocess
+
+import pytest
+
+from typing import Any
+
+from async_subprocess import AsyncRunner, parse_host_limits
+
+
+def test_parse_host_limits() -> None:
+    limits = parse_host_limits(["github.com=2", "example.com=3"])
+    assert limits["github.com"] == 2
+    assert limits["example.com"] == 3
+    assert limits["android.googlesource.com"] == 16
+
+
+def test_retries(tmpdir: Any) -> None:
+    counter = tmpdir.join("counter")
+    # Fails on the first two attempts
+    script = f"echo x >> {counter}; [ $(wc -l < {counter}) -ge 3 ] && echo ok"
+    runner = AsyncRunner(1, retries=2, backoff=0)
+
+    output = asyncio.run(runner.run(["sh", "-c", script], url="https://example.com/a"))
+    assert output == b"ok\n"
+
+    counter.remove()
+    runner = AsyncRunner(1, retries=1, backoff=0)
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(runner.run(["sh", "-c", script], url="https://example.com/a"))
+
+
+def test_run_in_thread_retries() -> None:
+    attempts = []
+
+    def flaky(x: int) -> int:
+        attempts.append(x)
+        if len(attempts) < 3:
+            raise subprocess.CalledProcessError(128, ["git", "ls-remote"])
+        return x * 2
+
+    runner = AsyncRunner(1, retries=2, backoff=0)
+    assert asyncio.run(runner.run_in_thread("https://example.com/a", flaky, 21)) == 42
+    assert attempts == [21, 21, 21]
+
+
+def test_host_limit() -> None:
+    runner = AsyncRunner(4, host_limits={"example.com": 1})
+
+    async def run_all() -> float:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(
+            *(
+                runner.run(["sleep", "0.2"], url=f"https://example.com/{i}")
+                for i in range(3)
+            )
+        )
+        return loop.time() - start
+
+    assert asyncio.run(run_all()) >= 0.6
+
+
+def test_disk_budget() -> None:
+    runner = AsyncRunner(4, disk_budget=10)
+    events = []
+
+    async def use_disk(name: str, nbytes: int) -> None:
+        async with runner.disk(nbytes):
+            events.append(f"start {name}")
+            await asyncio.sleep(0.05)
+            events.append(f"end {name}")
+
+    async def run_all() -> None:
+        await asyncio.gather(use_disk("a", 6), use_disk("b", 6), use_disk("c", 20))
+
+    asyncio.run(run_all())
+    # b does not fit next to a, and c is larger than the budget so runs alone
+    assert events == ["start a", "end a", "start b", "end b", "start c", "end c"]
@@ -0,0 +1,144 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import subprocess
+import sys
+
+import pytest
+
+from unittest.mock import patch
+
+from typing import Any, List
+
+from git_protocol import (
+    DELIM,
+    FLUSH,
+    RESPONSE_END,
+    ProtocolError,
+    capabilities,
+    ls_refs,
+    pkt_line,
+)
+from test_mk_repo_file import git_create
+
+
+def test_ls_refs(tmpdir: Any) -> None:
+    repo = tmpdir.mkdir("repo")
+    (repo / "file").write("contents")
+    git_create(str(repo), tag="v1")
+    for tag in ["v10", "v2"]:
+        subprocess.check_call(["git", "tag", tag], cwd=repo)
+    rev = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo).decode()
+
+    refs = ls_refs(str(repo), ["refs/tags/v1", "refs/heads/main"])
+    assert refs == {
+        "refs/heads/main": rev.strip(),
+        "refs/tags/v1": rev.strip(),
+        "refs/tags/v10": rev.strip(),
+    }
+    assert ls_refs(f"file://{repo}", ["refs/tags/v3"]) == {}
+
+    with pytest.raises(ProtocolError):
+        ls_refs("git@example.com:repo", ["refs/tags/v1"])
+
+
+def test_capabilities(tmpdir: Any) -> None:
+    repo = tmpdir.mkdir("repo")
+    (repo / "file").write("contents")
+    git_create(str(repo))
+
+    assert "ls-refs" in capabilities(str(repo))
+    assert "filter" not in capabilities(str(repo))["fetch"]
+    subprocess.check_call(["git", "config", "uploadpack.allowFilter", "true"], cwd=repo)
+    assert "filter" in capabilities(str(repo))["fetch"]
+
+
+# Stands in for `git remote-https`: answers stateless-connect with the canned
+# bytes in argv[1], then answers each request with the bytes in argv[2]. The
+# requests are written to argv[3].
+FAKE_HELPER = """
+import sys
+
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+command = stdin.readline()
+stdout.write(bytes.fromhex(sys.argv[1]))
+stdout.flush()
+with open(sys.argv[3], "wb") as requests:
+    while True:
+        header = stdin.read(4)
+        if not header:
+            break
+        requests.write(header)
+        length = int(header, 16)
+        if length > 4:
+            requests.write(stdin.read(length - 4))
+        elif length == 0:
+            stdout.write(bytes.fromhex(sys.argv[2]))
+            stdout.flush()
+"""
+
+
+def fake_remote_helper(tmpdir: Any, greeting: bytes, response: bytes = b"") -> Any:
+    """Run FAKE_HELPER instead of the remote helper, returning the mock"""
+    script = tmpdir / "helper.py"
+    script.write(FAKE_HELPER)
+    requests = str(tmpdir / "requests")
+    popen = subprocess.Popen
+
+    def run_helper(args: List[str], **kwargs: Any) -> Any:
+        fake_args = [sys.executable, str(script), greeting.hex(), response.hex()]
+        return popen(fake_args + [requests], **kwargs)
+
+    return patch("subprocess.Popen", side_effect=run_helper)
+
+
+ADVERTISEMENT = (
+    pkt_line(b"version 2\n")
+    + pkt_line(b"agent=git/2.43.0\n")
+    + pkt_line(b"ls-refs=unborn\n")
+    + pkt_line(b"fetch=shallow wait-for-done filter\n")
+    + FLUSH
+)
+
+
+def test_ls_refs_stateless_connect(tmpdir: Any) -> None:
+    url = "https://example.com/repo"
+    response = (
+        pkt_line(b"%s refs/heads/main\n" % (b"a" * 40))
+        + pkt_line(b"%s refs/tags/v1\n" % (b"b" * 40))
+        + FLUSH
+        + RESPONSE_END
+    )
+    with fake_remote_helper(tmpdir, b"\n" + ADVERTISEMENT, response) as popen:
+        refs = ls_refs(url, ["refs/tags/v1", "refs/heads/main"])
+    assert refs == {"refs/heads/main": "a" * 40, "refs/tags/v1": "b" * 40}
+    assert popen.call_args[0][0] == [
+        "git",
+        "-c",
+        "protocol.version=2",
+        "remote-https",
+        url,
+        url,
+    ]
+    assert (tmpdir / "requests").read_binary() == (
+        pkt_line(b"command=ls-refs\n")
+        + DELIM
+        + pkt_line(b"ref-prefix refs/heads/main\n")
+        + pkt_line(b"ref-prefix refs/tags/v1\n")
+        + FLUSH
+    )
+
+    with fake_remote_helper(tmpdir, b"\n" + ADVERTISEMENT):
+        assert capabilities(url)["fetch"] == ["shallow", "wait-for-done", "filter"]
+
+
+def test_stateless_connect_fallback(tmpdir: Any) -> None:
+    # Helpers answer "fallback" for remotes which only speak protocol v0
+    with fake_remote_helper(tmpdir, b"fallback\n"):
+        with pytest.raises(ProtocolError):
+            ls_refs("https://example.com/repo", ["refs/tags/v1"])
+    # A v0 server sends refs right away, instead of a v2 advertisement
+    v0 = pkt_line(b"%s HEAD\0multi_ack\n" % (b"a" * 40)) + FLUSH
+    with fake_remote_helper(tmpdir, b"\n" + v0):
+        with pytest.raises(ProtocolError):
+            ls_refs("https://example.com/repo", ["refs/tags/v1"])
@@ -1,16 +1,22 @@
 # SPDX-FileCopyrightText: 2020 Daniel Fullmer and robotnix contributors
 # SPDX-License-Identifier: MIT
 
+import copy
 import json
 import os
+import sqlite3
 import subprocess
 
 from unittest.mock import patch
 import pytest
 
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import mk_repo_file
+from git_objects import present_objects
+from journal import Journal
+from mk_repo_file import ProjectInfoDict
+from robotnix_common import HashMethod, MirrorTrie, prefetch_git, url_cache_dir
 
 
 def git_create(
@@ -60,7 +66,6 @@ def manifest_repo(tmpdir: Any) -> Any:
 
 def test_basic(tmpdir: Any, manifest_repo: Any) -> None:
     os.chdir(tmpdir.mkdir("checkout"))
-    # TODO: Each invocation of this downloads a remote git repo to fetch the "repo" tool
     data = mk_repo_file.make_repo_file(manifest_repo, "release")
     assert "a" in data
     assert "rev" in data["a"]
@@ -77,6 +82,39 @@ def test_basic(tmpdir: Any, manifest_repo: Any) -> None:
         assert "sha256" in data["b"]
 
 
+def test_repo_fallback(tmpdir: Any, monkeypatch: Any) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir / "cache"))
+    manifest_repo = tmpdir.mkdir("manifest")
+    (manifest_repo / "default.xml").write(
+        '<manifest><submanifest name="other" /></manifest>'
+    )
+    git_create(str(manifest_repo))
+    dumped = {"a": {"url": "https://example.com/a", "revisionExpr": "main"}}
+    repo_calls = []
+    check_call = subprocess.check_call
+
+    def run_repo(args: List[str], **kwargs: Any) -> Any:
+        """Fake the repo tool, which is not available in tests"""
+        if args[0] != "repo":
+            return check_call(args, **kwargs)
+        repo_calls.append(args[:2])
+        return json.dumps(dumped).encode()
+
+    with patch("subprocess.check_call", side_effect=run_repo), patch(
+        "subprocess.check_output", side_effect=run_repo
+    ):
+        data = mk_repo_file.load_manifest(
+            str(manifest_repo),
+            "release",
+            mk_repo_file.ManifestRefType.TAG,
+            [],
+            False,
+            mk_repo_file.ManifestEngine.NATIVE,
+        )
+    assert data == dumped
+    assert repo_calls == [["repo", "init"], ["repo", "dumpjson"]]
+
+
 def test_read_cached_repo_json(tmpdir: Any) -> None:
     top = tmpdir.mkdir("repo")
     top.mkdir("test_subdir")
@@ -94,13 +132,339 @@ def test_read_cached_repo_json(tmpdir: Any) -> None:
     repo_test_filename.write(json.dumps(repo_file_contents))
 
     mk_repo_file.read_cached_repo_json(top)
-    assert mk_repo_file.revInfo["foo", True] == {
+    assert mk_repo_file.revInfo["foo", True, True] == {
         "sha256": "bar",
         "tree": "foo2",
         "dateTime": 1,
     }
-    assert mk_repo_file.treeInfo["foo2", True] == {
+    assert mk_repo_file.treeInfo["foo2", True, True] == {
         "sha256": "bar",
         "tree": "foo2",
         "dateTime": 1,
     }
+
+
+def test_read_cached_repo_lock(tmpdir: Any) -> None:
+    lock = {
+        "fetch_completed": True,
+        "entries": {
+            "a": {
+                "project": {
+                    "path": "a",
+                    "repo_ref": {
+                        "repo_url": "https://example.com/a",
+                        "revision": "refs/heads/main",
+                        "fetch_lfs": True,
+                        "fetch_submodules": True,
+                    },
+                },
+                "lock": {
+                    "commit": "abc",
+                    "nix_hash": "sha256-47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=",
+                    "path": "/nix/store/foo-a-abc",
+                    "date": 1,
+                },
+            },
+            "b": {"project": {"path": "b"}, "lock": None},
+            "c": {
+                "project": {
+                    "path": "c",
+                    "repo_ref": {
+                        "repo_url": "https://example.com/c",
+                        "revision": "refs/heads/main",
+                        "fetch_lfs": False,
+                        "fetch_submodules": False,
+                    },
+                },
+                "lock": {
+                    "commit": "def",
+                    "nix_hash": "sha256-47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=",
+                    "path": "/nix/store/foo-c-def",
+                    "date": 1,
+                },
+            },
+        },
+    }
+    tmpdir.mkdir("lineage").join("repo.lock").write(json.dumps(lock))
+
+    mk_repo_file.read_cached_repo_json(tmpdir)
+    assert mk_repo_file.revInfo["abc", True, True] == {
+        "sha256": "0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73",
+        "dateTime": 1,
+    }
+    # Hashed without LFS, which would differ for repositories using LFS
+    assert ("def", False, False) in mk_repo_file.revInfo
+    assert ("def", False, True) not in mk_repo_file.revInfo
+
+
+def test_persistent_cache(tmpdir: Any) -> None:
+    top = tmpdir.mkdir("repo")
+    repo_test_filename = top / "repo-test.json"
+    repo_test_filename.write(
+        json.dumps({"a": {"rev": "abc", "tree": "def", "sha256": "ghi"}})
+    )
+
+    db_path = str(tmpdir / "cache.sqlite")
+    mk_repo_file.use_cache(db_path)
+    mk_repo_file.read_cached_repo_json(top)
+    assert mk_repo_file.revInfo["abc", False, True] == {"sha256": "ghi", "tree": "def"}
+
+    # A fresh process reuses the cache without parsing the lockfile again
+    mk_repo_file.use_cache(db_path)
+    assert mk_repo_file.treeInfo["def", False, True] == {"sha256": "ghi", "tree": "def"}
+    with patch("mk_repo_file.json.load") as json_load:
+        mk_repo_file.read_cached_repo_json(top)
+        json_load.assert_not_called()
+
+    mk_repo_file.use_cache(":memory:")
+
+
+def test_cache_migration(tmpdir: Any) -> None:
+    db_path = str(tmpdir / "cache.sqlite")
+    db = sqlite3.connect(db_path)
+    for table, key in [("revs", "abc"), ("trees", "def")]:
+        db.execute(
+            f"CREATE TABLE {table} (key TEXT NOT NULL, "
+            "fetch_submodules INTEGER NOT NULL, sha256 TEXT NOT NULL, "
+            "date_time INTEGER, tree TEXT, PRIMARY KEY (key, fetch_submodules)) "
+            "WITHOUT ROWID"
+        )
+        db.execute(f"INSERT INTO {table} VALUES (?, 0, 'ghi', 1, 'def')", (key,))
+    db.commit()
+    db.close()
+
+    mk_repo_file.use_cache(db_path)
+    info = {"sha256": "ghi", "dateTime": 1, "tree": "def"}
+    assert dict(mk_repo_file.revInfo) == {("abc", False, True): info}
+    assert dict(mk_repo_file.treeInfo) == {("def", False, True): info}
+    mk_repo_file.use_cache(db_path)
+    assert dict(mk_repo_file.revInfo) == {("abc", False, True): info}
+    mk_repo_file.use_cache(":memory:")
+
+
+def test_cache_fetch_lfs(tmpdir: Any, manifest_repo: Any) -> None:
+    repo_top = manifest_repo / ".."
+    url = str(repo_top / "a")
+    rev = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=url).decode()
+    prev_data: Dict[str, ProjectInfoDict] = {
+        "a": {"url": url, "revisionExpr": rev.strip()}
+    }
+    git_info = prefetch_git(url, rev.strip(), method=HashMethod.GIT_OBJECTS)
+
+    def fake_prefetch_git(
+        url: str, rev: str, fetch_submodules: bool, fetch_lfs: bool, method: Any
+    ) -> Any:
+        return {**git_info, "sha256": "lfs" if fetch_lfs else "nolfs"}
+
+    mk_repo_file.use_cache(str(tmpdir / "cache.sqlite"))
+    with patch("mk_repo_file.prefetch_git", side_effect=fake_prefetch_git) as mock:
+        for fetch_lfs, sha256 in [(True, "lfs"), (False, "nolfs"), (True, "lfs")]:
+            data = mk_repo_file.make_repo_file(
+                "unused",
+                "unused",
+                prev_data=copy.deepcopy(prev_data),
+                fetch_lfs=fetch_lfs,
+            )
+            assert data["a"]["sha256"] == sha256
+        # The last run reuses the hash of the first one
+        assert mock.call_count == 2
+    mk_repo_file.use_cache(":memory:")
+
+
+def test_copy_from_base() -> None:
+    base_data: Dict[str, Any] = {
+        "tagged": {
+            "url": "https://example.com/tagged",
+            "revisionExpr": "refs/tags/r1",
+            "rev": "a" * 40,
+            "sha256": "tagged-hash",
+        },
+        "pinned": {
+            "url": "https://example.com/pinned",
+            "revisionExpr": "b" * 40,
+            "rev": "b" * 40,
+            "sha256": "pinned-hash",
+        },
+        "branch": {
+            "url": "https://example.com/branch",
+            "revisionExpr": "refs/heads/main",
+            "rev": "c" * 40,
+            "sha256": "branch-hash",
+        },
+        "removed": {"url": "https://example.com/removed", "revisionExpr": "x"},
+    }
+    data: Dict[str, Any] = {
+        "tagged": {"url": "https://example.com/tagged", "revisionExpr": "refs/tags/r1"},
+        "pinned": {"url": "https://example.com/pinned", "revisionExpr": "d" * 40},
+        "branch": {
+            "url": "https://example.com/branch",
+            "revisionExpr": "refs/heads/main",
+        },
+        "added": {"url": "https://example.com/added", "revisionExpr": "e" * 40},
+    }
+
+    mk_repo_file.copy_from_base(data, base_data, [])
+    assert data["tagged"]["sha256"] == "tagged-hash"
+    assert data["tagged"]["rev"] == "a" * 40
+    assert "sha256" not in data["pinned"]
+    assert "sha256" not in data["branch"]  # Branches may have moved
+
+    data["pinned"]["rev"] = "d" * 40
+    data["branch"]["rev"] = "c" * 40
+    data["added"]["rev"] = "e" * 40
+    assert mk_repo_file.diff_repo_files(base_data, data) == {
+        "unchanged": ["branch", "tagged"],
+        "changed": ["pinned"],
+        "added": ["added"],
+        "removed": ["removed"],
+    }
+
+
+def test_journal(tmpdir: Any) -> None:
+    filename = str(tmpdir / "repo-test.json")
+    journal = Journal(filename, compact_every=2)
+    journal.save({"a": {"url": "a"}, "b": {"url": "b"}})
+
+    journal.record("a", {"url": "a", "sha256": "1"})
+    assert json.load(open(filename))["a"] == {"url": "a"}
+    journal.record("b", {"url": "b", "sha256": "2"})  # Compacts
+    assert json.load(open(filename))["b"] == {"url": "b", "sha256": "2"}
+    assert not os.path.exists(filename + ".journal")
+
+    # Simulate a crash while writing a record
+    journal.record("a", {"url": "a", "sha256": "3"})
+    with open(filename + ".journal", "a") as f:
+        f.write('["b", {"url": "b", "sha')
+
+    data = Journal(filename).load()
+    assert data == {
+        "a": {"url": "a", "sha256": "3"},
+        "b": {"url": "b", "sha256": "2"},
+    }
+
+
+@pytest.mark.parametrize("backend", list(mk_repo_file.Backend))
+def test_backends(tmpdir: Any, manifest_repo: Any, backend: Any) -> None:
+    prev_data: Dict[str, Any] = {}
+    for name in ["a", "b"]:
+        rev = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=manifest_repo / ".." / name
+        )
+        prev_data[name] = {
+            "url": str(manifest_repo / ".." / name),
+            "revisionExpr": rev.decode().strip(),
+        }
+    profile_path = str(tmpdir / "profile.json")
+
+    data = mk_repo_file.make_repo_file(
+        "unused",
+        "unused",
+        prev_data=prev_data,
+        jobs=2,
+        hash_method=HashMethod.GIT_OBJECTS,
+        backend=backend,
+        profile_path=profile_path,
+    )
+    assert "sha256" in data["a"]
+    assert "dateTime" in data["b"]
+
+    profile = json.load(open(profile_path))
+    assert set(profile["projects"]) == {"a", "b"}
+    assert "checkout" in profile["totals"]
+
+
+def test_make_repo_files(tmpdir: Any, manifest_repo: Any) -> None:
+    repo_top = manifest_repo / ".."
+    prev_data: Dict[str, Any] = {}
+    for name in ["a", "b"]:
+        rev = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_top / name)
+        prev_data[name] = {
+            "url": str(repo_top / name),
+            "revisionExpr": rev.decode().strip(),
+        }
+    other_data = copy.deepcopy(prev_data)
+    other_data["c"] = other_data.pop("b")  # Same revision at another path
+    saved: Dict[str, Any] = {}
+
+    mk_repo_file.use_cache(":memory:")
+    with patch("mk_repo_file.prefetch_git", wraps=prefetch_git) as mock_prefetch:
+        datas = mk_repo_file.make_repo_files(
+            "unused",
+            [
+                mk_repo_file.RefSpec("one", prev_data=prev_data),
+                mk_repo_file.RefSpec(
+                    "two", prev_data=other_data, callback=saved.update
+                ),
+            ],
+            jobs=2,
+            hash_method=HashMethod.GIT_OBJECTS,
+            profile_path=str(tmpdir / "profile.json"),
+        )
+        assert mock_prefetch.call_count == 2
+
+    assert datas[0]["a"]["sha256"] == datas[1]["a"]["sha256"]
+    assert datas[0]["b"]["sha256"] == datas[1]["c"]["sha256"]
+    assert "dateTime" in datas[1]["c"]
+    assert saved == datas[1]
+
+    profile = json.load(open(tmpdir / "profile.json"))["projects"]
+    assert set(profile) == {"one:a", "one:b", "two:a", "two:c"}
+    assert profile["two:c"]["cached"] == "ref"
+    assert "checkout" in profile["one:b"]
+
+
+def test_lookup_mirror_trees(manifest_repo: Any) -> None:
+    repo_top = str(manifest_repo / "..")
+    items: List[Tuple[str, ProjectInfoDict]] = []
+    trees: Dict[str, str] = {}
+    for name in ["a", "b"]:
+        path = os.path.join(repo_top, name)
+        rev, tree = (
+            subprocess.check_output(["git", "log", "-1", "--pretty=%H %T"], cwd=path)
+            .decode()
+            .split()
+        )
+        trees[rev] = tree
+        items.append((name, {"url": f"https://example.com/{name}", "rev": rev}))
+    items.append(("c", {"url": "https://example.com/a", "rev": "0" * 40}))
+    items.append(("d", {"url": "https://elsewhere.com/d", "rev": "1" * 40}))
+
+    mirrors = MirrorTrie()
+    mirrors.add("https://example.com", repo_top)
+    with patch("robotnix_common.MIRRORS", mirrors):
+        assert mk_repo_file.lookup_mirror_trees(items) == trees
+
+
+def test_fetch_remote_trees(tmpdir: Any, manifest_repo: Any, monkeypatch: Any) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir / "cache"))
+    repo_top = manifest_repo / ".."
+    items: List[Tuple[str, ProjectInfoDict]] = []
+    trees: Dict[str, str] = {}
+    for name in ["a", "b"]:
+        path = str(repo_top / name)
+        rev, tree = (
+            subprocess.check_output(["git", "log", "-1", "--pretty=%H %T"], cwd=path)
+            .decode()
+            .split()
+        )
+        trees[rev] = tree
+        items.append((name, {"url": path, "rev": rev}))
+    items.append(("c", {"url": str(repo_top / "a"), "rev": "0" * 40}))
+    # Only "a" supports partial fetches, "b" would send all of its objects
+    subprocess.check_call(
+        ["git", "config", "uploadpack.allowFilter", "true"], cwd=repo_top / "a"
+    )
+    a_rev = items[0][1]["rev"]
+
+    mk_repo_file.use_cache(":memory:")
+    assert mk_repo_file.fetch_remote_trees(items) == {}
+
+    mk_repo_file.add_to_cache({"rev": "1" * 40, "tree": "2" * 40, "sha256": "x"}, True)
+    assert mk_repo_file.fetch_remote_trees(items, jobs=2) == {a_rev: trees[a_rev]}
+    assert present_objects(url_cache_dir("commits", str(repo_top / "a"))) == {a_rev}
+    assert present_objects(url_cache_dir("commits", str(repo_top / "b"))) == set()
+
+    # Commits are kept between runs
+    (repo_top / "a").remove()
+    assert mk_repo_file.fetch_remote_trees(items[:1]) == {a_rev: trees[a_rev]}
+    mk_repo_file.use_cache(":memory:")
@@ -0,0 +1,92 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import io
+import json
+import os
+import sqlite3
+
+from typing import Any, Dict
+
+from module_info import (
+    ModuleIndex,
+    build_index,
+    install,
+    iter_module_info,
+    lookup_modules,
+)
+
+MODULE_INFO: Dict[str, Any] = {
+    "adb": {
+        "class": ["EXECUTABLES"],
+        "path": ["packages/modules/adb"],
+        "installed": ["out/host/linux-x86/bin/adb"],
+    },
+    'tricky"{[': {
+        "class": ["ETC"],
+        "path": ['some/path with } and \\" in it'],
+        "installed": [],
+    },
+    "fastboot": {
+        "class": ["EXECUTABLES"],
+        "path": ["system/core/fastboot"],
+        "installed": ["out/host/linux-x86/bin/fastboot", "out/host/linux-x86/bin/adb"],
+    },
+}
+
+
+def test_iter_module_info() -> None:
+    text = json.dumps(MODULE_INFO, indent=2)
+    for chunk_size in (1, 7, 1024):
+        assert dict(iter_module_info(io.StringIO(text), chunk_size=chunk_size)) == (
+            MODULE_INFO
+        )
+        assert dict(
+            iter_module_info(io.StringIO(text), ['tricky"{[', "fastboot"], chunk_size)
+        ) == {k: MODULE_INFO[k] for k in ['tricky"{[', "fastboot"]}
+
+
+def test_install(tmpdir: Any, monkeypatch: Any) -> None:
+    monkeypatch.chdir(tmpdir)
+    os.makedirs("out/host/linux-x86/bin")
+    for name in ("adb", "fastboot"):
+        with open(f"out/host/linux-x86/bin/{name}", "w") as f:
+            f.write(name)
+    with open("module-info.json", "w") as f:
+        json.dump(MODULE_INFO, f)
+
+    install(str(tmpdir / "result"), "module-info.json", ["fastboot", "missing"], 2)
+
+    bindir = tmpdir / "result" / "host" / "linux-x86" / "bin"
+    assert sorted(os.listdir(bindir)) == ["adb", "fastboot"]
+    assert (bindir / "fastboot").read() == "fastboot"
+
+
+def test_index(tmpdir: Any, monkeypatch: Any) -> None:
+    module_info = str(tmpdir / "module-info.json")
+    outdir = tmpdir / "out"
+    outdir.mkdir()
+    index = str(outdir / "module-info.sqlite")
+    with open(module_info, "w") as f:
+        json.dump(MODULE_INFO, f)
+    connect = sqlite3.connect
+    opened = []
+
+    def record_connect(database: str, *args: Any, **kwargs: Any) -> Any:
+        opened.append(database)
+        return connect(database, *args, **kwargs)
+
+    monkeypatch.setattr("sqlite3.connect", record_connect)
+    with open(module_info) as f:
+        build_index(f, index)
+    # Like $out, the directory of the index may only hold the index itself
+    assert not any(path.startswith(str(outdir)) for path in opened)
+    assert os.listdir(outdir) == ["module-info.sqlite"]
+    monkeypatch.undo()
+
+    names = ["fastboot", 'tricky"{[', "missing", "fastboot"]
+    expected = {name: MODULE_INFO[name] for name in ["fastboot", 'tricky"{[']}
+    with ModuleIndex(index) as module_index:
+        assert module_index.lookup(names) == expected
+    assert lookup_modules(index, names) == expected
+    assert lookup_modules(module_info, names) == expected
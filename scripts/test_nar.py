@@ -0,0 +1,154 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from unittest.mock import patch
+
+from typing import Any, List
+
+import nar
+import robotnix_common
+from test_mk_repo_file import git_create
+
+
+def test_nix_base32_encode() -> None:
+    assert (
+        nar.nix_base32_encode(hashlib.sha256(b"").digest())
+        == "0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73"
+    )
+
+
+def test_to_nix_base32() -> None:
+    base32 = "0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73"
+    assert (
+        nar.to_nix_base32("sha256-47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=")
+        == base32
+    )
+    assert nar.to_nix_base32(hashlib.sha256(b"").hexdigest()) == base32
+    assert nar.to_nix_base32(base32) == base32
+
+
+def nar_bytes(*tokens: bytes) -> bytes:
+    """Encode `tokens` as NAR strings: a 64-bit length, then zero padded data"""
+    return b"".join(
+        struct.pack("<Q", len(t)) + t + b"\0" * (-len(t) % 8) for t in tokens
+    )
+
+
+# Expected NAR of each path created by make_nar_paths, written out by hand
+NAR_VECTORS = {
+    "file": nar_bytes(
+        b"nix-archive-1", b"(", b"type", b"regular", b"contents", b"hello", b")"
+    ),
+    "exe": nar_bytes(
+        b"nix-archive-1",
+        b"(",
+        b"type",
+        b"regular",
+        b"executable",
+        b"",
+        b"contents",
+        b"#!/bin/sh\n",
+        b")",
+    ),
+    "link": nar_bytes(
+        b"nix-archive-1", b"(", b"type", b"symlink", b"target", b"file", b")"
+    ),
+    "dir": nar_bytes(
+        b"nix-archive-1",
+        *[b"(", b"type", b"directory"],
+        *[b"entry", b"(", b"name", b"empty", b"node"],
+        *[b"(", b"type", b"directory", b")", b")"],
+        *[b"entry", b"(", b"name", b"sub", b"node"],
+        *[b"(", b"type", b"directory"],
+        *[b"entry", b"(", b"name", b"eight", b"node"],
+        *[b"(", b"type", b"regular", b"contents", b"12345678", b")", b")"],
+        *[b")", b")"],
+        *[b"entry", b"(", b"name", b"sub.d", b"node"],
+        *[b"(", b"type", b"symlink", b"target", b"sub/eight", b")", b")"],
+        b")",
+    ),
+}
+
+
+def make_nar_paths(tmpdir: Any) -> List[str]:
+    (tmpdir / "file").write("hello")
+    (tmpdir / "exe").write("#!/bin/sh\n")
+    os.chmod(tmpdir / "exe", 0o755)
+    os.symlink("file", tmpdir / "link")
+    top = tmpdir.mkdir("dir")
+    top.mkdir("empty")
+    top.mkdir("sub").join("eight").write("12345678")
+    os.symlink("sub/eight", top / "sub.d")
+    return [str(tmpdir / name) for name in NAR_VECTORS]
+
+
+def test_nar_vectors(tmpdir: Any) -> None:
+    for path in make_nar_paths(tmpdir):
+        output = bytearray()
+        nar.dump_path(nar.NarWriter(output.extend), path)
+        assert bytes(output) == NAR_VECTORS[os.path.basename(path)]
+        assert nar.hash_path(path) == nar.nix_base32_encode(
+            hashlib.sha256(output).digest()
+        )
+
+
+@pytest.mark.skipif(shutil.which("nix-hash") is None, reason="nix is not available")
+def test_hash_path_nix(tmpdir: Any) -> None:
+    for path in make_nar_paths(tmpdir):
+        expected = subprocess.check_output(
+            ["nix-hash", "--type", "sha256", "--base32", path]
+        )
+        assert nar.hash_path(path) == expected.decode().strip()
+
+
+def test_hash_git_tree(tmpdir: Any) -> None:
+    repo = tmpdir.mkdir("repo")
+    (repo / "file").write("contents")
+    (repo / "odd").write("x" * 13)
+    repo.mkdir("dir")
+    (repo / "dir" / "script").write("#!/bin/sh\n")
+    os.chmod(repo / "dir" / "script", 0o755)
+    repo.mkdir("dir.d")  # git and NAR sort this differently relative to "dir"
+    (repo / "dir.d" / "x").write("")
+    os.symlink("dir/script", repo / "link")
+
+    expected = nar.hash_path(str(repo))
+    git_create(repo)
+
+    assert nar.hash_git_tree(str(repo / ".git"), "release") == expected
+
+    # Fetch through a URL, as is done for remote projects
+    git_info = robotnix_common.prefetch_git_objects(
+        f"file://{repo}", "refs/tags/release"
+    )
+    assert git_info["sha256"] == expected
+
+
+def test_hash_path_mmap(tmpdir: Any) -> None:
+    repo = tmpdir.mkdir("repo")
+    (repo / "small").write("x")
+    (repo / "large").write("y" * 1001)
+
+    with patch("nar.MMAP_THRESHOLD", 100):
+        expected = nar.hash_path(str(repo))
+    assert nar.hash_path(str(repo)) == expected
+
+    git_create(repo)
+    assert nar.hash_git_tree(str(repo / ".git"), "release") == expected
+
+
+def test_hash_git_tree_gitattributes(tmpdir: Any) -> None:
+    repo = tmpdir.mkdir("repo")
+    (repo / ".gitattributes").write("*.bin filter=lfs diff=lfs merge=lfs -text\n")
+    git_create(repo)
+
+    with pytest.raises(nar.UnsupportedTree):
+        nar.hash_git_tree(str(repo / ".git"), "release")
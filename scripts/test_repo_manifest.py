@@ -0,0 +1,117 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import pytest
+
+from typing import Any, Dict
+
+from repo_manifest import (
+    ManifestError,
+    UnsupportedManifest,
+    fetch_manifest,
+    resolve_fetch_url,
+    resolve_manifest,
+)
+from test_mk_repo_file import git_create
+
+FILES: Dict[str, str] = {
+    "default.xml": """<?xml version="1.0" encoding="UTF-8"?>
+        <manifest>
+          <remote name="aosp" fetch=".." revision="refs/tags/android-12.0.0_r1" />
+          <remote name="github" fetch="https://github.com/LineageOS" />
+          <default revision="refs/heads/main" remote="aosp" />
+          <include name="snippets/extra.xml" groups="extra" />
+          <project path="build/make" name="platform/build" groups="pdk">
+            <copyfile src="core/root.mk" dest="Makefile" />
+            <linkfile src="CleanSpec.mk" dest="build/CleanSpec.mk" />
+          </project>
+          <project path="device/foo" name="device_foo" remote="github" />
+          <project name="platform/darwin" groups="notdefault,platform-darwin" />
+          <project name="platform/removed" />
+          <remove-project name="platform/removed" />
+          <extend-project name="device_foo" revision="refs/heads/other" groups="x" />
+        </manifest>
+        """,
+    "snippets/extra.xml": """<manifest>
+          <project path="extra" name="platform/extra" revision="abc" />
+        </manifest>
+        """,
+}
+
+
+def read_file(name: str) -> bytes:
+    return FILES[name].encode()
+
+
+def test_resolve_fetch_url() -> None:
+    base = "https://android.googlesource.com/platform/manifest"
+    assert resolve_fetch_url(base, "..") == "https://android.googlesource.com/"
+    assert resolve_fetch_url(base, "https://x.org/") == "https://x.org"
+    assert resolve_fetch_url("/srv/repo/manifest", ".") == "/srv/repo/"
+    assert resolve_fetch_url("host:path/manifest", "..") == "host:path/"
+
+
+def test_resolve_manifest(tmpdir: Any) -> None:
+    local = tmpdir / "local.xml"
+    local.write(
+        """<manifest>
+          <remove-project name="platform/extra" />
+          <project path="vendor/bar" name="vendor_bar" remote="github" />
+        </manifest>
+        """
+    )
+    data = resolve_manifest(
+        "https://android.googlesource.com/platform/manifest",
+        read_file,
+        local_manifests=[str(local)],
+    )
+    assert data == {
+        "build/make": {
+            "url": "https://android.googlesource.com/platform/build",
+            "revisionExpr": "refs/tags/android-12.0.0_r1",
+            "groups": ["pdk"],
+            "copyfiles": [{"src": "core/root.mk", "dest": "Makefile"}],
+            "linkfiles": [{"src": "CleanSpec.mk", "dest": "build/CleanSpec.mk"}],
+        },
+        "device/foo": {
+            "url": "https://github.com/LineageOS/device_foo",
+            "revisionExpr": "refs/heads/other",
+            "groups": ["x"],
+        },
+        "vendor/bar": {
+            "url": "https://github.com/LineageOS/vendor_bar",
+            "revisionExpr": "refs/heads/main",
+            "groups": ["local:local"],
+        },
+    }
+
+    data = resolve_manifest("https://example.com/manifest", read_file)
+    assert data["extra"]["groups"] == ["extra"]
+    assert data["extra"]["revisionExpr"] == "abc"
+
+
+def test_resolve_manifest_errors() -> None:
+    with pytest.raises(ManifestError):
+        resolve_manifest(
+            "https://example.com",
+            lambda _: b'<manifest><project name="a" /></manifest>',
+        )
+    with pytest.raises(UnsupportedManifest):
+        resolve_manifest(
+            "https://example.com",
+            lambda _: b'<manifest><submanifest name="a" /></manifest>',
+        )
+
+
+def test_fetch_manifest(tmpdir: Any, monkeypatch: Any) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir / "cache"))
+    manifest_repo = tmpdir.mkdir("manifest")
+    for name, text in FILES.items():
+        (manifest_repo / name).write(text, ensure=True)
+    git_create(str(manifest_repo))
+
+    data = fetch_manifest(str(manifest_repo), "refs/tags/release")
+    assert data["build/make"]["url"] == str(tmpdir.dirpath() / "platform/build")
+    # Cached tags are not fetched again
+    manifest_repo.remove()
+    assert fetch_manifest(str(manifest_repo), "refs/tags/release") == data
@@ -0,0 +1,133 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import multiprocessing.pool
+import time
+
+from unittest.mock import patch
+
+from typing import Any, Dict
+
+import robotnix_common
+
+
+def test_ls_remote_single_flight() -> None:
+    calls = []
+
+    def list_remote_refs(url: str) -> Dict[str, str]:
+        calls.append(url)
+        time.sleep(0.1)
+        return {"refs/heads/main": "a" * 40}
+
+    url = "https://example.com/single-flight"
+    with patch("robotnix_common._list_remote_refs", list_remote_refs):
+        with multiprocessing.pool.ThreadPool(8) as pool:
+            results = pool.map(robotnix_common.ls_remote, [url] * 8)
+
+    assert calls == [url]
+    assert all(r == {"refs/heads/main": "a" * 40} for r in results)
+
+
+def test_remote_refs_cache(tmpdir: Any) -> None:
+    url = "https://example.com/cached"
+    cache_file = str(tmpdir / "refs.json")
+    with patch("robotnix_common._list_remote_refs") as list_remote_refs:
+        list_remote_refs.return_value = {"refs/tags/x": "b" * 40}
+        robotnix_common.prefetch_remote_refs([url, url])
+        list_remote_refs.assert_called_once_with(url)
+    robotnix_common.save_remote_refs(cache_file)
+
+    del robotnix_common.REMOTE_REFS[url]
+    robotnix_common.load_remote_refs(cache_file, ttl=0)
+    assert url not in robotnix_common.REMOTE_REFS
+    robotnix_common.load_remote_refs(cache_file, ttl=3600)
+    assert robotnix_common.REMOTE_REFS[url] == {"refs/tags/x": "b" * 40}
+
+
+def test_remote_refs_time() -> None:
+    url = "https://example.com/refs-time"
+    set_remote_refs = robotnix_common.set_remote_refs
+    with patch("time.time", return_value=100.0):
+        set_remote_refs(url, {"refs/tags/v1": "b" * 40}, ["v1"])
+    with patch("time.time", return_value=200.0):
+        set_remote_refs(url, {"refs/heads/main": "a" * 40}, ["main"])
+    # The refs of v1 are as old as before
+    assert robotnix_common.REMOTE_REFS_TIME[url] == 100.0
+
+    with patch("time.time", return_value=300.0):
+        set_remote_refs(url, {"refs/heads/main": "c" * 40})
+    assert robotnix_common.REMOTE_REFS_TIME[url] == 300.0
+    with patch("time.time", return_value=400.0):
+        set_remote_refs(url, {}, ["v2"])
+    assert robotnix_common.REMOTE_REFS_TIME[url] == 300.0
+    assert robotnix_common.REMOTE_REFS[url] == {"refs/heads/main": "c" * 40}
+
+
+def test_ls_remote_patterns() -> None:
+    calls = []
+
+    def list_remote_refs(url: str, patterns: Any = None) -> Dict[str, str]:
+        calls.append(patterns)
+        refs = {
+            "refs/heads/main": "a" * 40,
+            "refs/tags/v1": "b" * 40,
+            "refs/tags/v10": "c" * 40,
+        }
+        if patterns is None:
+            return refs
+        return robotnix_common.filter_refs(refs, patterns)
+
+    url = "https://example.com/patterns"
+    with patch("robotnix_common._list_remote_refs", list_remote_refs):
+        assert robotnix_common.ls_remote(url, ["v1"]) == {"refs/tags/v1": "b" * 40}
+        robotnix_common.prefetch_remote_refs([url], patterns={url: {"v1", "main"}})
+        assert robotnix_common.ls_remote(url, ["main", "v1"]) == {
+            "refs/heads/main": "a" * 40,
+            "refs/tags/v1": "b" * 40,
+        }
+        # A full listing replaces the partial one
+        assert "refs/tags/v10" in robotnix_common.ls_remote(url)
+        robotnix_common.ls_remote(url, ["v10"])
+    assert calls == [{"v1"}, {"main"}, None]
+
+
+def test_mirrors(tmpdir: Any) -> None:
+    mirror_file = tmpdir.join("mirrors")
+    mirror_file.write(
+        "# Comment\n"
+        f"https://github.com/LineageOS={tmpdir}/lineage\n"
+        "https://github.com=https://mirror.example.com/github\n"
+    )
+    tmpdir.mkdir("aosp").mkdir("platform").mkdir("build.git")
+
+    with patch.multiple(
+        robotnix_common,
+        ROBOTNIX_GIT_MIRRORS=f"https://android.googlesource.com={tmpdir}/aosp|"
+        f"https://github.com/LineageOS={tmpdir}/missing",
+        ROBOTNIX_GIT_MIRRORS_FILE=str(mirror_file),
+    ):
+        mirrors = robotnix_common.load_mirrors()
+    assert len(mirrors) == 4
+
+    with patch("robotnix_common.MIRRORS", mirrors):
+        get_mirrored_url = robotnix_common.get_mirrored_url
+        assert (
+            get_mirrored_url("https://android.googlesource.com/platform/build")
+            == f"{tmpdir}/aosp/platform/build"
+        )
+        # Only the leading prefix is replaced
+        assert (
+            get_mirrored_url("https://github.com/foo/https://github.com")
+            == "https://mirror.example.com/github/foo/https://github.com"
+        )
+        # Neither local mirror has this project, fall back to the remote
+        assert robotnix_common.get_mirrored_urls("https://github.com/LineageOS/x") == [
+            f"{tmpdir}/missing/x",
+            f"{tmpdir}/lineage/x",
+            "https://github.com/LineageOS/x",
+        ]
+        assert (
+            get_mirrored_url("https://github.com/LineageOS/x")
+            == "https://github.com/LineageOS/x"
+        )
+        assert get_mirrored_url("https://example.com/a") == "https://example.com/a"
@@ -0,0 +1,48 @@
+# SPDX-FileCopyrightText: 2026 robotnix contributors
+# SPDX-License-Identifier: MIT
+
+import threading
+
+import pytest
+
+from typing import List
+
+from scheduler import Task, estimate_task, run_longest_first
+
+
+def test_longest_first() -> None:
+    started: List[str] = []
+    tasks = [
+        estimate_task("small", "external/foo", None, None),
+        estimate_task("known", "external/bar", 5.0, None),
+        estimate_task("large", "prebuilts/clang/host/linux-x86", None, None),
+    ]
+    run_longest_first(started.append, tasks, jobs=1)
+    assert started == ["large", "known", "small"]
+
+
+def test_disk_budget() -> None:
+    lock = threading.Lock()
+    running: List[str] = []
+    max_running = 0
+
+    def func(item: str) -> None:
+        nonlocal max_running
+        with lock:
+            running.append(item)
+            max_running = max(max_running, len(running))
+        threading.Event().wait(0.05)
+        with lock:
+            running.remove(item)
+
+    tasks = [Task(str(i), 1.0, 60) for i in range(4)]
+    run_longest_first(func, tasks, jobs=4, disk_budget=100)
+    assert max_running == 1
+
+
+def test_exception() -> None:
+    def func(item: str) -> None:
+        raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        run_longest_first(func, [Task("a", 1.0, 0)], jobs=2)